@@ -1,87 +1,557 @@
 """CKAN API actions
 """
-import random
-import string
+import contextlib
+import copy
+import hashlib
+import json
+import math
+import secrets
+import time
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import Any, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
 
-import jwt
-import pytz
 from ckan.model.user import User
 from ckan.plugins import toolkit
 
-from . import util
-from .authzzie import Scope, UnknownEntityType
+from . import audit, cache, keys, tracing, util
+from .authz_binding import refresh as refresh_state
+from .authzzie import Scope, UnknownEntityType, coalesce_scopes
+from .deadline import DEFAULT_FAILURE_THRESHOLD, DEFAULT_RESET_TIMEOUT, CircuitBreaker, Deadline, DeadlineMetrics
+from .querycount import QueryCounter
+from .ratelimit import DEFAULT_SUBSCOPE_COST, DEFAULT_TYPE_COSTS, DEFAULT_WILDCARD_FACTOR, CostModel, TokenBucketLimiter
+from .singleflight import DEFAULT_TIMEOUT, SingleFlight
+from .verifier import DEFAULT_MAX_LIFETIME, get_audience, get_issuer, get_revocation_list, get_token_verifier
 
-DEFAULT_MAX_LIFETIME = 900
+jwt = util.lazy_module('jwt')
+pytz = util.lazy_module('pytz')
+verification = util.lazy_module('ckanext.authz_service.verification')
+
+DEFAULT_LIFETIME_BUCKET = 60
+
+DEFAULT_DOWNSCOPE_MAX_LIFETIME = 300
+
+DEFAULT_USER_RATE = 50
+
+DEFAULT_USER_BURST = 500
+
+DEFAULT_IP_RATE = 100
+
+DEFAULT_IP_BURST = 1000
+
+DECISION_CACHE_NAMESPACE = 'decisions'
+
+_single_flight = None  # type: Optional[SingleFlight]
+
+_rate_limiters = None  # type: Optional[Dict[str, TokenBucketLimiter]]
+
+_cost_model = None  # type: Optional[CostModel]
+
+_circuit_breaker = None  # type: Optional[CircuitBreaker]
+
+_deadline_metrics = None  # type: Optional[DeadlineMetrics]
+
+
+class RateLimitExceeded(toolkit.NotAuthorized):
+    """An authorization request was rejected because it exceeds the caller's rate limit
+    """
+
+    def __init__(self, message, retry_after):
+        # type: (str, float) -> None
+        super(RateLimitExceeded, self).__init__(message)
+        self.retry_after = retry_after
 
 
 def authorize(authorizer, context, data_dict):
     """Request an authorization token for a list of scopes
+
+    If rate limiting is enabled, requests exceeding the user's or client IP's
+    rate limit are rejected before any scope is evaluated.
+
+    Unless disabled, concurrent identical requests (same user, scopes and
+    lifetime bucket) handled by the same process are evaluated once, and
+    share the result.
+
+    If `debug` is set and debug responses are enabled, the response includes
+    a `debug` field with the number of SQL queries made by this request
+    (requests sharing the result of a concurrent request make none).
+
+    Scopes that could not be evaluated within the configured time limits are
+    not granted, and are listed in the `deferred_scopes` response field.
     """
     scopes = toolkit.get_or_bust(data_dict, 'scopes')
     if isinstance(scopes, str):
         scopes = scopes.split(' ')
-    requested_scopes = [Scope.from_string(s) for s in scopes]
+    requested_scopes = _parse_scopes(scopes)
 
-    max_lifetime = util.get_config_int('jwt_max_lifetime', DEFAULT_MAX_LIFETIME)
+    lifetime = _get_lifetime(data_dict)
+    debug = _is_debug_requested(data_dict)
+    _check_rate_limits(context, requested_scopes)
+
+    started = time.perf_counter()
+    attributes = {"authz.requested_scopes": ' '.join(str(s) for s in requested_scopes),
+                  "authz.lifetime": lifetime}
+    with tracing.span('authz.authorize', attributes) as span, _count_queries(debug) as queries:
+        result, jti = _authorize_request(authorizer, context, requested_scopes, lifetime)
+        span.set_attribute('authz.granted_scopes', ' '.join(result['granted_scopes']))
+        span.set_attribute('authz.granted', bool(result['granted_scopes']))
+
+    if queries is not None:
+        result['debug'] = {"query_count": queries.count}
+
+    _audit_authorize(result, jti, time.perf_counter() - started)
+    return result
+
+
+def refresh(authorizer, context, data_dict):
+    """Issue a new token for the scopes granted by a still valid token
+
+    The token must have been issued to the current user. Unless they were
+    changed, scopes are not re-evaluated if the token was issued with token
+    refresh enabled and nothing they depend on changed since they were
+    evaluated (see `authz_binding.refresh`). Otherwise, they are re-evaluated
+    the same way as by `authorize`, and only re-granted if still permitted.
+    """
+    payload = _verify_token_to_refresh(toolkit.get_or_bust(data_dict, 'token'), context)
+    requested_scopes = [Scope.from_string(s) for s in payload.get('scopes', '').split(' ') if s]
+    lifetime = _get_lifetime(data_dict)
+
+    started = time.perf_counter()
+    # The new state must be recorded before checking for changes, so that changes made since are not missed
+    claims = _get_refresh_claims(context)
+    state = payload.get(refresh_state.STATE_CLAIM) if claims else None
+    reused, stale = refresh_state.split_stale_scopes(requested_scopes, state, context)
+    if reused:
+        # Scopes are only reused for a limited time since they were first evaluated
+        claims[refresh_state.STATE_CLAIM]['at'] = state['at']
+    _check_rate_limits(context, stale)
+
+    with tracing.span('authz.refresh', {"authz.reused_scopes": len(reused),
+                                        "authz.evaluated_scopes": len(stale)}):
+        evaluated, deferred = _evaluate_scopes(authorizer, context, stale) if stale else ([], [])
+        granted_scopes, coalescing_report = _coalesce_granted_scopes(reused + evaluated)
+        result, jti = _create_response(context, requested_scopes, granted_scopes, coalescing_report, lifetime,
+                                       claims, deferred)
+
+    result['refreshed'] = {"reused_scopes": [str(s) for s in reused],
+                           "evaluated_scopes": [str(s) for s in stale]}
+    _audit_authorize(result, jti, time.perf_counter() - started, event='refresh')
+    return result
+
+
+def downscope(authorizer, context, data_dict):
+    """Derive a token for a subset of the scopes granted by a valid token
+
+    All requested scopes must be covered by the token's granted scopes; No
+    authorizer is called and the database is not accessed. The derived token
+    is issued to the same subject, expires no later than the original token,
+    and is revoked if the original token is revoked by ID.
+    """
+    payload = _verify_issued_token(toolkit.get_or_bust(data_dict, 'token'), 'downscoped')
+    scopes = toolkit.get_or_bust(data_dict, 'scopes')
+    if isinstance(scopes, str):
+        scopes = scopes.split(' ')
+    requested_scopes = _parse_scopes(s for s in scopes if s)
+
+    with tracing.span('authz.downscope', {"authz.requested_scopes": ' '.join(scopes)}):
+        matcher = authorizer.get_scope_matcher(Scope.from_string(s) for s in payload.get('scopes', '').split(' ')
+                                               if s)
+        uncovered = [str(scope) for scope in requested_scopes if not matcher.matches(scope)]
+        if uncovered:
+            raise toolkit.NotAuthorized("Requested scopes are not granted by the token: {}".format(' '.join(uncovered)))
+
+        granted_scopes, coalescing_report = _coalesce_granted_scopes(requested_scopes)
+        expires = _get_downscoped_expiry(payload, data_dict)
+        claims = {claim: payload[claim] for claim in ('sub', 'name', 'email') if claim in payload}
+        if payload.get('jti'):
+            claims['parent_jti'] = payload['jti']
+
+        token, _ = _sign_token(claims, granted_scopes, expires)
+        result = {"user_id": payload.get('sub'),
+                  "token": token,
+                  "expires_at": expires.isoformat(),
+                  "requested_scopes": [str(s) for s in requested_scopes],
+                  "granted_scopes": granted_scopes}
+
+    if coalescing_report:
+        result['scopes_coalescing'] = coalescing_report
+
+    return result
+
+
+def _get_downscoped_expiry(payload, data_dict):
+    # type: (Dict[str, Any], Dict[str, Any]) -> datetime
+    """Get the expiry time of a token derived from a token, which is no later than the original token's
+    """
+    max_lifetime = util.get_config_int('downscope_max_lifetime', DEFAULT_DOWNSCOPE_MAX_LIFETIME)
     lifetime = min(toolkit.asint(data_dict.get('lifetime', max_lifetime)), max_lifetime)
     expires = datetime.now(tz=pytz.utc) + timedelta(seconds=lifetime)
+    if payload.get('exp') is not None:
+        expires = min(expires, datetime.fromtimestamp(payload['exp'], tz=pytz.utc))
+    return expires
+
+
+def _verify_token_to_refresh(token, context):
+    # type: (str, Dict[str, Any]) -> Dict[str, Any]
+    """Verify a token to refresh, and check that it was issued to the current user
+    """
+    payload = _verify_issued_token(token, 'refreshed')
+    if payload.get('sub') != (context.get('user') or None):
+        raise toolkit.NotAuthorized("Token can not be refreshed: it was not issued to the current user")
+    return payload
+
+
+def _verify_issued_token(token, operation):
+    # type: (str, str) -> Dict[str, Any]
+    """Verify a token issued by this extension, including that it was not revoked, and get its payload
+
+    Raises `NotAuthorized` if the token is not valid.
+    """
+    verified = get_token_verifier().verify(token)
+    if not verified['verified']:
+        raise toolkit.NotAuthorized("Token can not be {}: {}".format(operation, verified['message']))
+
+    return verified['payload']
+
+
+def _get_refresh_claims(context):
+    # type: (Dict[str, Any]) -> Dict[str, Any]
+    """Get the authorization state claim to include in tokens, if reusing scopes on token refresh is enabled
+    """
+    if not util.get_config_bool('refresh_reuse_scopes', False):
+        return {}
+    return {refresh_state.STATE_CLAIM: refresh_state.get_authorization_state(context)}
+
+
+def _is_debug_requested(data_dict):
+    # type: (Dict[str, Any]) -> bool
+    """Tell if a debug response was requested, and debug responses are enabled
+    """
+    return toolkit.asbool(data_dict.get('debug', False)) and util.get_config_bool('debug_responses', False)
+
+
+@contextlib.contextmanager
+def _count_queries(enabled):
+    # type: (bool) -> Iterator[Optional[QueryCounter]]
+    """Context manager counting SQL queries if enabled, yielding the counter or `None`
+    """
+    if not enabled:
+        yield None
+        return
+    with QueryCounter() as counter:
+        yield counter
+
+
+def _get_lifetime(data_dict):
+    # type: (Dict[str, Any]) -> int
+    """Get the requested token lifetime, limited to the configured maximal lifetime
+    """
+    max_lifetime = util.get_config_int('jwt_max_lifetime', DEFAULT_MAX_LIFETIME)
+    return min(toolkit.asint(data_dict.get('lifetime', max_lifetime)), max_lifetime)
+
+
+def _audit_authorize(result, jti, latency, event='authorize'):
+    # type: (Dict[str, Any], Optional[str], float, str) -> None
+    """Record an audit event for an issued token, if audit logging is enabled
+    """
+    audit_log = audit.get_audit_log()
+    if audit_log is None:
+        return
+
+    audit_log.record({"event": event,
+                      "time": datetime.now(tz=pytz.utc).isoformat(),
+                      "user": result['user_id'],
+                      "requested_scopes": result['requested_scopes'],
+                      "granted_scopes": result['granted_scopes'],
+                      "deferred_scopes": result['deferred_scopes'],
+                      "jti": jti,
+                      "expires_at": result['expires_at'],
+                      "latency_ms": round(latency * 1000, 3)})
+
+
+def _authorize_request(authorizer, context, requested_scopes, lifetime):
+    # type: (Any, Dict[str, Any], List[Scope], int) -> Tuple[Dict[str, Any], Optional[str]]
+    """Authorize requested scopes and create a token, sharing work with concurrent identical requests
+
+    Returns the `authorize` response and the ID of the created token, if any.
+    """
+    if not util.get_config_bool('single_flight', True):
+        return _authorize(authorizer, context, requested_scopes, lifetime)
+
+    key = _get_single_flight_key(context, requested_scopes, lifetime)
+    if util.get_config_bool('jwt_include_token_id', False):
+        # Each token must have a unique ID, so only scope evaluation can be shared
+        granted_scopes, deferred, coalescing_report, claims = get_single_flight().do(
+            key, _authorize_scopes, authorizer, context, requested_scopes)
+        return _create_response(context, requested_scopes, granted_scopes, coalescing_report, lifetime, claims,
+                                deferred)
+
+    result, jti = get_single_flight().do(key, _authorize, authorizer, context, requested_scopes, lifetime)
+    result = copy.deepcopy(result)
+    result['requested_scopes'] = [str(s) for s in requested_scopes]
+    return result, jti
+
+
+def _authorize(authorizer, context, requested_scopes, lifetime):
+    # type: (Any, Dict[str, Any], List[Scope], int) -> Tuple[Dict[str, Any], Optional[str]]
+    """Authorize requested scopes and create a token
+    """
+    granted_scopes, deferred, coalescing_report, claims = _authorize_scopes(authorizer, context, requested_scopes)
+    return _create_response(context, requested_scopes, granted_scopes, coalescing_report, lifetime, claims, deferred)
+
+
+def _authorize_scopes(authorizer, context, requested_scopes):
+    # type: (Any, Dict[str, Any], List[Scope]) -> Tuple[List[str], List[Scope], Optional[Dict[str, int]], Dict]
+    """Get the granted scopes (coalesced unless disabled), deferred scopes, coalescing report and extra token claims
+    """
+    claims = _get_refresh_claims(context)
+    granted, deferred = _evaluate_scopes_cached(authorizer, context, requested_scopes)
+    granted_scopes, coalescing_report = _coalesce_granted_scopes(granted)
+    return granted_scopes, deferred, coalescing_report, claims
+
+
+def _parse_scopes(scopes):
+    # type: (Iterable[str]) -> List[Scope]
+    """Parse requested scope strings
+    """
+    try:
+        return [Scope.from_string(s) for s in scopes]
+    except ValueError as e:
+        raise toolkit.ValidationError("Invalid scope: {}".format(e))
+
 
+def _evaluate_scopes(authorizer, context, requested_scopes):
+    # type: (Any, Dict[str, Any], List[Scope]) -> Tuple[List[Scope], List[Scope]]
+    """Get the list of granted scopes, and the list of scopes deferred due to time limits
+    """
+    deadline = _create_deadline()
     try:
-        granted_scopes = [str(scope) for scope
-                          in filter(None, (authorizer.authorize_scope(s, context=context) for s in requested_scopes))]
+        granted = authorizer.authorize_scopes(requested_scopes, deadline=deadline, context=context)
     except UnknownEntityType as e:
         raise toolkit.ValidationError(str(e))
 
+    get_deadline_metrics().record(deadline)
+    return [scope for scope in granted if scope], deadline.deferred_scopes
+
+
+def _evaluate_scopes_cached(authorizer, context, requested_scopes):
+    # type: (Any, Dict[str, Any], List[Scope]) -> Tuple[List[Scope], List[Scope]]
+    """Evaluate scopes as `_evaluate_scopes` does, reusing a cached decision for the same caller and scopes if enabled
+
+    Cached decisions are stored with the authorization state they were made
+    in, and are only reused if nothing the requested scopes depend on changed
+    since, the same way granted scopes are reused on token refresh (see
+    `authz_binding.refresh`).
+    """
+    ttl = util.get_config_int('decision_cache_ttl', 0)
+    if ttl <= 0:
+        return _evaluate_scopes(authorizer, context, requested_scopes)
+
+    backend = cache.get_backend(DECISION_CACHE_NAMESPACE)
+    key = _get_decision_cache_key(context, requested_scopes)
+    decision = backend.get(key)
+    if decision is not None:
+        _, stale = refresh_state.split_stale_scopes(requested_scopes, decision['state'], context)
+        if not stale:
+            return [Scope.from_string(s) for s in decision['granted']], []
+
+    # The state must be recorded before evaluating scopes, so that changes made meanwhile are not missed
+    state = refresh_state.get_authorization_state(context)
+    granted, deferred = _evaluate_scopes(authorizer, context, requested_scopes)
+    if not deferred:
+        backend.set(key, {"state": state, "granted": [str(s) for s in granted]}, ttl)
+    return granted, deferred
+
+
+def _get_decision_cache_key(context, requested_scopes):
+    # type: (Dict[str, Any], List[Scope]) -> str
+    """Get the decision cache key identifying identical callers requesting the same scopes
+    """
+    key = [get_caller_key(context=context), sorted({str(s) for s in requested_scopes})]
+    return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+def _create_deadline():
+    # type: () -> Deadline
+    """Create the deadline for evaluating the scopes of a request, which never passes unless configured
+    """
+    budget = util.get_config_int('authorize_deadline_ms', 0)
+    return Deadline(budget / 1000.0 if budget > 0 else math.inf)
+
+
+def _coalesce_granted_scopes(granted):
+    # type: (List[Scope]) -> Tuple[List[str], Optional[Dict[str, int]]]
+    """Coalesce granted scopes unless disabled, and get the coalescing report
+    """
+    granted_scopes = [str(scope) for scope in granted]
+    coalescing_report = None
+    if util.get_config_bool('coalesce_scopes', True):
+        uncoalesced_scopes = granted_scopes
+        # Entities are only grouped into multi-reference scopes for clients using them
+        group_refs = any(scope.is_multi_ref for scope in granted)
+        granted_scopes = [str(scope) for scope in coalesce_scopes(granted, group_refs=group_refs)]
+        coalescing_report = _get_coalescing_report(uncoalesced_scopes, granted_scopes)
+
+    return granted_scopes, coalescing_report
+
+
+def _create_response(context,  # type: Dict[str, Any]
+                     requested_scopes,  # type: List[Scope]
+                     granted_scopes,  # type: List[str]
+                     coalescing_report,  # type: Optional[Dict[str, int]]
+                     lifetime,  # type: int
+                     claims=None,  # type: Optional[Dict]
+                     deferred_scopes=None,  # type: Optional[List[Scope]]
+                     ):
+    # type: (...) -> Tuple[Dict[str, Any], Optional[str]]
+    """Create a token for the granted scopes and the `authorize` response
+
+    Returns the response and the ID of the created token, if any.
+    """
+    expires = datetime.now(tz=pytz.utc) + timedelta(seconds=lifetime)
     user = context.get('auth_user_obj')
-    return {"user_id": user.name if user else None,
-            "token": _create_token(user, granted_scopes, expires),
-            "expires_at": expires.isoformat(),
-            "requested_scopes": [str(s) for s in requested_scopes],
-            "granted_scopes": granted_scopes}
+    token, jti = _create_token(user, granted_scopes, expires, claims)
+    result = {"user_id": user.name if user else None,
+              "token": token,
+              "expires_at": expires.isoformat(),
+              "requested_scopes": [str(s) for s in requested_scopes],
+              "granted_scopes": granted_scopes,
+              "deferred_scopes": [str(s) for s in deferred_scopes or ()]}
+
+    if coalescing_report:
+        result['scopes_coalescing'] = coalescing_report
+
+    return result, jti
+
+
+def _get_single_flight_key(context, requested_scopes, lifetime):
+    # type: (Dict[str, Any], List[Scope], int) -> Tuple[Hashable, ...]
+    """Get the key identifying identical `authorize` requests
+    """
+    bucket = max(util.get_config_int('single_flight_lifetime_bucket', DEFAULT_LIFETIME_BUCKET), 1)
+    return ('authorize',
+            get_caller_key(context=context),
+            tuple(sorted({str(s) for s in requested_scopes})),
+            lifetime // bucket)
+
+
+def get_caller_key(context=None, **_):
+    # type: (Optional[Dict[str, Any]], Any) -> Optional[Hashable]
+    """Get a key identifying the caller of an action or authorizer, for sharing results between identical callers
+    """
+    if context is None:
+        return None
+    return context.get('user'), bool(context.get('ignore_auth'))
+
+
+def get_single_flight():
+    # type: () -> SingleFlight
+    """Get the single-flight group shared by `authorize` and authorizer calls, creating it on first use
+    """
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight(util.get_config_int('single_flight_timeout', DEFAULT_TIMEOUT))
+    return _single_flight
+
+
+def reset_single_flight():
+    # type: () -> None
+    """Discard the shared single-flight group
+    """
+    global _single_flight
+    _single_flight = None
 
 
 @toolkit.side_effect_free
 def verify(_, data_dict, **__):
     """Validate a JWT token and dump it's payload
+
+    Tokens are only recorded as used by replay detection for POST requests;
+    GET requests, which may be repeated by crawlers and proxies, check for
+    replays without using the token up.
     """
     token = toolkit.get_or_bust(data_dict, 'token')
     strict = toolkit.asbool(data_dict.get('strict', True))
-    jwt_algorithm = util.get_config('jwt_algorithm', 'RS256')
-    if jwt_algorithm[0:2] == 'HS':
-        # We're using a symmetric secret key
-        key = _get_private_key()
-    else:
-        key = _get_public_key()
+    check_replay = toolkit.asbool(data_dict.get('check_replay', util.get_config_bool('replay_detection', False)))
+    return get_token_verifier().verify(token, strict=strict, check_replay=check_replay,
+                                       record_replay=not _is_get_request())
 
-    if key is None:
-        raise ValueError("No key is configured to verify JWT token")
 
+def _is_get_request():
+    # type: () -> bool
+    """Tell if the current action is called through a GET request
+    """
     try:
-        decoded = jwt.decode(token, key, algorithms=jwt_algorithm)
-        result = {"verified": True,
-                  "payload": decoded}
-    except jwt.PyJWTError as e:
-        result = {"verified": False,
-                  "message": str(e)}
-
-        if not strict:
-            # Try to decode without verification and provide the payload
-            try:
-                decoded = jwt.decode(token, key, verify=False, algorithms=jwt_algorithm)
-                result['payload'] = decoded
-            except jwt.PyJWTError:
-                pass
+        return toolkit.request.method == 'GET'
+    except (RuntimeError, TypeError):
+        # Not called within a request
+        return False
 
-    return result
+
+def revoke(context, data_dict):
+    """Revoke issued tokens before they expire
+
+    Tokens can be revoked by passing the token itself as `token`, by token
+    ID (`jti`, optionally with the token's `expires_at` UNIX timestamp), or
+    all tokens issued to a `subject` (optionally only those issued before the
+    `issued_before` UNIX timestamp).
+    """
+    toolkit.check_access('authz_revoke', context, data_dict)
+    revocations = get_revocation_list()
+    revoked = {}
+
+    if data_dict.get('token'):
+        payload = _decode_token_to_revoke(data_dict['token'])
+        revocations.revoke_token(payload['jti'], payload.get('exp'))
+        revoked['jti'] = payload['jti']
+
+    if data_dict.get('jti'):
+        revocations.revoke_token(data_dict['jti'], _get_timestamp(data_dict, 'expires_at'))
+        revoked['jti'] = data_dict['jti']
+
+    if data_dict.get('subject'):
+        revocations.revoke_subject(data_dict['subject'], _get_timestamp(data_dict, 'issued_before'))
+        revoked['subject'] = data_dict['subject']
+
+    if not revoked:
+        raise toolkit.ValidationError("One of 'token', 'jti' or 'subject' must be specified")
+
+    return {"revoked": revoked}
+
+
+def _decode_token_to_revoke(token):
+    # type: (str) -> Dict[str, Any]
+    """Decode and verify a token passed to `revoke`
+    """
+    verified = verification.verify_token(token, keys.get_verification_key(), keys.get_algorithm(),
+                                         issuer=get_issuer(), audience=get_audience())
+    if not verified['verified']:
+        raise toolkit.ValidationError("Invalid token: {}".format(verified['errors'][0]['message']))
+
+    payload = verified['payload']
+    if not payload.get('jti'):
+        raise toolkit.ValidationError("Token has no ID and can only be revoked by subject")
+
+    return payload
+
+
+def _get_timestamp(data_dict, key):
+    # type: (Dict[str, Any], str) -> Optional[float]
+    """Get an optional UNIX timestamp parameter
+    """
+    value = data_dict.get(key)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError("'{}' must be a UNIX timestamp".format(key))
 
 
 @toolkit.side_effect_free
 def public_key(*_, **__):
     """Provide the public key used for JWT signing, if one was configured
     """
-    pub_key = _get_public_key()
+    pub_key = keys.get_public_key()
     if pub_key:
         return {
             "public_key": pub_key
@@ -90,64 +560,180 @@ def public_key(*_, **__):
     raise toolkit.ObjectNotFound("Public key has not been configured")
 
 
-def _create_token(user, scopes, expires):
-    # type: (Optional[User], List[Scope], datetime) -> str
-    """Create a JWT token
+def _get_coalescing_report(original, coalesced):
+    # type: (List[str], List[str]) -> Dict[str, int]
+    """Report the effect of coalescing on the `scopes` claim
+    """
+    return {"original_count": len(original),
+            "original_size": len(' '.join(original)),
+            "coalesced_count": len(coalesced),
+            "coalesced_size": len(' '.join(coalesced))}
+
+
+def _create_token(user, scopes, expires, claims=None):
+    # type: (Optional[User], List[str], datetime, Optional[Dict[str, Any]]) -> Tuple[str, Optional[str]]
+    """Create a JWT token for a user, optionally with extra claims, and return it with its ID, if any
     """
-    jwt_algorithm = util.get_config('jwt_algorithm', 'RS256')
-    private_key = _get_private_key()
-    issuer = util.get_config('jwt_issuer', toolkit.config.get('ckan.site_url'))
+    user_claims = {"sub": user.name if user else None,
+                   "name": user.fullname if user else None}
+
+    if util.get_config_bool('jwt_include_user_email', False):
+        user_claims['email'] = user.email if user else None
+
+    if claims:
+        user_claims.update(claims)
+
+    return _sign_token(user_claims, scopes, expires)
+
 
+def _sign_token(claims, scopes, expires):
+    # type: (Dict[str, Any], List[str], datetime) -> Tuple[str, Optional[str]]
+    """Create a JWT token with the given claims and scopes, adding registered claims
+
+    Returns the token and its ID, if token IDs are enabled.
+    """
+    jwt_algorithm = keys.get_algorithm()
+    private_key = keys.get_signing_key(jwt_algorithm)
+
+    now = datetime.now(tz=pytz.utc)
     payload = {"exp": expires,
-               "nbf": datetime.now(tz=pytz.utc),
-               "sub": user.name if user else None,
-               "iss": issuer,
-               "name": user.fullname if user else None,
+               "nbf": now,
+               "iat": now,
+               "iss": get_issuer(),
                "scopes": ' '.join(scopes)}
 
-    audience = util.get_config('jwt_audience')
+    audience = get_audience()
     if audience:
         payload['aud'] = audience
 
-    if util.get_config_bool('jwt_include_user_email', False):
-        payload['email'] = user.email if user else None
-
     if util.get_config_bool('jwt_include_token_id', False):
         payload['jti'] = _generate_jti()
 
-    return jwt.encode(payload, private_key, jwt_algorithm)
+    payload.update(claims)
 
+    with tracing.span('authz.sign', {"jwt.algorithm": jwt_algorithm}):
+        return jwt.encode(payload, private_key, jwt_algorithm), payload.get('jti')
 
-def _get_public_key():
-    # type: () -> Optional[bytes]
-    """Get the configured public key from file
+
+def _check_rate_limits(context, requested_scopes):
+    # type: (Dict[str, Any], List[Scope]) -> None
+    """Take the estimated cost of a request from the user's and client IP's rate limits
+
+    Raises `RateLimitExceeded` if either of them is exceeded, in which case
+    nothing is taken from either.
+    """
+    if context.get('ignore_auth') or not util.get_config_bool('rate_limit', False):
+        return
+
+    cost = get_cost_model().request_cost(requested_scopes)
+    taken = []  # type: List[Tuple[TokenBucketLimiter, str]]
+    for limit, key in (('user', context.get('user')), ('ip', _get_client_ip())):
+        if not key:
+            continue
+        limiter = get_rate_limiters()[limit]
+        bucket = '{}:{}'.format(limit, key)
+        retry_after = limiter.consume(bucket, cost)
+        if retry_after:
+            for taken_limiter, taken_bucket in taken:
+                taken_limiter.refund(taken_bucket, cost)
+            raise RateLimitExceeded(_get_rate_limit_message(limit, cost, limiter.burst, retry_after), retry_after)
+        taken.append((limiter, bucket))
+
+
+def _get_rate_limit_message(limit, cost, burst, retry_after):
+    # type: (str, int, float, float) -> str
+    if math.isinf(retry_after):
+        return ("Authorization request cost ({}) exceeds the maximal {} rate limit budget ({:g}); "
+                "Request fewer or more specific scopes".format(cost, limit, burst))
+    return "Authorization request {} rate limit exceeded; Retry after {:.1f} seconds".format(limit, retry_after)
+
+
+def _get_client_ip():
+    # type: () -> Optional[str]
+    """Get the IP address of the client making the current request, if there is one
     """
-    pub_key_file = util.get_config('jwt_public_key_file', None)
-    if pub_key_file is None:
+    try:
+        return toolkit.request.remote_addr
+    except (RuntimeError, TypeError, AttributeError):
         return None
 
-    with open(pub_key_file, 'rb') as f:
-        return f.read()
+
+def get_cost_model():
+    # type: () -> CostModel
+    """Get the model used to estimate the cost of authorization requests for rate limiting
+    """
+    global _cost_model
+    if _cost_model is None:
+        _cost_model = CostModel(
+            CostModel.parse_type_costs(util.get_config('rate_limit_scope_costs', DEFAULT_TYPE_COSTS)),
+            wildcard_factor=util.get_config_int('rate_limit_wildcard_factor', DEFAULT_WILDCARD_FACTOR),
+            subscope_cost=util.get_config_int('rate_limit_subscope_cost', DEFAULT_SUBSCOPE_COST))
+    return _cost_model
+
+
+def get_rate_limiters():
+    # type: () -> Dict[str, TokenBucketLimiter]
+    """Get the per-user and per-IP rate limiters, creating them on first use
+    """
+    global _rate_limiters
+    if _rate_limiters is None:
+        backend = cache.get_backend('ratelimit')
+        _rate_limiters = {
+            limit: TokenBucketLimiter(backend,
+                                      float(util.get_config('rate_limit_{}_rate'.format(limit), rate)),
+                                      float(util.get_config('rate_limit_{}_burst'.format(limit), burst)))
+            for limit, rate, burst in (('user', DEFAULT_USER_RATE, DEFAULT_USER_BURST),
+                                       ('ip', DEFAULT_IP_RATE, DEFAULT_IP_BURST))}
+    return _rate_limiters
+
+
+def reset_rate_limiters():
+    # type: () -> None
+    """Discard the rate limiters and cost model
+    """
+    global _rate_limiters, _cost_model
+    _rate_limiters = None
+    _cost_model = None
 
 
-def _get_private_key():
-    # type: () -> Optional[bytes]
-    """Get the configured private key from file or string
+def get_circuit_breaker():
+    # type: () -> Optional[CircuitBreaker]
+    """Get the circuit breaker for authorizers that keep timing out, creating it on first use
+
+    Returns `None` if disabled by setting `circuit_breaker_failures` to 0.
     """
-    private_key = util.get_config('jwt_private_key', None)
-    if private_key:
-        return private_key.encode('ascii')
+    global _circuit_breaker
+    threshold = util.get_config_int('circuit_breaker_failures', DEFAULT_FAILURE_THRESHOLD)
+    if _circuit_breaker is None and threshold > 0:
+        _circuit_breaker = CircuitBreaker(threshold,
+                                          util.get_config_int('circuit_breaker_reset', DEFAULT_RESET_TIMEOUT))
+    return _circuit_breaker
 
-    private_key_file = util.get_config('jwt_private_key_file')
-    if private_key_file:
-        with open(private_key_file, 'rb') as f:
-            return f.read()
 
-    return None
+def get_deadline_metrics():
+    # type: () -> DeadlineMetrics
+    """Get the counters of requests and scopes deferred due to time limits, creating them on first use
+    """
+    global _deadline_metrics
+    if _deadline_metrics is None:
+        _deadline_metrics = DeadlineMetrics()
+    return _deadline_metrics
 
 
-def _generate_jti(length=8):
-    # type: (int) -> bytes
+def reset_time_limits():
+    # type: () -> None
+    """Discard the circuit breaker and deadline metrics
+    """
+    global _circuit_breaker, _deadline_metrics
+    _circuit_breaker = None
+    _deadline_metrics = None
+
+
+def _generate_jti(nbytes=16):
+    # type: (int) -> str
     """Generate a unique token ID
+
+    The ID is based on `nbytes` random bytes from a cryptographically secure
+    source, so the chance of collision is negligible.
     """
-    return ''.join(random.choice(string.printable) for _ in range(length))
+    return secrets.token_urlsafe(nbytes)
@@ -0,0 +1,273 @@
+"""Asynchronous audit log
+
+Audit events (e.g. issued tokens, with the requesting user, requested and
+granted scopes, token ID, expiry and latency) are recorded by putting them on
+a bounded in-memory queue, which never blocks the request path. A background
+thread drains the queue and writes events in batches to an audit sink. If the
+queue is full, events are dropped and counted.
+
+The sink is selected using the `ckanext.authz_service.audit_log_sink`
+configuration setting:
+
+* `file` (the default) - a JSON Lines file, set by `audit_log_file`, which is
+  rotated when it reaches `audit_log_max_bytes`
+* `some.module:factory` - a custom callable, called with no arguments and
+  returning an `AuditSink` instance
+
+Each CKAN worker process has its own queue and writer thread; When using the
+file sink, each worker process should be configured to write to a different
+file, or a custom sink should be used.
+"""
+import atexit
+import importlib
+import io
+import json
+import os
+import queue
+import threading
+from typing import Any, Dict, List, Optional
+
+from . import util
+
+DEFAULT_QUEUE_SIZE = 10000
+
+DEFAULT_BATCH_SIZE = 100
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+
+DEFAULT_BACKUP_COUNT = 5
+
+_audit_log = None  # type: Optional[AuditLog]
+
+_STOP = object()
+
+
+class AuditSink(object):
+    """Audit sink interface
+    """
+
+    def write(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        """Write a batch of audit events
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        # type: () -> None
+        """Release any resources held by the sink
+        """
+
+
+class JsonLinesFileSink(AuditSink):
+    """Write audit events to a JSON Lines file, rotating it when it gets too big
+
+    When rotated, the file is renamed by appending `.1` to its name, and
+    existing backups are renamed from `.1` to `.2` etc. Up to `backup_count`
+    backups are kept.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT):
+        # type: (str, Optional[int], int) -> None
+        self.path = path
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._file = None  # type: Optional[io.TextIOBase]
+
+    def write(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        data = ''.join(json.dumps(event, sort_keys=True, default=str) + '\n' for event in events)
+        if self._file is None:
+            self._file = io.open(self.path, 'a', encoding='utf-8')
+
+        size = self._file.tell()
+        if self._max_bytes and size > 0 and size + len(data) > self._max_bytes:
+            self._rotate()
+
+        self._file.write(data)
+        self._file.flush()
+
+    def close(self):
+        # type: () -> None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _rotate(self):
+        # type: () -> None
+        self.close()
+        if self._backup_count > 0:
+            for i in range(self._backup_count - 1, 0, -1):
+                source = '{}.{}'.format(self.path, i)
+                if os.path.exists(source):
+                    os.replace(source, '{}.{}'.format(self.path, i + 1))
+            os.replace(self.path, '{}.1'.format(self.path))
+        else:
+            os.remove(self.path)
+        self._file = io.open(self.path, 'a', encoding='utf-8')
+
+
+class AuditLog(object):
+    """Queue audit events, and write them in batches to a sink from a background thread
+
+    The writer thread is started on the first recorded event, and restarted
+    if the process was forked since it was started.
+    """
+
+    def __init__(self, sink, queue_size=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL):
+        # type: (AuditSink, int, int, float) -> None
+        self._sink = sink
+        self._queue = queue.Queue(queue_size)  # type: queue.Queue
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._thread = None  # type: Optional[threading.Thread]
+        self._pid = None  # type: Optional[int]
+        self._stats = {"recorded": 0, "dropped": 0, "written": 0, "failed": 0, "batches": 0}
+
+    def record(self, event):
+        # type: (Dict[str, Any]) -> bool
+        """Queue an event to be written, returning `False` if it was dropped because the queue is full
+        """
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._count('dropped')
+            return False
+        self._count('recorded')
+        return True
+
+    def flush(self):
+        # type: () -> None
+        """Wait until all queued events have been handed to the sink
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        # type: () -> None
+        """Write all queued events, stop the writer thread and close the sink
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive() and self._pid == os.getpid():
+            self._queue.put(_STOP)
+            thread.join()
+        self._sink.close()
+
+    def stats(self):
+        # type: () -> Dict[str, int]
+        """Get event counters: `recorded`, `dropped` (queue full), `written`, `failed` (sink errors) and `batches`
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        return stats
+
+    def _count(self, counter, value=1):
+        # type: (str, int) -> None
+        with self._lock:
+            self._stats[counter] += value
+
+    def _ensure_writer(self):
+        # type: () -> None
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='authz-audit-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        # type: () -> None
+        while True:
+            batch = self._next_batch()
+            stop = _STOP in batch
+            events = [e for e in batch if e is not _STOP]
+            if events:
+                self._write(events)
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _next_batch(self):
+        # type: () -> List[Any]
+        """Wait for an event, then get up to `batch_size` events without waiting
+        """
+        batch = []  # type: List[Any]
+        try:
+            batch.append(self._queue.get(timeout=self._flush_interval))
+            while len(batch) < self._batch_size and batch[-1] is not _STOP:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _write(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        try:
+            self._sink.write(events)
+        except Exception:
+            self._count('failed', len(events))
+        else:
+            self._count('written', len(events))
+            self._count('batches')
+
+
+def get_audit_log():
+    # type: () -> Optional[AuditLog]
+    """Get the shared audit log, or `None` if audit logging is disabled
+    """
+    global _audit_log
+    if _audit_log is None and util.get_config_bool('audit_log', False):
+        _audit_log = AuditLog(_create_sink(util.get_config('audit_log_sink', 'file')),
+                              queue_size=util.get_config_int('audit_log_queue_size', DEFAULT_QUEUE_SIZE),
+                              batch_size=util.get_config_int('audit_log_batch_size', DEFAULT_BATCH_SIZE),
+                              flush_interval=float(util.get_config('audit_log_flush_interval',
+                                                                   DEFAULT_FLUSH_INTERVAL)))
+    return _audit_log
+
+
+def record(event):
+    # type: (Dict[str, Any]) -> None
+    """Record an audit event, if audit logging is enabled
+    """
+    audit_log = get_audit_log()
+    if audit_log is not None:
+        audit_log.record(event)
+
+
+def reset_audit_log():
+    # type: () -> None
+    """Close and discard the shared audit log
+    """
+    global _audit_log
+    audit_log, _audit_log = _audit_log, None
+    if audit_log is not None:
+        audit_log.close()
+
+
+def _create_sink(sink_type):
+    # type: (str) -> AuditSink
+    """Create an audit sink instance
+    """
+    if sink_type == 'file':
+        path = util.get_config('audit_log_file')
+        if not path:
+            raise ValueError("ckanext.authz_service.audit_log_file must be set to use the file audit sink")
+        return JsonLinesFileSink(path,
+                                 max_bytes=util.get_config_int('audit_log_max_bytes', DEFAULT_MAX_BYTES),
+                                 backup_count=util.get_config_int('audit_log_backup_count', DEFAULT_BACKUP_COUNT))
+    elif ':' in sink_type:
+        module_name, factory_name = sink_type.split(':', 1)
+        return getattr(importlib.import_module(module_name), factory_name)()
+
+    raise ValueError("Unknown audit sink type: {}".format(sink_type))
+
+
+atexit.register(reset_audit_log)
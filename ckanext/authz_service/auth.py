@@ -0,0 +1,19 @@
+"""CKAN authorization functions for actions provided by this extension
+"""
+
+
+def revoke(context, data_dict):
+    """Check if the user can revoke tokens
+
+    Anyone holding a valid token can revoke it, and users can revoke all tokens
+    issued to themselves. Revoking tokens by ID or tokens issued to other users
+    is only allowed to sysadmins.
+    """
+    if data_dict.get('jti'):
+        return {"success": False, "msg": "Only sysadmins can revoke tokens by ID"}
+
+    subject = data_dict.get('subject')
+    if subject and subject != context.get('user'):
+        return {"success": False, "msg": "Only sysadmins can revoke tokens issued to other users"}
+
+    return {"success": True}
@@ -1,9 +1,11 @@
-from typing import Dict, Optional, Set
+from typing import Any, Dict, Optional, Set, Tuple
 
-from ..authzzie import Authzzie
+from .. import util
+from ..authzzie import AuthorizerCallable, Authzzie, BatchAuthorizerCallable, RoleMatrix
 from . import dataset as ds
 from . import organization as org
 from . import resource as res
+from . import roles
 
 __all__ = ['default_authz_bindings']
 
@@ -12,23 +14,55 @@ def default_authz_bindings(authorizer):
     # type: (Authzzie) -> None
     """Initialize default authorization bindings for CKAN entities
     """
+    matrix = roles.get_default_role_matrix() if util.get_config_bool('role_matrix_authorizers', True) else None
 
     # Register organization authz bindings
     authorizer.register_scope_normalizer('org', org.normalize_org_scope)
-    authorizer.register_authorizer('org', org.check_org_permissions,
-                                   actions=_all_entity_actions(org.ORG_ENTITY_CHECKS))
+    _register_authorizer(authorizer, 'org', org.check_org_permissions, roles.get_org_role, matrix,
+                         actions=_all_entity_actions(org.ORG_ENTITY_CHECKS))
 
     # Register dataset authz bindings
     authorizer.register_entity_ref_parser('ds', ds.dataset_id_parser)
-    authorizer.register_authorizer('ds', ds.check_dataset_permissions,
-                                   actions=_all_entity_actions(ds.DS_ENTITY_CHECKS),
-                                   subscopes=(None, 'data', 'metadata'))
+    _register_authorizer(authorizer, 'ds', ds.check_dataset_permissions, roles.get_dataset_role, matrix,
+                         actions=_all_entity_actions(ds.DS_ENTITY_CHECKS),
+                         subscopes=(None, 'data', 'metadata'),
+                         batch_role_lookup=roles.get_dataset_roles)
 
     # Register resource authz bindings
     authorizer.register_entity_ref_parser('res', res.resource_id_parser)
-    authorizer.register_authorizer('res', res.check_resource_permissions,
-                                   actions=_all_entity_actions(res.RES_ENTITY_CHECKS),
-                                   subscopes=(None, 'data', 'metadata'))
+    _register_authorizer(authorizer, 'res', res.check_resource_permissions, roles.get_resource_role, matrix,
+                         actions=_all_entity_actions(res.RES_ENTITY_CHECKS),
+                         subscopes=(None, 'data', 'metadata'),
+                         batch_function=res.check_resource_permissions_many,
+                         batch_role_lookup=roles.get_resource_roles)
+
+
+def _register_authorizer(authorizer,  # type: Authzzie
+                         entity_type,  # type: str
+                         function,  # type: AuthorizerCallable
+                         role_lookup,  # type: Any
+                         matrix,  # type: Optional[RoleMatrix]
+                         actions,  # type: Set[Optional[str]]
+                         subscopes=(None,),  # type: Tuple
+                         batch_function=None,  # type: Optional[BatchAuthorizerCallable]
+                         batch_role_lookup=None,  # type: Any
+                         ):
+    # type: (...) -> None
+    """Register an entity type's authorizer, wrapped in a role matrix authorizer if a matrix is given
+
+    If given, `batch_function` and `batch_role_lookup` are used to evaluate
+    multi-reference scopes in a single batch.
+    """
+    for subscope in subscopes:
+        if matrix is not None:
+            check = matrix.authorizer(entity_type, role_lookup, subscope=subscope, fallback=function,
+                                      batch_role_lookup=batch_role_lookup, batch_fallback=batch_function)
+            authorizer.register_batch_authorizer(check, check.check_many)
+        else:
+            check = function
+            if batch_function is not None:
+                authorizer.register_batch_authorizer(check, batch_function)
+        authorizer.register_authorizer(entity_type, check, actions=actions, subscopes=subscope)
 
 
 def _all_entity_actions(entity_checks):
@@ -5,8 +5,13 @@ from ckan.authz import is_sysadmin, users_role_for_group_or_org
 from ckan.common import g
 from ckan.plugins import toolkit
 
+from .. import tracing
+
 OptionalCkanContext = Optional[Dict[str, Any]]
 
+# Context keys in which CKAN auth functions look for preloaded model objects
+ENTITY_CONTEXT_KEYS = ('package', 'resource', 'group')
+
 
 def normalize_id_part(id_part):
     # type: (str) -> Optional[str]
@@ -24,17 +29,37 @@ def check_entity_permissions(permission_checks, data_dict=None, context=None):
     return set(granted)
 
 
+def get_entity_context(context=None, **objects):
+    # type: (OptionalCkanContext, Any) -> Dict[str, Any]
+    """Get a copy of the CKAN context with preloaded model objects
+
+    CKAN auth functions use the model objects found in the context (as
+    `package`, `resource` or `group`) rather than loading them from the DB,
+    so passing them in allows all permission checks for an entity to share a
+    single load. As auth functions may also store objects they load in the
+    context, a separate copy must be used for each entity.
+    """
+    if context is None:
+        context = get_user_context()
+    context = {k: v for k, v in context.items() if k not in ENTITY_CONTEXT_KEYS}
+    context.update((k, v) for k, v in objects.items() if v is not None)
+    return context
+
+
 def ckan_auth_check(permission, data_dict=None, context=None):
     # type: (str, Dict[str, Any], OptionalCkanContext) -> bool
     """Wrapper for CKAN permission check
     """
     if context is None:
         context = get_user_context()
-    try:
-        toolkit.check_access(permission, context=context, data_dict=data_dict)
-    except (toolkit.NotAuthorized, toolkit.ObjectNotFound):
-        return False
-    return True
+    with tracing.span('ckan.check_access', {"ckan.auth_function": permission}) as span:
+        try:
+            toolkit.check_access(permission, context=context, data_dict=data_dict)
+            granted = True
+        except (toolkit.NotAuthorized, toolkit.ObjectNotFound):
+            granted = False
+        span.set_attribute('authz.granted', granted)
+    return granted
 
 
 def ckan_get_user_role_in_group(group_id, context=None):
@@ -50,9 +75,17 @@ def ckan_get_user_role_in_group(group_id, context=None):
 def ckan_is_sysadmin(context=None):
     # type: (OptionalCkanContext) -> bool
     """Tell if the current user is a CKAN sysadmin
+
+    The user object found in the context is used if it is the current user's,
+    to avoid loading it from the DB again.
     """
-    user = _get_username(context)
-    return is_sysadmin(user)
+    if context is None or 'user' not in context:
+        context = get_user_context()
+    user = context.get('user')
+    userobj = context.get('auth_user_obj')
+    if user and userobj is not None and user in (userobj.name, userobj.id):
+        return bool(userobj.sysadmin)
+    return bool(is_sysadmin(user))
 
 
 def _get_username(context=None):
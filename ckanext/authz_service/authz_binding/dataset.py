@@ -1,10 +1,11 @@
 from typing import Dict, Optional, Set
 
-from ckan.plugins import toolkit
+from ckan import model
 
-from . import common as c
 from .common import (OptionalCkanContext, check_entity_permissions, ckan_auth_check, ckan_get_user_role_in_group,
-                     ckan_is_sysadmin, normalize_id_part)
+                     ckan_is_sysadmin, get_entity_context, normalize_id_part)
+from .ownership import get_ownership_index
+from .snapshot import get_permission_snapshot
 
 DS_ENTITY_CHECKS = {"read": "package_show",
                     "list": None,
@@ -29,7 +30,7 @@ def check_dataset_permissions(id, organization_id=None, context=None):
         # If user can't see the dataset, we'll assume it exists but no permissions
         return set()
 
-    return check_entity_permissions(DS_ENTITY_CHECKS, {"id": id, "owner_org": organization_id}, context=context)
+    return _check_dataset_entity_permissions(id, context=context)
 
 
 def _check_dataset_permissions_unknown_org(id, organization_id, context=None):
@@ -48,13 +49,31 @@ def _check_dataset_permissions_unknown_org(id, organization_id, context=None):
         return set()
 
     # We got a dataset ID with no organization specified
-    return check_entity_permissions(DS_ENTITY_CHECKS, {"id": id}, context=context)
+    return _check_dataset_entity_permissions(id, context=context)
+
+
+def _check_dataset_entity_permissions(id, context=None):
+    # type: (str, OptionalCkanContext) -> Set[str]
+    """Run permission checks for a specific dataset, loading it from the DB only once
+    """
+    package = get_package_object(id)
+    if package is None:
+        return set()
+
+    context = get_entity_context(context, package=package)
+    return check_entity_permissions(DS_ENTITY_CHECKS, {"id": package.id, "owner_org": package.owner_org},
+                                    context=context)
 
 
 def _check_dataset_permissions_unknown_ds(id, organization_id, context=None):
     # type: (Optional[str], str, OptionalCkanContext) -> Set[str]
     """Run dataset permissions checks when dataset ID is not known
     """
+    snapshot = get_permission_snapshot(context)
+    snapshot_actions = snapshot.get_org_dataset_actions(organization_id, id == '*') if snapshot else None
+    if snapshot_actions is not None:
+        return snapshot_actions
+
     granted = set()
     if ckan_auth_check('package_create', {"owner_org": organization_id}, context=context):
         granted.add('create')
@@ -71,7 +90,7 @@ def _check_dataset_permissions_unknown_ds(id, organization_id, context=None):
             granted.update({'update', 'patch'})
 
         if ckan_auth_check('organization_delete', {"id": organization_id}, context=context):
-            granted.update('delete')
+            granted.add('delete')
 
         # TODO: check `delete` and `purge` permissions
 
@@ -106,17 +125,23 @@ def dataset_id_parser(id):
             "id": normalize_id_part(parts[1])}
 
 
+def get_package_object(id):
+    # type: (str) -> Optional[model.Package]
+    """Load a dataset by ID or name
+
+    The ownership index is used to resolve names, so that the dataset is
+    loaded by primary key (and thus taken from the session if already loaded)
+    """
+    dataset = get_ownership_index().get_dataset(id)
+    if dataset is None:
+        return None
+    return model.Package.get(dataset.id)
+
+
 def _check_ds_in_org(id, organization_id, context=None):
     # type: (str, str, OptionalCkanContext) -> bool
-    """Check that a dataset exists in the given organization and that it is readable
+    """Check that a dataset exists in the given organization
+
+    Whether the user can read the dataset is left to the entity permission checks
     """
-    if context is None:
-        context = c.get_user_context()
-    try:
-        ds = toolkit.get_action('package_show')(context, {"id": id})
-        if ds.get('owner_org') == organization_id or ds.get('organization', {}).get('name') == organization_id:
-            return True
-    except (toolkit.ObjectNotFound, toolkit.NotAuthorized):
-        pass
-
-    return False
+    return get_ownership_index().is_dataset_in_org(id, organization_id)
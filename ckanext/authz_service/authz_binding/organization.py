@@ -2,8 +2,11 @@
 """
 from typing import Set
 
+from ckan import model
+
 from ..authzzie import Scope
-from .common import OptionalCkanContext, check_entity_permissions, ckan_auth_check, ckan_is_sysadmin
+from .common import OptionalCkanContext, check_entity_permissions, ckan_auth_check, ckan_is_sysadmin, get_entity_context
+from .snapshot import get_permission_snapshot
 
 ORG_ENTITY_CHECKS = {"read": "organization_show",
                      "list": None,
@@ -34,7 +37,15 @@ def check_org_permissions(id, context=None):
         if ckan_auth_check('organization_create', context=context):
             granted.add('create')
     else:
-        granted.update(check_entity_permissions(ORG_ENTITY_CHECKS, {"id": id}))
+        snapshot = get_permission_snapshot(context)
+        snapshot_actions = snapshot.get_org_actions(id) if snapshot else None
+        if snapshot_actions is not None:
+            return snapshot_actions
+
+        group = model.Group.get(id)
+        if group is not None:
+            granted.update(check_entity_permissions(ORG_ENTITY_CHECKS, {"id": group.id},
+                                                    context=get_entity_context(context, group=group)))
 
     return granted
 
@@ -0,0 +1,264 @@
+"""Per-transaction entity ownership index
+
+Authorization bindings often need to check that entities are contained in
+each other, e.g. that a dataset is owned by an organization or that a
+resource belongs to a dataset. Rather than calling `package_show` (which
+loads and dictizes the entire dataset, including all its resources) for each
+such check, ownership information is loaded into a compact index:
+
+* resource ID -> dataset ID, for active resources
+* dataset ID / name -> dataset ID, name, owner org ID / name, private flag
+  and state
+
+Entries are loaded lazily, one entity at a time, using direct model queries;
+Entries for multiple entities can also be loaded at once, e.g. when
+evaluating multi-reference scopes.
+
+Entries are kept in the current DB session, and only for the duration of the
+current transaction: they are discarded once it is committed or rolled back
+(and thus at the end of each request), and when the plugin's
+`IPackageController` and `IResourceController` hooks report changes. As
+entities can be changed through any worker process, ownership information is
+never kept across transactions, so that authorization decisions are always
+based on the current owner and state of entities.
+"""
+from collections import namedtuple
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from ckan import model
+from sqlalchemy import event
+
+DatasetOwnership = namedtuple('DatasetOwnership', ['id', 'name', 'owner_org', 'org_name', 'private',
+                                                   'state'])
+
+# Key in SQLAlchemy's `Session.info` holding the entries loaded in the current transaction
+_ENTRIES_KEY = 'authz_service_ownership'
+
+_index = None  # type: Optional[OwnershipIndex]
+
+_listening = False
+
+
+class OwnershipIndex(object):
+    """Index of dataset and resource ownership, loaded once per DB transaction
+    """
+
+    def __init__(self):
+        # type: () -> None
+        self._stats = {"datasets": {"hits": 0, "misses": 0},
+                       "resources": {"hits": 0, "misses": 0}}
+
+    def get_dataset(self, id_or_name):
+        # type: (str) -> Optional[DatasetOwnership]
+        """Get ownership information for a dataset by ID or name, or `None` if it does not exist
+        """
+        datasets = self._get_entries('datasets')
+        if id_or_name not in datasets:
+            self._stats['datasets']['misses'] += 1
+            dataset = _query_dataset(id_or_name)
+            datasets[id_or_name] = dataset
+            if dataset is not None:
+                datasets[dataset.id] = dataset
+                datasets[dataset.name] = dataset
+            return dataset
+        self._stats['datasets']['hits'] += 1
+        return datasets[id_or_name]
+
+    def get_resource_dataset_id(self, resource_id):
+        # type: (str) -> Optional[str]
+        """Get the ID of the dataset an active resource belongs to, or `None` if it does not exist
+        """
+        resources = self._get_entries('resources')
+        if resource_id not in resources:
+            self._stats['resources']['misses'] += 1
+            resources[resource_id] = _query_resource_dataset_id(resource_id)
+        else:
+            self._stats['resources']['hits'] += 1
+        return resources[resource_id]
+
+    def preload_datasets(self, ids_or_names):
+        # type: (Iterable[str]) -> None
+        """Load ownership information for multiple datasets specified by ID or name, using a single query
+        """
+        datasets = self._get_entries('datasets')
+        missing = {ref for ref in ids_or_names if ref not in datasets}
+        for dataset in _query_datasets(missing) if missing else ():
+            datasets[dataset.id] = dataset
+            datasets[dataset.name] = dataset
+        for ref in missing:
+            datasets.setdefault(ref, None)
+
+    def preload_resources(self, resource_ids):
+        # type: (Iterable[str]) -> None
+        """Load the IDs of the datasets multiple active resources belong to, using a single query
+        """
+        resources = self._get_entries('resources')
+        missing = {id for id in resource_ids if id not in resources}
+        for resource_id, dataset_id in _query_resource_dataset_ids(missing) if missing else ():
+            resources[resource_id] = dataset_id
+        for id in missing:
+            resources.setdefault(id, None)
+
+    def is_dataset_in_org(self, dataset_id, organization_id):
+        # type: (str, str) -> bool
+        """Check that a dataset, specified by ID or name, is owned by an organization specified by ID or name
+        """
+        dataset = self.get_dataset(dataset_id)
+        if dataset is None or dataset.owner_org is None:
+            return False
+        return organization_id in (dataset.owner_org, dataset.org_name)
+
+    def is_resource_in_dataset(self, resource_id, dataset_id):
+        # type: (str, str) -> bool
+        """Check that a resource belongs to a dataset, specified by ID or name
+        """
+        owner_id = self.get_resource_dataset_id(resource_id)
+        if owner_id is None:
+            return False
+        if owner_id == dataset_id:
+            return True
+        dataset = self.get_dataset(dataset_id)
+        return dataset is not None and dataset.id == owner_id
+
+    def invalidate_dataset(self, id, name=None):
+        # type: (str, Optional[str]) -> None
+        """Remove a dataset from the index
+        """
+        datasets = self._get_entries('datasets')
+        dataset = datasets.pop(id, None)
+        if dataset is not None:
+            datasets.pop(dataset.name, None)
+        if name:
+            datasets.pop(name, None)
+
+    def invalidate_resource(self, id):
+        # type: (str) -> None
+        """Remove a resource from the index
+        """
+        self._get_entries('resources').pop(id, None)
+
+    def invalidate(self, data):
+        # type: (Union[Dict[str, Any], List[Dict[str, Any]]]) -> None
+        """Remove the entities described by a dataset or resource dict, or a list of them, from the index
+
+        This accepts whatever CKAN passes to the `IPackageController` and
+        `IResourceController` "after" hooks.
+        """
+        if isinstance(data, list):
+            for item in data:
+                self.invalidate(item)
+            return
+
+        if not isinstance(data, dict) or not data.get('id'):
+            return
+
+        if 'package_id' in data and 'owner_org' not in data:
+            self.invalidate_resource(data['id'])
+            self.invalidate_dataset(data['package_id'])
+        else:
+            self.invalidate_dataset(data['id'], data.get('name'))
+            self.invalidate(data.get('resources', []))
+
+    def stats(self):
+        # type: () -> Dict[str, Dict[str, Any]]
+        """Get the number of hits and misses for datasets and resources (which are counted approximately)
+        """
+        stats = {}  # type: Dict[str, Dict[str, Any]]
+        for entity_type, counts in self._stats.items():
+            lookups = counts['hits'] + counts['misses']
+            stats[entity_type] = dict(counts, hit_rate=float(counts['hits']) / lookups if lookups else None)
+        return stats
+
+    def clear(self):
+        # type: () -> None
+        """Remove all entries loaded in the current transaction from the index
+        """
+        _discard_entries(model.Session())
+
+    @staticmethod
+    def _get_entries(entity_type):
+        # type: (str) -> Dict[str, Any]
+        """Get the entries of an entity type loaded in the current transaction
+        """
+        _listen_for_transaction_end()
+        entries = model.Session().info.setdefault(_ENTRIES_KEY, {"datasets": {}, "resources": {}})
+        return entries[entity_type]
+
+
+def get_ownership_index():
+    # type: () -> OwnershipIndex
+    """Get the shared ownership index
+    """
+    global _index
+    if _index is None:
+        _index = OwnershipIndex()
+    return _index
+
+
+def reset_ownership_index():
+    # type: () -> None
+    """Discard the shared ownership index
+    """
+    global _index
+    _index = None
+
+
+def _listen_for_transaction_end():
+    # type: () -> None
+    """Register SQLAlchemy event listeners discarding index entries when transactions end, if not already registered
+    """
+    global _listening
+    if _listening:
+        return
+    event.listen(model.Session, 'after_commit', _discard_entries)
+    event.listen(model.Session, 'after_rollback', _discard_entries)
+    _listening = True
+
+
+def _discard_entries(session):
+    session.info.pop(_ENTRIES_KEY, None)
+
+
+def _query_dataset(id_or_name):
+    # type: (str) -> Optional[DatasetOwnership]
+    """Load dataset ownership information from the DB
+    """
+    row = model.Session.query(model.Package.id, model.Package.name, model.Package.owner_org,
+                              model.Group.name, model.Package.private, model.Package.state) \
+        .outerjoin(model.Group, model.Group.id == model.Package.owner_org) \
+        .filter((model.Package.id == id_or_name) | (model.Package.name == id_or_name)) \
+        .first()
+    if row is None:
+        return None
+    return DatasetOwnership(*row)
+
+
+def _query_datasets(ids_or_names):
+    # type: (Set[str]) -> List[DatasetOwnership]
+    """Load ownership information for multiple datasets from the DB
+    """
+    rows = model.Session.query(model.Package.id, model.Package.name, model.Package.owner_org,
+                               model.Group.name, model.Package.private, model.Package.state) \
+        .outerjoin(model.Group, model.Group.id == model.Package.owner_org) \
+        .filter(model.Package.id.in_(ids_or_names) | model.Package.name.in_(ids_or_names)) \
+        .all()
+    return [DatasetOwnership(*row) for row in rows]
+
+
+def _query_resource_dataset_id(resource_id):
+    # type: (str) -> Optional[str]
+    """Load the ID of the dataset owning an active resource from the DB
+    """
+    row = model.Session.query(model.Resource.package_id) \
+        .filter(model.Resource.id == resource_id, model.Resource.state == 'active') \
+        .first()
+    return row[0] if row else None
+
+
+def _query_resource_dataset_ids(resource_ids):
+    # type: (Set[str]) -> List[Tuple[str, str]]
+    """Load the IDs of the datasets owning multiple active resources from the DB
+    """
+    return model.Session.query(model.Resource.id, model.Resource.package_id) \
+        .filter(model.Resource.id.in_(resource_ids), model.Resource.state == 'active') \
+        .all()
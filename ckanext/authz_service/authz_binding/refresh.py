@@ -0,0 +1,140 @@
+"""Change tracking for token refresh
+
+When token refresh is enabled, tokens carry an authorization state claim,
+recording when their scopes were evaluated, the membership change counter
+(see `snapshot`) at that time, and whether the user was a sysadmin. When a
+token is refreshed, each of its granted scopes is reused without calling any
+authorizer if nothing it depends on changed since it was evaluated:
+
+* The user's sysadmin flag, and all organization memberships, collaborators
+  and organizations, tracked by the membership change counter. These are all
+  that organization scopes, and dataset and resource scopes not referring to
+  a specific dataset, depend on.
+* For dataset and resource scopes referring to a specific dataset, the
+  dataset's `metadata_modified` timestamp, which CKAN updates whenever the
+  dataset or any of its resources are changed, and its state.
+
+Scopes of other entity types are always re-evaluated. To account for changes
+not tracked by the membership change counter (e.g. changes made by other
+processes when using the `memory` cache backend), scopes are re-evaluated
+anyway once a configurable time has passed since they were first evaluated.
+"""
+import calendar
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from ckan import model
+
+from .. import util
+from ..authzzie import Scope
+from .common import OptionalCkanContext, ckan_is_sysadmin
+from .dataset import dataset_id_parser
+from .ownership import get_ownership_index
+from .resource import resource_id_parser
+from .snapshot import get_membership_version
+
+STATE_CLAIM = 'authz_state'
+
+DEFAULT_MAX_REUSE_AGE = 3600
+
+# Entity types for which the state granted scopes depend on is tracked
+TRACKED_ENTITY_TYPES = ('org', 'ds', 'res')
+
+
+def get_authorization_state(context):
+    # type: (OptionalCkanContext) -> Dict[str, Any]
+    """Get the current authorization state, to be stored in a token's state claim
+
+    This should be called before scopes are evaluated, so that changes made
+    while they are evaluated are not missed. `at` is the time scopes were
+    first evaluated, and should be carried over when scopes are reused.
+    """
+    now = time.time()
+    return {"t": now,
+            "at": int(now),
+            "mv": get_membership_version(),
+            "sa": ckan_is_sysadmin(context=context)}
+
+
+def split_stale_scopes(scopes, state, context):
+    # type: (Iterable[Scope], Optional[Dict[str, Any]], OptionalCkanContext) -> Tuple[List[Scope], List[Scope]]
+    """Split scopes granted with a given authorization state into (reusable, stale) scopes
+    """
+    scopes = list(scopes)
+    if not _is_state_reusable(state, context):
+        return [], scopes
+
+    dataset_refs = {scope: _get_dataset_refs(scope) for scope in scopes if scope.entity_type in TRACKED_ENTITY_TYPES}
+    changed = _get_changed_datasets(set().union(*dataset_refs.values()), state['t'])
+
+    reusable, stale = [], []
+    for scope in scopes:
+        if scope in dataset_refs and not dataset_refs[scope].intersection(changed):
+            reusable.append(scope)
+        else:
+            stale.append(scope)
+    return reusable, stale
+
+
+def _is_state_reusable(state, context):
+    # type: (Optional[Dict[str, Any]], OptionalCkanContext) -> bool
+    """Check that memberships and the user's sysadmin flag did not change since the state was recorded
+    """
+    if not isinstance(state, dict) or not {'t', 'at', 'mv', 'sa'}.issubset(state):
+        return False
+    if time.time() - state['at'] > util.get_config_int('refresh_max_reuse_age', DEFAULT_MAX_REUSE_AGE):
+        return False
+    return state['mv'] == get_membership_version() and state['sa'] == ckan_is_sysadmin(context=context)
+
+
+def _get_dataset_refs(scope):
+    # type: (Scope) -> Set[str]
+    """Get the IDs or names of the specific datasets the entities a scope refers to belong to, if any
+    """
+    dataset_refs = (_get_dataset_ref(scope.entity_type, entity_ref) for entity_ref in scope.entity_refs)
+    return {dataset_ref for dataset_ref in dataset_refs if dataset_ref}
+
+
+def _get_dataset_ref(entity_type, entity_ref):
+    # type: (str, Optional[str]) -> Optional[str]
+    """Get the ID or name of the specific dataset an entity reference refers to, if any
+    """
+    if not entity_ref or entity_type == 'org':
+        return None
+
+    if entity_type == 'ds':
+        dataset_ref = dataset_id_parser(entity_ref).get('id')
+    else:
+        ref = resource_id_parser(entity_ref)
+        dataset_ref = ref.get('dataset_id')
+        if not dataset_ref and ref['id'] and ref['id'] != '*':
+            dataset_ref = get_ownership_index().get_resource_dataset_id(ref['id']) or ref['id']
+
+    return dataset_ref if dataset_ref and dataset_ref != '*' else None
+
+
+def _get_changed_datasets(dataset_refs, since):
+    # type: (Set[str], float) -> Set[str]
+    """Get the IDs or names of datasets that were changed at or after a given time, are not active or do not exist
+    """
+    if not dataset_refs:
+        return set()
+
+    rows = model.Session.query(model.Package.id, model.Package.name, model.Package.state,
+                               model.Package.metadata_modified) \
+        .filter(model.Package.id.in_(dataset_refs) | model.Package.name.in_(dataset_refs)) \
+        .all()
+
+    unchanged = set()
+    for id, name, state, modified in rows:
+        if state == 'active' and modified is not None and _to_timestamp(modified) < since:
+            unchanged.update((id, name))
+
+    return dataset_refs - unchanged
+
+
+def _to_timestamp(utc_datetime):
+    # type: (Any) -> float
+    """Convert a naive UTC datetime to a UNIX timestamp
+    """
+    return calendar.timegm(utc_datetime.utctimetuple()) + utc_datetime.microsecond / 1e6
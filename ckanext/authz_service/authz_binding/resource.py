@@ -1,9 +1,10 @@
-from typing import Dict, Optional
+from typing import Any, Dict, List, Optional, Set, Tuple
 
-from ckan.plugins import toolkit
+from ckan import model
 
-from .common import OptionalCkanContext, check_entity_permissions, get_user_context, normalize_id_part
+from .common import OptionalCkanContext, check_entity_permissions, get_entity_context, normalize_id_part
 from .dataset import check_dataset_permissions
+from .ownership import get_ownership_index
 
 RES_ENTITY_CHECKS = {"read": "resource_show",
                      "create": None,
@@ -25,7 +26,58 @@ def check_resource_permissions(id, dataset_id=None, organization_id=None, contex
     if not _check_resource_in_dataset(id, dataset_id, context=context):
         return set()
 
-    return check_entity_permissions(RES_ENTITY_CHECKS, {"id": id}, context=context)
+    # Deleted resources are kept in the DB
+    resource = model.Resource.get(id)
+    if resource is None or resource.state != 'active':
+        return set()
+
+    context = get_entity_context(context, resource=resource, package=model.Package.get(resource.package_id))
+    return check_entity_permissions(RES_ENTITY_CHECKS, {"id": resource.id}, context=context)
+
+
+def check_resource_permissions_many(entity_refs, context=None, **kwargs):
+    # type: (List[Dict[str, Any]], OptionalCkanContext, Any) -> List[Set[str]]
+    """Check what permissions a user has on each of a list of resources, specified by their parsed references
+
+    Resources, and the datasets owning them, are loaded only once for all
+    references, and dataset permissions are checked once per dataset.
+    """
+    resource_ids = {ref['id'] for ref in entity_refs
+                    if ref.get('id') not in {None, '*'} and ref.get('dataset_id') is not None}
+    get_ownership_index().preload_resources(resource_ids)
+    resources = {}  # type: Dict[str, model.Resource]
+    if resource_ids:
+        resources = {r.id: r for r in model.Session.query(model.Resource)
+                     .filter(model.Resource.id.in_(resource_ids), model.Resource.state == 'active')}
+
+    dataset_permissions = {}  # type: Dict[Tuple[str, Optional[str]], Set[str]]
+    packages = {}  # type: Dict[str, Optional[model.Package]]
+    results = []
+    for ref in entity_refs:
+        id, dataset_id, organization_id = ref.get('id'), ref.get('dataset_id'), ref.get('organization_id')
+        if dataset_id is None:
+            results.append(set())
+            continue
+
+        if (dataset_id, organization_id) not in dataset_permissions:
+            dataset_permissions[(dataset_id, organization_id)] = check_dataset_permissions(
+                id=dataset_id, organization_id=organization_id, context=context)
+        granted = dataset_permissions[(dataset_id, organization_id)]
+        if id == '*' or id is None:
+            results.append(granted.intersection(set(RES_ENTITY_CHECKS.keys())))
+            continue
+
+        resource = resources.get(id)
+        if resource is None or not _check_resource_in_dataset(id, dataset_id, context=context):
+            results.append(set())
+            continue
+
+        if resource.package_id not in packages:
+            packages[resource.package_id] = model.Package.get(resource.package_id)
+        entity_context = get_entity_context(context, resource=resource, package=packages[resource.package_id])
+        results.append(check_entity_permissions(RES_ENTITY_CHECKS, {"id": resource.id}, context=entity_context))
+
+    return results
 
 
 def resource_id_parser(id):
@@ -73,14 +125,4 @@ def _check_resource_in_dataset(resource_id, dataset_id, context=None):
     # type: (str, str, OptionalCkanContext) -> bool
     """Check that a resource exists in the dataset
     """
-    if context is None:
-        context = get_user_context()
-    try:
-        ds = toolkit.get_action('package_show')(context, {"id": dataset_id})
-        for resource in ds['resources']:
-            if resource['id'] == resource_id:
-                return True
-    except (toolkit.ObjectNotFound, toolkit.NotAuthorized):
-        pass
-
-    return False
+    return get_ownership_index().is_resource_in_dataset(resource_id, dataset_id)
@@ -0,0 +1,171 @@
+"""Role matrix authorization bindings
+
+For most organizations, datasets and resources, the actions a user can
+perform follow directly from their role (capacity) in the owning
+organization. Rather than calling a CKAN auth function for each action, the
+role matrix authorizers look up the user's role once (from the user's
+permission snapshot if enabled, or with a single query otherwise), and take
+the granted actions from a `RoleMatrix`.
+
+The default matrix is derived from CKAN's role permissions, the same way
+CKAN's core auth functions use them. Whenever the actions can not be derived
+from a role alone - for sysadmins, users who are not members of the owning
+organization, inactive datasets, wildcard references and when dataset
+collaborators are enabled - the regular, auth function based authorizers are
+used instead. Role matrix authorizers should be disabled if other extensions
+override the organization, dataset or resource auth functions.
+
+Roles for multiple datasets or resources (as referred to by multi-reference
+scopes) are looked up in a batch: all entities are loaded into the ownership
+index at once, and the user's role is looked up once per organization.
+
+A dataset's owning organization and state are taken from the ownership
+index, which only keeps entries loaded in the current DB transaction (see
+`ownership`), so a dataset moved to another organization or deleted by any
+worker process is never granted actions based on a role in its previous
+organization.
+"""
+from typing import Any, Dict, List, Optional
+
+from ckan import authz, model
+
+from ..authzzie import RoleMatrix
+from .common import OptionalCkanContext, _get_username, ckan_is_sysadmin
+from .ownership import get_ownership_index
+from .snapshot import _role_has_permission, get_permission_snapshot
+
+# CKAN role permission required for each action, per entity type
+ENTITY_ACTION_PERMISSIONS = {
+    "org": {"read": "read",
+            "update": "update",
+            "patch": "update",
+            "delete": "delete"},
+    # `package_delete` defers to `package_update`, as do all resource auth functions
+    "ds": {"read": "read",
+           "update": "update_dataset",
+           "patch": "update_dataset",
+           "delete": "update_dataset"},
+    "res": {"read": "read",
+            "update": "update_dataset",
+            "delete": "update_dataset"},
+}
+
+
+def get_default_role_matrix():
+    # type: () -> RoleMatrix
+    """Build a role matrix from CKAN's role permissions
+    """
+    matrix = RoleMatrix()
+    for role in authz.ROLE_PERMISSIONS:
+        for entity_type, permissions in ENTITY_ACTION_PERMISSIONS.items():
+            matrix.grant(role, entity_type, [action for action, permission in permissions.items()
+                                             if _role_has_permission(role, permission)])
+    return matrix
+
+
+def get_org_role(id, context=None, **kwargs):
+    # type: (Optional[str], OptionalCkanContext, Any) -> Optional[str]
+    """Get the user's role in a specific organization
+    """
+    if id in {None, '*'} or ckan_is_sysadmin(context=context):
+        return None
+    return _get_user_role(id, context)
+
+
+def get_dataset_role(id, organization_id=None, context=None, **kwargs):
+    # type: (Optional[str], Optional[str], OptionalCkanContext, Any) -> Optional[str]
+    """Get the user's role in the organization owning a specific, active dataset
+    """
+    return _get_dataset_role(id, organization_id, context)
+
+
+def get_dataset_roles(entity_refs, context=None, **kwargs):
+    # type: (List[Dict[str, Any]], OptionalCkanContext, Any) -> List[Optional[str]]
+    """Get the user's role for each of a list of parsed dataset references, as `get_dataset_role` does
+    """
+    get_ownership_index().preload_datasets(ref['id'] for ref in entity_refs if ref.get('id') not in {None, '*'})
+    org_roles = {}  # type: Dict[str, Optional[str]]
+    return [_get_dataset_role(ref.get('id'), ref.get('organization_id'), context, org_roles) for ref in entity_refs]
+
+
+def get_resource_role(id, dataset_id=None, organization_id=None, context=None, **kwargs):
+    # type: (Optional[str], Optional[str], Optional[str], OptionalCkanContext, Any) -> Optional[str]
+    """Get the user's role in the organization owning a specific resource's dataset
+
+    Resource wildcard references are resolved to the dataset's role, as
+    permissions on all resources of a dataset are taken from the dataset.
+    """
+    if dataset_id in {None, '*'}:
+        return None
+    if id not in {None, '*'} and not get_ownership_index().is_resource_in_dataset(id, dataset_id):
+        return None
+    return get_dataset_role(dataset_id, organization_id, context=context)
+
+
+def get_resource_roles(entity_refs, context=None, **kwargs):
+    # type: (List[Dict[str, Any]], OptionalCkanContext, Any) -> List[Optional[str]]
+    """Get the user's role for each of a list of parsed resource references, as `get_resource_role` does
+    """
+    index = get_ownership_index()
+    index.preload_resources(ref['id'] for ref in entity_refs if ref.get('id') not in {None, '*'})
+    index.preload_datasets(ref['dataset_id'] for ref in entity_refs if ref.get('dataset_id') not in {None, '*'})
+
+    org_roles = {}  # type: Dict[str, Optional[str]]
+    roles = []
+    for ref in entity_refs:
+        id, dataset_id = ref.get('id'), ref.get('dataset_id')
+        if dataset_id in {None, '*'} or (id not in {None, '*'} and not index.is_resource_in_dataset(id, dataset_id)):
+            roles.append(None)
+        else:
+            roles.append(_get_dataset_role(dataset_id, ref.get('organization_id'), context, org_roles))
+    return roles
+
+
+def _get_dataset_role(id, organization_id, context, org_roles=None):
+    # type: (Optional[str], Optional[str], OptionalCkanContext, Optional[Dict[str, Optional[str]]]) -> Optional[str]
+    """Get the user's role in the organization owning a specific, active dataset
+
+    If provided, `org_roles` is used to remember the user's role in each
+    organization, so it is only looked up once for multiple datasets.
+    """
+    if id in {None, '*'} or organization_id == '*':
+        return None
+
+    dataset = get_ownership_index().get_dataset(id)
+    if dataset is None or dataset.owner_org is None or dataset.state != 'active':
+        return None
+    if organization_id is not None and organization_id not in (dataset.owner_org, dataset.org_name):
+        return None
+    if authz.check_config_permission('allow_dataset_collaborators') or ckan_is_sysadmin(context=context):
+        return None
+
+    if org_roles is None:
+        return _get_user_role(dataset.owner_org, context)
+    if dataset.owner_org not in org_roles:
+        org_roles[dataset.owner_org] = _get_user_role(dataset.owner_org, context)
+    return org_roles[dataset.owner_org]
+
+
+def _get_user_role(org_ref, context):
+    # type: (str, OptionalCkanContext) -> Optional[str]
+    """Get the user's role in an active organization, specified by ID or name
+    """
+    username = _get_username(context)
+    if not username:
+        return None
+
+    snapshot = get_permission_snapshot(context)
+    if snapshot is not None:
+        return snapshot.get_role(org_ref)
+
+    row = model.Session.query(model.Member.capacity) \
+        .join(model.Group, model.Group.id == model.Member.group_id) \
+        .join(model.User, model.User.id == model.Member.table_id) \
+        .filter((model.Group.id == org_ref) | (model.Group.name == org_ref),
+                model.User.name == username,
+                model.Member.table_name == 'user',
+                model.Member.state == 'active',
+                model.Group.is_organization.is_(True),
+                model.Group.state == 'active') \
+        .first()
+    return row[0] if row else None
@@ -0,0 +1,262 @@
+"""Materialized per-user permission snapshots
+
+Permissions derived from a user's organization memberships are otherwise
+computed by running CKAN auth functions, which query membership tables, on
+every request. When enabled, a snapshot of the user's memberships and the
+actions they grant is built in a single pass and stored in a cache backend
+(see `cache`), and is used instead for as long as it is valid.
+
+A snapshot maps each active organization the user is a member of to the
+user's role, and to the actions granted on the organization itself (`org`
+scopes), on all of its datasets (`ds:<org>/*` scopes) and on its datasets in
+general (`ds:<org>/` scopes). Actions are derived from roles using CKAN's
+role permissions, the same way CKAN's core auth functions do; Snapshots
+should not be enabled if other plugins override these auth functions.
+Snapshots are not used for sysadmins, who are granted all actions by CKAN
+regardless of their memberships.
+
+Snapshots are versioned by a membership change counter, kept in the same
+cache backend and incremented whenever organization memberships,
+collaborators or organizations are changed. A snapshot is only valid while
+the counter has not changed since it was built, and in addition expires after
+a configurable TTL to account for changes made outside of CKAN.
+
+The counter is only seen by all worker processes if the cache backend is
+shared between them (e.g. `mmap` or `redis`); With a per-process backend,
+changes made through one worker would go unnoticed by the others, so
+snapshots are not used, and an error is logged instead.
+"""
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from ckan import authz, model
+from sqlalchemy import event, orm
+
+from .. import cache, util
+from .common import OptionalCkanContext, _get_username, ckan_is_sysadmin
+
+CACHE_NAMESPACE = 'permissions'
+
+VERSION_KEY = 'membership_version'
+
+DEFAULT_TTL = 300
+
+# Key in SQLAlchemy's `Session.info` marking that memberships were changed in the current transaction
+_CHANGED_FLAG = 'authz_service_membership_changed'
+
+_listening = False
+
+_reported_unshared_backend = False
+
+log = logging.getLogger(__name__)
+
+
+class PermissionSnapshot(object):
+    """A user's materialized, membership derived permissions
+    """
+
+    def __init__(self, data):
+        # type: (Dict[str, Any]) -> None
+        self._orgs = data['orgs']
+        self._org_ids = {org['name']: org_id for org_id, org in self._orgs.items()}
+        self.version = data['version']
+
+    def get_role(self, org_ref):
+        # type: (str) -> Optional[str]
+        """Get the user's role in an organization specified by ID or name, if they are a member
+        """
+        org = self._get_org(org_ref)
+        return org['role'] if org else None
+
+    def get_org_actions(self, org_ref):
+        # type: (str) -> Optional[Set[str]]
+        """Get actions granted on an organization, or `None` if the user is not a member
+        """
+        org = self._get_org(org_ref)
+        return set(org['org']) if org else None
+
+    def get_org_dataset_actions(self, org_ref, all_datasets=True):
+        # type: (str, bool) -> Optional[Set[str]]
+        """Get actions granted on an organization's datasets, or `None` if the user is not a member
+
+        If `all_datasets` is `True`, these are the actions granted on all of
+        the organization's datasets; Otherwise, they are the actions granted
+        on the organization's datasets in general (e.g. `create` and `list`)
+        """
+        org = self._get_org(org_ref)
+        if org is None:
+            return None
+        return set(org['all_datasets' if all_datasets else 'datasets'])
+
+    def _get_org(self, org_ref):
+        # type: (str) -> Optional[Dict[str, Any]]
+        org_id = org_ref if org_ref in self._orgs else self._org_ids.get(org_ref)
+        return self._orgs.get(org_id) if org_id else None
+
+
+def get_permission_snapshot(context=None):
+    # type: (OptionalCkanContext) -> Optional[PermissionSnapshot]
+    """Get the current user's permission snapshot, building it if there is no valid one
+
+    Returns `None` if snapshots are disabled or can not be used with the
+    configured cache backend, or the user is anonymous or a sysadmin.
+    """
+    if not util.get_config_bool('permission_snapshots', False):
+        return None
+
+    backend = cache.get_backend(CACHE_NAMESPACE)
+    if not backend.shared:
+        _report_unshared_backend()
+        return None
+
+    username = _get_username(context)
+    if not username or ckan_is_sysadmin(context=context):
+        return None
+
+    key = 'user:{}'.format(username)
+    values = backend.get_many([key, VERSION_KEY])
+    version = values.get(VERSION_KEY, 0)
+    data = values.get(key)
+    if data is None or data['version'] != version:
+        data = build_snapshot_data(username, version)
+        backend.set(key, data, util.get_config_int('permission_snapshot_ttl', DEFAULT_TTL))
+
+    return PermissionSnapshot(data)
+
+
+def _report_unshared_backend():
+    # type: () -> None
+    """Log that snapshots are not used because of the cache backend, once per process
+    """
+    global _reported_unshared_backend
+    if _reported_unshared_backend:
+        return
+    log.error('Permission snapshots are enabled, but the configured cache backend (%s) is not shared between '
+              'worker processes; Permissions are checked live instead. Configure a shared backend such as mmap '
+              'or redis to use snapshots.', util.get_config('cache_backend', 'memory'))
+    _reported_unshared_backend = True
+
+
+def build_snapshot_data(username, version):
+    # type: (str, int) -> Dict[str, Any]
+    """Build a user's permission snapshot data from the DB
+    """
+    orgs = {}
+    for org_id, org_name, role in _query_memberships(username):
+        orgs[org_id] = {"name": org_name,
+                        "role": role,
+                        "org": _get_org_actions(role),
+                        "datasets": _get_dataset_actions(role, all_datasets=False),
+                        "all_datasets": _get_dataset_actions(role, all_datasets=True)}
+
+    return {"version": version,
+            "orgs": orgs}
+
+
+def get_membership_version():
+    # type: () -> int
+    """Get the current value of the membership change counter
+    """
+    return cache.get_backend(CACHE_NAMESPACE).get(VERSION_KEY) or 0
+
+
+def bump_membership_version():
+    # type: () -> int
+    """Invalidate all permission snapshots by incrementing the membership change counter
+    """
+    return cache.get_backend(CACHE_NAMESPACE).incr(VERSION_KEY)
+
+
+def listen_for_membership_changes():
+    # type: () -> None
+    """Register SQLAlchemy event listeners that invalidate permission snapshots on membership changes
+
+    Changes are tracked as they are flushed, and snapshots are invalidated
+    once the transaction is committed, so that a snapshot built concurrently
+    can not miss them.
+    """
+    global _listening
+    if _listening:
+        return
+
+    for entity in _get_tracked_entities():
+        for event_name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(entity, event_name, _on_entity_change)
+    event.listen(model.Session, 'after_commit', _on_commit)
+    event.listen(model.Session, 'after_rollback', _on_rollback)
+    _listening = True
+
+
+def _get_tracked_entities():
+    # type: () -> List[Any]
+    entities = [model.Member, model.Group]
+    if hasattr(model, 'PackageMember'):
+        entities.append(model.PackageMember)
+    return entities
+
+
+def _on_entity_change(mapper, connection, target):
+    if isinstance(target, model.Member) and target.table_name != 'user':
+        return
+    if isinstance(target, model.Group) and not target.is_organization:
+        return
+    session = orm.object_session(target)
+    if session is not None:
+        session.info[_CHANGED_FLAG] = True
+
+
+def _on_commit(session):
+    if session.info.pop(_CHANGED_FLAG, False):
+        bump_membership_version()
+
+
+def _on_rollback(session):
+    session.info.pop(_CHANGED_FLAG, None)
+
+
+def _query_memberships(username):
+    # type: (str) -> Iterable[Any]
+    """Get the ID, name and user's role for all active organizations a user is a member of
+    """
+    return model.Session.query(model.Group.id, model.Group.name, model.Member.capacity) \
+        .join(model.Member, model.Member.group_id == model.Group.id) \
+        .join(model.User, model.User.id == model.Member.table_id) \
+        .filter(model.User.name == username,
+                model.Member.table_name == 'user',
+                model.Member.state == 'active',
+                model.Group.is_organization.is_(True),
+                model.Group.state == 'active') \
+        .all()
+
+
+def _role_has_permission(role, permission):
+    # type: (str, str) -> bool
+    return role in authz.get_roles_with_permission(permission)
+
+
+def _get_org_actions(role):
+    # type: (str) -> List[str]
+    """Get the actions a role grants on an active organization
+    """
+    actions = ['read']
+    if _role_has_permission(role, 'update'):
+        actions.extend(['update', 'patch'])
+    if _role_has_permission(role, 'delete'):
+        actions.append('delete')
+    return actions
+
+
+def _get_dataset_actions(role, all_datasets):
+    # type: (str, bool) -> List[str]
+    """Get the actions a role grants on an organization's datasets
+    """
+    actions = ['list']
+    if _role_has_permission(role, 'create_dataset'):
+        actions.append('create')
+    if all_datasets:
+        actions.append('read')
+        if _role_has_permission(role, 'update'):
+            actions.extend(['update', 'patch'])
+        if _role_has_permission(role, 'delete'):
+            actions.append('delete')
+    return actions
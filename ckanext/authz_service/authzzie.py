@@ -9,11 +9,17 @@ system is granted permission X, and if so grant them permission Y in a
 different system.
 """
 import copy
-from collections import Iterable, defaultdict
-from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+import re
+import time
+from collections import Iterable, OrderedDict, defaultdict
+from types import MappingProxyType
+from typing import Any, Callable, Dict, FrozenSet, Hashable, List, Optional, Set, Tuple, Union
 
 from typing_extensions import Protocol
 
+from . import tracing
+from .deadline import AUTHORIZER_TIMEOUT, CIRCUIT_OPEN, Deadline, Deferred
+
 
 class AuthorizerCallable(Protocol):
     """Type declaration for authentication check callable
@@ -23,11 +29,22 @@ class AuthorizerCallable(Protocol):
         raise NotImplementedError('You should not be instantiating this')
 
 
+BatchAuthorizerCallable = Callable[..., List[Set[str]]]
+
+RoleLookupCallable = Callable[..., Optional[str]]
+
+BatchRoleLookupCallable = Callable[..., List[Optional[str]]]
+
 IdParserCallable = Callable[[str], Dict[str, str]]
 
 ScopeNormalizerCallable = Callable[['Scope', 'Scope'], 'Scope']
 
 
+MultiRef = Tuple[str, List[str], str]
+
+_MULTI_REF_RE = re.compile(r'^([^{}]*){([^{}]*)}([^{}]*)$')
+
+
 class UnknownEntityType(ValueError):
     pass
 
@@ -67,6 +84,12 @@ class Scope(object):
     be specified, or simply omitted if no following parts are specified as
     well.
 
+    `entity_id` may also refer to multiple entities at once, by listing
+    alternatives for one of its parts in braces: `res:org/ds/{a,b,c}:read`
+    is equivalent to `res:org/ds/a:read res:org/ds/b:read res:org/ds/c:read`.
+    Such multi-reference scopes are evaluated as a single batch (see
+    `Authzzie.register_batch_authorizer`).
+
     Examples:
 
         `org:*:read` - denotes allowing the "read" action on all "org" type
@@ -83,6 +106,9 @@ class Scope(object):
 
         `file:*:meta:*` - denotes allowing all actions on the metadata of all
         file entities.
+
+        `file:{foo,bar}:read` - denotes allowing reading the 'foo' and 'bar'
+        files.
     """
 
     entity_type = None
@@ -132,7 +158,7 @@ class Scope(object):
             raise ValueError("Scope string should have at least 1 part")
         scope = cls(parts[0])
         if len(parts) > 1 and parts[1] != '*':
-            scope.entity_ref = parts[1]
+            scope.entity_ref = _normalize_entity_ref(parts[1])
         if len(parts) == 3 and parts[2] != '*':
             scope.actions = cls._parse_actions(parts[2])
         if len(parts) == 4:
@@ -143,6 +169,40 @@ class Scope(object):
 
         return scope
 
+    @property
+    def is_multi_ref(self):
+        # type: () -> bool
+        """Tell if this scope refers to multiple entities using the `{a,b,c}` syntax
+        """
+        return parse_multi_ref(self.entity_ref) is not None
+
+    @property
+    def entity_refs(self):
+        # type: () -> List[Optional[str]]
+        """Get the references of all entities this scope refers to
+
+        >>> Scope.from_string('res:org/ds/{b,a}:read').entity_refs
+        ['org/ds/a', 'org/ds/b']
+        """
+        multi_ref = parse_multi_ref(self.entity_ref)
+        if multi_ref is None:
+            return [self.entity_ref]
+        prefix, members, suffix = multi_ref
+        return [prefix + member + suffix for member in members]
+
+    def expand(self):
+        # type: () -> List[Scope]
+        """Get a single entity scope for each of the entities this scope refers to
+        """
+        if not self.is_multi_ref:
+            return [self]
+        expanded = []
+        for entity_ref in self.entity_refs:
+            scope = copy.copy(self)
+            scope.entity_ref = entity_ref
+            expanded.append(scope)
+        return expanded
+
     @classmethod
     def _parse_actions(cls, actions_str):
         # type: (str) -> Set[str]
@@ -150,6 +210,385 @@ class Scope(object):
             return set()
         return set(actions_str.split(','))
 
+    def covers(self, other):
+        # type: (Scope) -> bool
+        """Tell if this scope grants everything the other scope grants
+
+        A scope covers another scope of the same entity type if its entity
+        reference and subscope are either equal to the other scope's or are
+        wildcards, and if its actions are a superset of the other scope's
+        actions (or "any action").
+
+        >>> Scope.from_string('ds:*:read,update').covers(Scope.from_string('ds:foo:read'))
+        True
+
+        >>> Scope.from_string('ds:foo').covers(Scope.from_string('ds:foo:data:read'))
+        True
+
+        >>> Scope.from_string('ds:foo:read').covers(Scope.from_string('ds:foo'))
+        False
+
+        >>> Scope.from_string('ds:{foo,bar}:read').covers(Scope.from_string('ds:foo:read'))
+        True
+        """
+        if self.is_multi_ref or other.is_multi_ref:
+            covering = self.expand()
+            return all(any(scope.covers(member) for scope in covering) for member in other.expand())
+        if self.entity_type != other.entity_type:
+            return False
+        if not _is_wildcard(self.entity_ref) and self.entity_ref != other.entity_ref:
+            return False
+        if not _is_wildcard(self.subscope) and self.subscope != other.subscope:
+            return False
+        if _is_any_action(self.actions):
+            return True
+        if _is_any_action(other.actions):
+            return False
+        return set(other.actions).issubset(self.actions)
+
+
+class ScopeSet(object):
+    """An ordered set of requested scopes
+
+    Scopes are canonicalized and de-duplicated as they are added, so that the
+    set holds a single instance of each scope no matter how it was written
+    (e.g. `ds:foo:*:read` and `ds:foo:read` are the same scope).
+
+    In addition, the set can tell which of its scopes are "maximal" - that is
+    not covered by any other scope in the set referring to the same entity -
+    and which maximal scopes cover a given scope. This allows evaluating only
+    the maximal scopes of a set, and deriving results for all other scopes.
+
+    >>> scopes = ScopeSet(Scope.from_string(s) for s in ('ds:x:read', 'ds:x:read,update', 'ds:x:*:read', 'ds:y'))
+    >>> len(scopes)
+    3
+    >>> scopes.maximal()
+    [<Scope ds:x:read,update>, <Scope ds:y>]
+    >>> scopes.covering(Scope.from_string('ds:x:read'))
+    [<Scope ds:x:read,update>]
+    """
+
+    def __init__(self, scopes=None):
+        # type: (Optional[Iterable[Scope]]) -> None
+        self._scopes = OrderedDict()  # type: Dict[str, Scope]
+        self._entities = defaultdict(list)  # type: Dict[Tuple[str, Optional[str]], List[Scope]]
+        for scope in scopes or ():
+            self.add(scope)
+
+    def __iter__(self):
+        return iter(self._scopes.values())
+
+    def __len__(self):
+        return len(self._scopes)
+
+    def __contains__(self, scope):
+        return str(scope) in self._scopes
+
+    def add(self, scope):
+        # type: (Scope) -> Scope
+        """Add a scope to the set, returning the canonical instance of the scope
+        """
+        key = str(scope)
+        if key not in self._scopes:
+            self._scopes[key] = scope
+            self._entities[_entity_key(scope)].append(scope)
+        return self._scopes[key]
+
+    def get(self, scope):
+        # type: (Scope) -> Scope
+        """Get the canonical instance of a scope in this set
+        """
+        return self._scopes[str(scope)]
+
+    def maximal(self):
+        # type: () -> List[Scope]
+        """Get all scopes in the set which are not covered by another scope in the set
+        """
+        return [scope for scope in self if not self.covering(scope)]
+
+    def covering(self, scope):
+        # type: (Scope) -> List[Scope]
+        """Get all maximal scopes in the set, other than the scope itself, that cover a scope
+        """
+        key = str(scope)
+        covering = [other for other in self._entities[_entity_key(scope)]
+                    if str(other) != key and other.covers(scope)]
+        return [other for other in covering
+                if not any(c is not other and c.covers(other) for c in covering)]
+
+
+class ScopeMatcher(object):
+    """Compiled index of granted scopes, for answering permission queries
+
+    This is meant to be used by token consumers: the list of scopes granted
+    by a token is compiled once into a trie keyed by entity type, entity
+    reference and subscope, holding the granted actions. Checking whether an
+    action is granted on an entity then takes at most 4 dictionary lookups,
+    regardless of the number of granted scopes.
+
+    Wildcard semantics are identical to those of `Scope.covers`. Type and
+    action aliases, if provided (as `alias -> original` and
+    `(entity_type, subscope, alias) -> original` mappings respectively), are
+    resolved both when compiling scopes and when querying.
+
+    >>> matcher = ScopeMatcher.from_string('ds:foo:read,update ds:*:metadata:read org:bar')
+    >>> matcher.is_granted('ds', 'foo', 'update')
+    True
+    >>> matcher.is_granted('ds', 'baz', 'read', subscope='metadata')
+    True
+    >>> matcher.is_granted('ds', 'baz', 'read')
+    False
+    >>> matcher.check_many('org', ['bar', 'baz'], 'delete')
+    {'bar': True, 'baz': False}
+
+    Multi-reference scopes are compiled as if each entity was granted its own
+    scope.
+    """
+
+    def __init__(self, scopes, type_aliases=None, action_aliases=None):
+        # type: (Iterable[Scope], Optional[Dict[str, str]], Optional[Dict[Tuple[str, Optional[str], str], str]]) -> None
+        self._type_aliases = type_aliases or {}
+        self._action_aliases = action_aliases or {}
+        self._index = {}  # type: Dict[str, Dict[Optional[str], Dict[Optional[str], Optional[FrozenSet[str]]]]]
+        for scope in scopes:
+            self._add(scope)
+
+    @classmethod
+    def from_string(cls, scopes_str, **kwargs):
+        # type: (str, Any) -> ScopeMatcher
+        """Create a matcher from a space separated list of scopes, such as a token's `scopes` claim
+        """
+        return cls((Scope.from_string(s) for s in scopes_str.split(' ') if s), **kwargs)
+
+    def is_granted(self, entity_type, entity_ref=None, action=None, subscope=None):
+        # type: (str, Optional[str], Optional[str], Optional[str]) -> bool
+        """Tell if an action is granted on an entity
+
+        If `action` is not specified, will tell if *all* actions are granted
+        on the entity; If `entity_ref` is not specified, will tell if the
+        action is granted on all entities of the type.
+        """
+        entity_type = self._type_aliases.get(entity_type, entity_type)
+        entity_refs = self._index.get(entity_type)
+        if not entity_refs:
+            return False
+
+        action = self._get_original_action(entity_type, subscope, action)
+        entity_ref = None if _is_wildcard(entity_ref) else entity_ref
+        subscope = None if _is_wildcard(subscope) else subscope
+        return (self._match(entity_refs.get(entity_ref), subscope, action) or
+                (entity_ref is not None and self._match(entity_refs.get(None), subscope, action)))
+
+    def check_many(self, entity_type, entity_refs, action=None, subscope=None):
+        # type: (str, Iterable[str], Optional[str], Optional[str]) -> Dict[str, bool]
+        """Tell if an action is granted on each one of a list of entities
+
+        Returns a dict mapping each entity reference to a boolean.
+        """
+        if self.is_granted(entity_type, None, action, subscope):
+            # Granted on all entities of this type
+            return {ref: True for ref in entity_refs}
+        return {ref: self.is_granted(entity_type, ref, action, subscope) for ref in entity_refs}
+
+    def matches(self, scope):
+        # type: (Scope) -> bool
+        """Tell if a scope is covered by the compiled scopes
+
+        This means that all actions requested by the scope are granted, on
+        all entities it refers to
+        """
+        if scope.is_multi_ref:
+            return all(self.matches(entity_scope) for entity_scope in scope.expand())
+        if _is_any_action(scope.actions):
+            return self.is_granted(scope.entity_type, scope.entity_ref, None, scope.subscope)
+        return all(self.is_granted(scope.entity_type, scope.entity_ref, action, scope.subscope)
+                   for action in scope.actions)
+
+    def _add(self, scope):
+        # type: (Scope) -> None
+        if scope.is_multi_ref:
+            for entity_scope in scope.expand():
+                self._add(entity_scope)
+            return
+
+        entity_type = self._type_aliases.get(scope.entity_type, scope.entity_type)
+        entity_ref = None if _is_wildcard(scope.entity_ref) else scope.entity_ref
+        subscope = None if _is_wildcard(scope.subscope) else scope.subscope
+        subscopes = self._index.setdefault(entity_type, {}).setdefault(entity_ref, {})
+
+        if _is_any_action(scope.actions) or (subscope in subscopes and subscopes[subscope] is None):
+            subscopes[subscope] = None
+        else:
+            actions = frozenset(self._get_original_action(entity_type, subscope, a) for a in scope.actions)
+            subscopes[subscope] = actions.union(subscopes.get(subscope, ()))
+
+    def _get_original_action(self, entity_type, subscope, action):
+        # type: (str, Optional[str], Optional[str]) -> Optional[str]
+        if action is None or action == '*':
+            return None
+        return self._action_aliases.get((entity_type, subscope, action), action)
+
+    @staticmethod
+    def _match(subscopes, subscope, action):
+        # type: (Optional[Dict[Optional[str], Optional[FrozenSet[str]]]], Optional[str], Optional[str]) -> bool
+        if not subscopes:
+            return False
+        for key in (subscope, None) if subscope is not None else (None,):
+            if key not in subscopes:
+                continue
+            actions = subscopes[key]
+            if actions is None or (action is not None and action in actions):
+                return True
+        return False
+
+
+class RoleMatrix(object):
+    """Declarative table of the actions granted by each role
+
+    Actions are mapped to roles per entity type and subscope; Entries
+    registered for the `None` subscope apply to all subscopes of the entity
+    type that have no entries of their own. A matrix is turned into an
+    authorizer, which can be passed to `Authzzie.register_authorizer`, by
+    providing a role lookup function (see `RoleMatrixAuthorizer`).
+
+    >>> matrix = RoleMatrix()
+    >>> matrix.grant('member', 'org', {'read'})
+    >>> matrix.grant('editor', 'org', {'read', 'update'})
+    >>> matrix.grant('editor', 'org', {'read'}, subscope='members')
+    >>> sorted(matrix.get_actions('editor', 'org'))
+    ['read', 'update']
+    >>> sorted(matrix.get_actions('editor', 'org', 'members'))
+    ['read']
+    >>> matrix.get_actions('member', 'org', 'members') is None
+    True
+    >>> matrix.get_actions('admin', 'org') is None
+    True
+    """
+
+    def __init__(self):
+        # type: () -> None
+        self._grants = defaultdict(dict)  # type: Dict[Tuple[str, Optional[str]], Dict[str, FrozenSet[str]]]
+
+    def grant(self, role, entity_type, actions, subscope=None):
+        # type: (str, str, Iterable[str], Optional[str]) -> None
+        """Set the actions a role grants on an entity type and subscope
+        """
+        self._grants[(entity_type, subscope)][role] = frozenset(actions)
+
+    def get_actions(self, role, entity_type, subscope=None):
+        # type: (str, str, Optional[str]) -> Optional[FrozenSet[str]]
+        """Get the actions a role grants on an entity type and subscope, or `None` if the role is not in the table
+        """
+        grants = self._grants.get((entity_type, subscope))
+        if grants is None and subscope is not None:
+            grants = self._grants.get((entity_type, None))
+        return grants.get(role) if grants else None
+
+    def authorizer(self,
+                   entity_type,  # type: str
+                   role_lookup,  # type: RoleLookupCallable
+                   subscope=None,  # type: Optional[str]
+                   fallback=None,  # type: Optional[AuthorizerCallable]
+                   batch_role_lookup=None,  # type: Optional[BatchRoleLookupCallable]
+                   batch_fallback=None,  # type: Optional[BatchAuthorizerCallable]
+                   ):
+        # type: (...) -> RoleMatrixAuthorizer
+        """Get an authorizer granting actions from this table for an entity type and subscope
+        """
+        return RoleMatrixAuthorizer(self, entity_type, role_lookup, subscope, fallback, batch_role_lookup,
+                                    batch_fallback)
+
+
+class RoleMatrixAuthorizer(object):
+    """Authorizer granting the actions mapped to the user's role in a `RoleMatrix`
+
+    `role_lookup` is called with the same arguments as any other authorizer,
+    and should return the user's role relevant to the entity, or `None` if it
+    can not be determined from a role alone (e.g. the user has no role, or
+    the entity is in a state the table does not describe). In that case, or if
+    the role is not in the table, `fallback` is called instead if provided,
+    and no actions are granted otherwise.
+
+    >>> matrix = RoleMatrix()
+    >>> matrix.grant('editor', 'org', {'read', 'update'})
+    >>> check = matrix.authorizer('org', lambda id, **kw: 'editor' if id == 'foo' else None,
+    ...                           fallback=lambda **kw: {'read'})
+    >>> sorted(check(id='foo'))
+    ['read', 'update']
+    >>> sorted(check(id='bar'))
+    ['read']
+
+    Multiple entities can be checked at once using `check_many`, which can
+    be registered as the authorizer's batch function (see
+    `Authzzie.register_batch_authorizer`). If provided, `batch_role_lookup`
+    and `batch_fallback` are then called once for all entities, with a list
+    of parsed entity references, instead of `role_lookup` and `fallback`
+    being called for each entity.
+
+    >>> [sorted(actions) for actions in check.check_many([{'id': 'foo'}, {'id': 'bar'}])]
+    [['read', 'update'], ['read']]
+    """
+
+    def __init__(self,
+                 matrix,  # type: RoleMatrix
+                 entity_type,  # type: str
+                 role_lookup,  # type: RoleLookupCallable
+                 subscope=None,  # type: Optional[str]
+                 fallback=None,  # type: Optional[AuthorizerCallable]
+                 batch_role_lookup=None,  # type: Optional[BatchRoleLookupCallable]
+                 batch_fallback=None,  # type: Optional[BatchAuthorizerCallable]
+                 ):
+        # type: (...) -> None
+        self._matrix = matrix
+        self._entity_type = entity_type
+        self._subscope = subscope
+        self._role_lookup = role_lookup
+        self._fallback = fallback
+        self._batch_role_lookup = batch_role_lookup
+        self._batch_fallback = batch_fallback
+
+    def __call__(self, **kwargs):
+        # type: (**Any) -> Set[str]
+        actions = self._get_role_actions(self._role_lookup(**kwargs))
+        if actions is not None:
+            return set(actions)
+        if self._fallback is not None:
+            return self._fallback(**kwargs)
+        return set()
+
+    def check_many(self, entity_refs, **kwargs):
+        # type: (List[Dict[str, Any]], **Any) -> List[Set[str]]
+        """Get the actions granted on each of a list of entities, specified by their parsed references
+        """
+        if self._batch_role_lookup is not None:
+            roles = self._batch_role_lookup(entity_refs, **kwargs)
+        else:
+            roles = [self._role_lookup(**dict(kwargs, **entity_ref)) for entity_ref in entity_refs]
+
+        granted = [self._get_role_actions(role) for role in roles]
+        undetermined = [i for i, actions in enumerate(granted) if actions is None]
+        if not undetermined or (self._fallback is None and self._batch_fallback is None):
+            return [set(actions or ()) for actions in granted]
+
+        fallback_refs = [entity_refs[i] for i in undetermined]
+        if self._batch_fallback is not None:
+            fallback_results = self._batch_fallback(fallback_refs, **kwargs)
+        else:
+            fallback_results = [self._fallback(**dict(kwargs, **entity_ref)) for entity_ref in fallback_refs]
+        results = [set(actions or ()) for actions in granted]
+        for i, actions in zip(undetermined, fallback_results):
+            results[i] = set(actions)
+        return results
+
+    def _get_role_actions(self, role):
+        # type: (Optional[str]) -> Optional[FrozenSet[str]]
+        if role is None:
+            return None
+        return self._matrix.get_actions(role, self._entity_type, self._subscope)
+
+    def __repr__(self):
+        return '<RoleMatrixAuthorizer {}:{}>'.format(self._entity_type, self._subscope or '*')
+
 
 class Authzzie(object):
     """Authzzie authorization permission mapping class
@@ -157,21 +596,112 @@ class Authzzie(object):
 
     def __init__(self):
         self._authorizers = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+        self._batch_authorizers = {}  # type: Dict[AuthorizerCallable, BatchAuthorizerCallable]
         self._scope_normalizers = {}  # type: Dict[Tuple[str, Optional[str]], ScopeNormalizerCallable]
         self._ref_parsers = {}  # type: Dict[str, IdParserCallable]
         self._type_aliases = {}  # type: Dict[str, str]
         self._action_aliases = {}  # type: Dict[Tuple[str, Optional[str], str], str]
+        self._single_flight = None  # type: Any
+        self._caller_key = None  # type: Optional[Callable[..., Optional[Hashable]]]
+        self._authorizer_timeouts = {}  # type: Dict[AuthorizerCallable, float]
+        self._default_timeout = None  # type: Optional[float]
+        self._circuit_breaker = None  # type: Any
+        self._clock = time.monotonic  # type: Callable[[], float]
+        self._frozen = False
+
+    @property
+    def frozen(self):
+        # type: () -> bool
+        """Tell if the registry has been frozen
+        """
+        return self._frozen
+
+    def freeze(self):
+        # type: () -> None
+        """Freeze the registry of authorizers, normalizers, parsers and aliases
+
+        Once frozen, registering new bindings is no longer possible, and the
+        registry is converted into read-only mappings and tuples so that
+        looking up authorizers never modifies it. This is useful when the
+        registry is created before forking worker processes, as it will not
+        dirty memory pages shared with the parent process.
+        """
+        if self._frozen:
+            return
+        self._authorizers = MappingProxyType({
+            entity_type: MappingProxyType({
+                subscope: MappingProxyType({action: tuple(checks) for action, checks in actions.items()})
+                for subscope, actions in subscopes.items()})
+            for entity_type, subscopes in self._authorizers.items()})
+        self._batch_authorizers = MappingProxyType(dict(self._batch_authorizers))
+        self._authorizer_timeouts = MappingProxyType(dict(self._authorizer_timeouts))
+        self._scope_normalizers = MappingProxyType(dict(self._scope_normalizers))
+        self._ref_parsers = MappingProxyType(dict(self._ref_parsers))
+        self._type_aliases = MappingProxyType(dict(self._type_aliases))
+        self._action_aliases = MappingProxyType(dict(self._action_aliases))
+        self._frozen = True
+
+    def set_single_flight(self, single_flight, caller_key):
+        # type: (Any, Callable[..., Optional[Hashable]]) -> None
+        """Share the results of concurrent identical authorizer calls
+
+        `single_flight` is an object with a `do(key, func, *args, **kwargs)`
+        method, such as `singleflight.SingleFlight`. `caller_key` is called
+        with the keyword arguments passed to `authorize_scopes` and
+        `get_granted_actions`, and should return a hashable value identifying
+        the caller (e.g. the user name) so that results are only shared by
+        identical callers. If it returns `None`, results are not shared.
+        """
+        self._check_not_frozen()
+        self._single_flight = single_flight
+        self._caller_key = caller_key
+
+    def set_time_limits(self, default_timeout=None, circuit_breaker=None, clock=time.monotonic):
+        # type: (Optional[float], Any, Callable[[], float]) -> None
+        """Limit the time authorizer calls may take
+
+        `default_timeout` is the number of seconds a call to an authorizer
+        registered without a timeout of its own may take (see
+        `register_authorizer`). A call that takes longer is counted as failed,
+        and the scopes being evaluated are deferred rather than granted. As
+        running functions can not be interrupted, timeouts are checked once
+        calls complete. Batch calls are given the same timeout as single
+        calls.
+
+        `circuit_breaker` is an object with `allow(name)`, `record_success(name)`
+        and `record_failure(name)` methods, such as `deadline.CircuitBreaker`,
+        keeping track of authorizers that keep timing out so that they are
+        not called at all for a while.
+        """
+        self._check_not_frozen()
+        self._default_timeout = default_timeout
+        self._circuit_breaker = circuit_breaker
+        self._clock = clock
 
     def register_entity_ref_parser(self, entity_type, function):
         # type: (str, IdParserCallable) -> None
         """Register an entity reference parser for an entity type
         """
+        self._check_not_frozen()
         self._ref_parsers[entity_type] = function
 
-    def register_authorizer(self, entity_type, function, actions=None, subscopes=None, append=False):
-        # type: (str, AuthorizerCallable, Union[Set[str], str, None], Union[Set[str], str, None], bool) -> None
+    def register_authorizer(self,
+                            entity_type,  # type: str
+                            function,  # type: AuthorizerCallable
+                            actions=None,  # type: Union[Set[str], str, None]
+                            subscopes=None,  # type: Union[Set[str], str, None]
+                            append=False,  # type: bool
+                            timeout=None,  # type: Optional[float]
+                            ):
+        # type: (...) -> None
         """Register an authorizer function for an entity type, subscopes and actions
+
+        If `timeout` is specified, calls to the function taking longer than
+        this number of seconds are counted as failed (see `set_time_limits`).
         """
+        self._check_not_frozen()
+        if timeout is not None:
+            self._authorizer_timeouts[function] = timeout
         actions = to_iterable(actions)
         subscopes = to_iterable(subscopes)
         auth_checks = self._authorizers[entity_type]
@@ -183,6 +713,21 @@ class Authzzie(object):
                 else:
                     auth_checks[s][a] = [function]
 
+    def register_batch_authorizer(self, function, batch_function):
+        # type: (AuthorizerCallable, BatchAuthorizerCallable) -> None
+        """Register a function evaluating a registered authorizer for multiple entities at once
+
+        When evaluating a multi-reference scope (e.g. `res:org/ds/{a,b,c}`),
+        instead of calling `function` once for each entity, `batch_function`
+        is called once with a list of the arguments parsed from each entity
+        reference, along with any additional keyword arguments, and should
+        return a list of the sets of actions granted on each entity. This
+        allows loading shared parent entities once for all of them. Results
+        of batch calls are not shared between concurrent callers.
+        """
+        self._check_not_frozen()
+        self._batch_authorizers[function] = batch_function
+
     def register_scope_normalizer(self, entity_type, function, subscope=None):
         # type: (str, ScopeNormalizerCallable, Optional[str]) -> None
         """Register a scope normalizer function
@@ -191,6 +736,7 @@ class Authzzie(object):
         scope. They allow implementors to normalize granted scopes, for example
         by removing actions implied by other granted actions.
         """
+        self._check_not_frozen()
         self._scope_normalizers[(entity_type, subscope)] = function
 
     def register_type_alias(self, alias, original):
@@ -201,6 +747,7 @@ class Authzzie(object):
         type added by an extension) with a new name, acceptable by an external
         service.
         """
+        self._check_not_frozen()
         self._type_aliases[alias] = original
 
     def register_action_alias(self, alias, original, entity_type, subscope=None):
@@ -211,20 +758,99 @@ class Authzzie(object):
         action added by an extension) with a new name, acceptable by an external
         service.
         """
+        self._check_not_frozen()
         self._action_aliases[(entity_type, subscope, alias)] = original
 
-    def authorize_scope(self, scope, **kwargs):
-        # type: (Scope, Any) -> Optional[Scope]
+    def get_scope_matcher(self, scopes):
+        # type: (Iterable[Scope]) -> ScopeMatcher
+        """Get a `ScopeMatcher` for a list of granted scopes, aware of registered type and action aliases
+        """
+        return ScopeMatcher(scopes, type_aliases=self._type_aliases, action_aliases=self._action_aliases)
+
+    def authorize_scope(self, scope, deadline=None, **kwargs):
+        # type: (Scope, Optional[Deadline], Any) -> Optional[Scope]
         """Check a requested permission scope and return a granted scope
 
         This is a wrapper around `get_granted_actions` that normalizes granted
         permissions into a scope object. If no permissions are granted, will
-        return `None`.
+        return `None`. For multi-reference scopes, only actions granted on all
+        entities are included.
 
         Any additional parameters passed as `**kwargs` will be passed on down the
         stack to authorizer callbacks.
         """
-        granted_actions = self.get_granted_actions(scope, **kwargs)
+        return self._get_granted_scope(scope, self.get_granted_actions(scope, deadline, **kwargs))
+
+    def authorize_scopes(self, scopes, deadline=None, **kwargs):
+        # type: (Iterable[Scope], Optional[Deadline], Any) -> List[Optional[Scope]]
+        """Check a list of requested permission scopes and return granted scopes
+
+        This is equivalent to calling `authorize_scope` for each scope, and
+        returns a list of granted scopes (or `None` for scopes that were not
+        granted at all) in the same order as the requested scopes. However,
+        duplicate scopes are only evaluated once, and scopes covered by another
+        requested scope of the same entity (see `ScopeSet`) are not evaluated
+        at all if they would call the same authorizers: their granted actions
+        are derived from the results of the covering scope.
+
+        Multi-reference scopes are evaluated as a single batch, and granted in
+        the same compact form: entities granted the same actions are grouped
+        into one scope. If different actions are granted on different
+        entities, the scope is granted as multiple scopes, all returned in its
+        place.
+
+        If a `deadline.Deadline` is given, no authorizer is called once it has
+        passed. Scopes that could not be evaluated in time, or that depend on
+        an authorizer that timed out or is disabled by the circuit breaker
+        (see `set_time_limits`), are not granted, and are added to the
+        deadline's deferred scopes instead.
+        """
+        scopes = list(scopes)
+        scope_set = ScopeSet(scopes)
+        results = {}  # type: Dict[str, Union[List[Set[str]], Deferred]]
+        granted = {}  # type: Dict[str, List[Optional[Scope]]]
+
+        for scope in scope_set:
+            checks = self._get_scope_authorizers(scope)
+            for covering in scope_set.covering(scope):
+                if set(self._get_scope_authorizers(covering)) == set(checks):
+                    break
+            else:
+                covering = scope
+
+            key = str(covering)
+            if key not in results:
+                results[key] = self._try_call_entities_authorizers(covering, deadline, **kwargs)
+
+            if isinstance(results[key], Deferred):
+                if deadline is not None:
+                    deadline.defer(scope, results[key].reason)
+                granted[str(scope)] = [None]
+            else:
+                granted[str(scope)] = self._get_granted_scopes(scope, results[key])
+
+        return [granted_scope for scope in scopes for granted_scope in granted[str(scope_set.get(scope))]]
+
+    def get_granted_actions(self, scope, deadline=None, **kwargs):
+        # type: (Scope, Optional[Deadline], Any) -> Set[str]
+        """Get list of granted permissions for an entity / ID
+
+        No permissions are granted on scopes deferred due to time limits.
+        """
+        try:
+            entity_results = self._call_entities_authorizers(scope, deadline, **kwargs)
+        except Deferred as e:
+            if deadline is not None:
+                deadline.defer(scope, e.reason)
+            return set()
+
+        granted = [self._get_granted_actions_from_results(scope, results) for results in entity_results]
+        return granted[0].intersection(*granted[1:])
+
+    def _get_granted_scope(self, scope, granted_actions):
+        # type: (Scope, Set[str]) -> Optional[Scope]
+        """Create a normalized granted scope object from a set of granted actions
+        """
         if len(granted_actions) == 0:
             return None
 
@@ -237,43 +863,123 @@ class Authzzie(object):
 
         return granted
 
-    def get_granted_actions(self, scope, **kwargs):
-        # type: (Scope, Any) -> Set[str]
-        """Get list of granted permissions for an entity / ID
+    def _get_granted_scopes(self, scope, results):
+        # type: (Scope, List[Set[str]]) -> List[Optional[Scope]]
+        """Create granted scopes from the results of a scope's authorizers for each of its entities
+
+        Entities granted the same actions are grouped into a single scope.
+        """
+        multi_ref = parse_multi_ref(scope.entity_ref)
+        if multi_ref is None:
+            return [self._get_granted_scope(scope, self._get_granted_actions_from_results(scope, results[0]))]
+
+        prefix, members, suffix = multi_ref
+        groups = OrderedDict()  # type: Dict[FrozenSet[str], List[str]]
+        for member, member_results in zip(members, results):
+            granted_actions = self._get_granted_actions_from_results(scope, member_results)
+            if granted_actions:
+                groups.setdefault(frozenset(granted_actions), []).append(member)
+
+        granted = []  # type: List[Optional[Scope]]
+        for granted_actions, granted_members in groups.items():
+            group = copy.copy(scope)
+            group.entity_ref = format_multi_ref(prefix, granted_members, suffix)
+            granted.append(self._get_granted_scope(group, set(granted_actions)))
+        return granted or [None]
+
+    def _get_granted_actions_from_results(self, scope, results):
+        # type: (Scope, Set[str]) -> Set[str]
+        """Calculate granted actions for a scope from the results of its authorizers
+
+        This also handles action aliases
         """
-        granted = self._call_authorizers_for_scope(scope, **kwargs)
+        action_map = self._get_action_map(scope)
+        granted = set(results)
+
+        # Translate original actions back to aliases if an alias was requested
+        granted.update(alias for action, alias in action_map.items() if action in granted)
+
         if scope.actions:
             granted = scope.actions.intersection(granted)
 
         return granted
 
-    def _call_authorizers_for_scope(self, scope, **kwargs):
-        # type: (Scope, Any) -> Set[str]
-        """Calculate granted permissions based on requested scope
-
-        This also handles action aliases
+    def _call_scope_authorizers(self, scope, deadline=None, **kwargs):
+        # type: (Scope, Optional[Deadline], Any) -> Set[str]
+        """Call all authorizers for the requested scope, and return the actions granted by all of them
+        """
+        attributes = {"authz.entity_type": scope.entity_type,
+                      "authz.entity_ref": scope.entity_ref,
+                      "authz.subscope": scope.subscope,
+                      "authz.actions": tracing.format_actions(scope.actions)}
+        with tracing.span('authz.scope', attributes) as span:
+            check_results = [self._call_authorizer(check, scope.entity_type, scope.entity_ref, deadline, **kwargs)
+                             for check in self._get_scope_authorizers(scope)]
+
+            if len(check_results) == 0:
+                granted = set()  # type: Set[str]
+            else:
+                granted = check_results[0].intersection(*check_results[1:])
+
+            span.set_attribute('authz.granted_actions', tracing.format_actions(granted))
+            span.set_attribute('authz.granted', bool(granted))
+            return granted
+
+    def _call_entities_authorizers(self, scope, deadline=None, **kwargs):
+        # type: (Scope, Optional[Deadline], Any) -> List[Set[str]]
+        """Call all authorizers for each entity of the requested scope, and return the actions granted on each
+        """
+        if not scope.is_multi_ref:
+            return [self._call_scope_authorizers(scope, deadline, **kwargs)]
+
+        entity_refs = scope.entity_refs
+        attributes = {"authz.entity_type": scope.entity_type,
+                      "authz.entity_ref": scope.entity_ref,
+                      "authz.entity_count": len(entity_refs),
+                      "authz.subscope": scope.subscope,
+                      "authz.actions": tracing.format_actions(scope.actions)}
+        with tracing.span('authz.scope', attributes) as span:
+            check_results = [self._call_batch_authorizer(check, scope.entity_type, entity_refs, deadline, **kwargs)
+                             for check in self._get_scope_authorizers(scope)]
+
+            if len(check_results) == 0:
+                granted = [set() for _ in entity_refs]  # type: List[Set[str]]
+            else:
+                granted = [results[0].intersection(*results[1:]) for results in zip(*check_results)]
+
+            span.set_attribute('authz.granted', any(granted))
+            return granted
+
+    def _try_call_entities_authorizers(self, scope, deadline=None, **kwargs):
+        # type: (Scope, Optional[Deadline], Any) -> Union[List[Set[str]], Deferred]
+        """Call all authorizers for each entity of the requested scope, returning the exception if it was deferred
+        """
+        try:
+            return self._call_entities_authorizers(scope, deadline, **kwargs)
+        except Deferred as e:
+            return e
+
+    def _get_scope_authorizers(self, scope):
+        # type: (Scope) -> List[AuthorizerCallable]
+        """Get the list of unique authorizers to call for the requested scope
         """
         entity_checks = self._get_entity_authorizers(scope)
-        action_map = self._get_action_map(scope)
         if scope.actions:
             # Check permissions for each requested action
-            check_results = [self._call_authorizer(check, scope.entity_type, scope.entity_ref, **kwargs)
-                             for action in action_map.keys()
-                             for check in entity_checks[action]]
+            checks = [check for action in self._get_action_map(scope).keys()
+                      for check in entity_checks.get(action, ())]
         else:
             # Fall back to the default checks
-            check_results = [self._call_authorizer(check, scope.entity_type, scope.entity_ref, **kwargs)
-                             for check in entity_checks[None]]
-
-        if len(check_results) == 0:
-            return set()
+            checks = entity_checks.get(None, ())
 
-        granted = check_results[0].intersection(*check_results[1:])
+        # The same authorizer is typically registered for multiple actions; There
+        # is no need to call it more than once
+        unique_checks = []  # type: List[AuthorizerCallable]
+        for check in checks:
+            if check not in unique_checks:
+                unique_checks.append(check)
 
-        # Translate original actions back to aliases if an alias was requested
-        granted.update(alias for action, alias in action_map.items() if action in granted)
-
-        return granted
+        return unique_checks
 
     def _get_action_map(self, scope):
         # type: (Scope) -> Dict[str, str]
@@ -310,16 +1016,83 @@ class Authzzie(object):
         if scope.subscope and scope.subscope in e_checks:
             e_checks = e_checks[scope.subscope]
         else:
-            e_checks = e_checks[None]
+            e_checks = e_checks.get(None, {})
 
         return e_checks
 
-    def _call_authorizer(self, check, entity_type, entity_ref=None, **kwargs):
-        # type: (AuthorizerCallable, str, Optional[str], Any) -> Set[str]
+    def _check_not_frozen(self):
+        # type: () -> None
+        if self._frozen:
+            raise RuntimeError("Authorization bindings can not be registered once the registry is frozen")
+
+    def _call_authorizer(self, check, entity_type, entity_ref=None, deadline=None, **kwargs):
+        # type: (AuthorizerCallable, str, Optional[str], Optional[Deadline], Any) -> Set[str]
         """Call permission check function for scope and return result
         """
-        kwargs.update(self._parse_entity_ref(entity_type, entity_ref))
-        return check(**kwargs)
+        attributes = {"authz.authorizer": _get_authorizer_name(check),
+                      "authz.entity_type": entity_type,
+                      "authz.entity_ref": entity_ref}
+        with tracing.span('authz.authorizer', attributes) as span:
+            caller = self._caller_key(**kwargs) if self._single_flight is not None else None
+            kwargs.update(self._parse_entity_ref(entity_type, entity_ref))
+            if caller is None:
+                granted = self._call_time_limited(check, deadline, check, **kwargs)
+            else:
+                key = (check, self._type_aliases.get(entity_type, entity_type), entity_ref, caller)
+                granted = set(self._call_time_limited(check, deadline, self._single_flight.do, key, check, **kwargs))
+
+            span.set_attribute('authz.granted_actions', tracing.format_actions(granted))
+            span.set_attribute('authz.granted', bool(granted))
+            return granted
+
+    def _call_batch_authorizer(self, check, entity_type, entity_refs, deadline=None, **kwargs):
+        # type: (AuthorizerCallable, str, List[Optional[str]], Optional[Deadline], Any) -> List[Set[str]]
+        """Call a permission check function for multiple entities, in a single batch if possible
+        """
+        batch_check = self._batch_authorizers.get(check)
+        if batch_check is None:
+            return [self._call_authorizer(check, entity_type, entity_ref, deadline, **kwargs)
+                    for entity_ref in entity_refs]
+
+        attributes = {"authz.authorizer": _get_authorizer_name(check),
+                      "authz.entity_type": entity_type,
+                      "authz.entity_count": len(entity_refs)}
+        with tracing.span('authz.authorizer', attributes) as span:
+            parsed_refs = [self._parse_entity_ref(entity_type, entity_ref) for entity_ref in entity_refs]
+            granted = [set(actions) for actions in self._call_time_limited(check, deadline, batch_check,
+                                                                           parsed_refs, **kwargs)]
+            span.set_attribute('authz.granted', any(granted))
+            return granted
+
+    def _call_time_limited(self, check, deadline, function, *args, **kwargs):
+        # type: (AuthorizerCallable, Optional[Deadline], Callable[..., Any], Any, Any) -> Any
+        """Call a function evaluating an authorizer, unless the deadline has passed or the authorizer is disabled
+
+        Raises `Deferred` if the function was not called, or if it took longer
+        than the authorizer's timeout.
+        """
+        if deadline is not None:
+            deadline.check()
+
+        timeout = self._authorizer_timeouts.get(check, self._default_timeout)
+        if timeout is None:
+            return function(*args, **kwargs)
+
+        name = _get_authorizer_name(check)
+        breaker = self._circuit_breaker
+        if breaker is not None and not breaker.allow(name):
+            raise Deferred(CIRCUIT_OPEN, name)
+
+        started = self._clock()
+        result = function(*args, **kwargs)
+        if self._clock() - started > timeout:
+            if breaker is not None:
+                breaker.record_failure(name)
+            raise Deferred(AUTHORIZER_TIMEOUT, name)
+
+        if breaker is not None:
+            breaker.record_success(name)
+        return result
 
     def _parse_entity_ref(self, entity_type, entity_ref):
         # type: (str, Optional[str]) -> Dict[str, Any]
@@ -333,6 +1106,180 @@ class Authzzie(object):
         return kwargs
 
 
+def _get_authorizer_name(check):
+    # type: (AuthorizerCallable) -> str
+    return getattr(check, '__qualname__', repr(check))
+
+
+def coalesce_scopes(scopes, group_refs=False):
+    # type: (Iterable[Scope], bool) -> List[Scope]
+    """Coalesce a list of scopes into a minimal, equivalent list of scopes
+
+    Scopes referring to the same entity and subscope are merged into a single
+    scope with the union of their actions, and scopes covered by other scopes
+    in the list (see `Scope.covers`) are dropped. If `group_refs` is set,
+    scopes granting the same actions on entities whose references differ
+    only in their last part are then grouped into a multi-reference scope.
+    The result grants exactly the same permissions as the original list, and
+    maintains the order in which entities first appear in it.
+
+    >>> coalesce_scopes([Scope.from_string(s) for s in ('ds:foo:read', 'ds:foo:update', 'ds:foo:read')])
+    [<Scope ds:foo:read,update>]
+
+    >>> coalesce_scopes([Scope.from_string(s) for s in ('ds:foo:data:update', 'ds:bar:read', 'ds:*:read')])
+    [<Scope ds:foo:data:update>, <Scope ds:*:read>]
+
+    >>> scopes = [Scope.from_string(s) for s in ('res:o/d/{a,b}:read', 'res:o/d/b:update', 'res:o/d/c:read')]
+    >>> coalesce_scopes(scopes, group_refs=True)
+    [<Scope res:o/d/{a,c}:read>, <Scope res:o/d/b:read,update>]
+    """
+    merged = OrderedDict()  # type: Dict[Tuple[str, Optional[str], Optional[str]], Scope]
+    for scope in (entity_scope for multi_scope in scopes for entity_scope in multi_scope.expand()):
+        key = _scope_key(scope)
+        if key not in merged:
+            merged[key] = copy.copy(scope)
+            continue
+        existing = merged[key]
+        if _is_any_action(existing.actions) or _is_any_action(scope.actions):
+            existing.actions = None
+        else:
+            existing.actions = set(existing.actions).union(scope.actions)
+
+    # Only scopes with a wildcard entity reference and / or subscope can cover
+    # other scopes, so we only need to look those up
+    coalesced = []
+    for (entity_type, entity_ref, subscope), scope in merged.items():
+        candidates = {(entity_type, None, subscope), (entity_type, entity_ref, None), (entity_type, None, None)}
+        candidates.discard((entity_type, entity_ref, subscope))
+        if any(key in merged and merged[key].covers(scope) for key in candidates):
+            continue
+        coalesced.append(scope)
+
+    return _group_entity_refs(coalesced) if group_refs else coalesced
+
+
+def _group_entity_refs(scopes):
+    # type: (List[Scope]) -> List[Scope]
+    """Group scopes that differ only in the last part of their entity reference into multi-reference scopes
+    """
+    groups = OrderedDict()  # type: Dict[Hashable, List[Scope]]
+    for scope in scopes:
+        key = _group_key(scope)
+        groups.setdefault(key if key is not None else id(scope), []).append(scope)
+
+    grouped = []
+    for group in groups.values():
+        if len(group) == 1:
+            grouped.append(group[0])
+            continue
+        prefix = _get_ref_prefix(group[0].entity_ref)
+        scope = copy.copy(group[0])
+        scope.entity_ref = format_multi_ref(prefix, sorted(s.entity_ref[len(prefix):] for s in group))
+        grouped.append(scope)
+
+    return grouped
+
+
+def _group_key(scope):
+    # type: (Scope) -> Optional[Hashable]
+    """Get a key identifying the group of a scope that can be grouped with others, or `None` if it can not
+    """
+    if _is_wildcard(scope.entity_ref):
+        return None
+    prefix = _get_ref_prefix(scope.entity_ref)
+    if scope.entity_ref[len(prefix):] in ('', '*'):
+        return None
+    actions = None if _is_any_action(scope.actions) else frozenset(scope.actions)
+    return scope.entity_type, prefix, None if _is_wildcard(scope.subscope) else scope.subscope, actions
+
+
+def _get_ref_prefix(entity_ref):
+    # type: (str) -> str
+    """Get an entity reference up to its last part, e.g. the org and dataset parts of a resource reference
+    """
+    return entity_ref[:entity_ref.rfind('/') + 1]
+
+
+def parse_multi_ref(entity_ref):
+    # type: (Optional[str]) -> Optional[MultiRef]
+    """Parse a multi-entity reference into its prefix, member list and suffix
+
+    Returns `None` if the reference refers to a single entity.
+
+    >>> parse_multi_ref('org/ds/{a,b}')
+    ('org/ds/', ['a', 'b'], '')
+
+    >>> parse_multi_ref('org/ds/a') is None
+    True
+    """
+    if entity_ref is None or '{' not in entity_ref:
+        return None
+    match = _MULTI_REF_RE.match(entity_ref)
+    if match is None:
+        raise ValueError("Entity reference may only have one group of alternatives: {}".format(entity_ref))
+    prefix, members, suffix = match.group(1), match.group(2).split(','), match.group(3)
+    if any(not member or member == '*' or '/' in member for member in members):
+        raise ValueError("Unexpected entity reference alternatives: {}".format(entity_ref))
+    return prefix, members, suffix
+
+
+def format_multi_ref(prefix, members, suffix=''):
+    # type: (str, Iterable[str], str) -> str
+    """Format a reference to multiple entities, differing in one part
+
+    >>> format_multi_ref('org/ds/', ['a', 'b'])
+    'org/ds/{a,b}'
+
+    >>> format_multi_ref('org/', ['ds'], '/*')
+    'org/ds/*'
+    """
+    members = list(members)
+    if len(members) == 1:
+        return prefix + members[0] + suffix
+    return '{}{{{}}}{}'.format(prefix, ','.join(members), suffix)
+
+
+def _normalize_entity_ref(entity_ref):
+    # type: (str) -> str
+    """Normalize a multi-entity reference by sorting and de-duplicating its members
+    """
+    multi_ref = parse_multi_ref(entity_ref)
+    if multi_ref is None:
+        return entity_ref
+    prefix, members, suffix = multi_ref
+    return format_multi_ref(prefix, sorted(set(members)), suffix)
+
+
+def _entity_key(scope):
+    # type: (Scope) -> Tuple[str, Optional[str]]
+    """Get a hashable key identifying the entity a scope refers to
+    """
+    return scope.entity_type, None if _is_wildcard(scope.entity_ref) else scope.entity_ref
+
+
+def _scope_key(scope):
+    # type: (Scope) -> Tuple[str, Optional[str], Optional[str]]
+    """Get a hashable key identifying the entity and subscope a scope refers to
+    """
+    entity_ref = None if _is_wildcard(scope.entity_ref) else scope.entity_ref
+    subscope = None if _is_wildcard(scope.subscope) else scope.subscope
+    return scope.entity_type, entity_ref, subscope
+
+
+def _is_wildcard(value):
+    # type: (Optional[str]) -> bool
+    """Tell if an entity reference or subscope value means "any"
+    """
+    return value is None or value == '*'
+
+
+def _is_any_action(actions):
+    # type: (Union[None, str, Set[str]]) -> bool
+    """Tell if a scope's actions value means "any action"
+    """
+    return not actions or actions == '*' or '*' in actions
+
+
 def to_iterable(val):
     # type: (Any) -> Iterable
     """Get something we can iterate over from an unknown type
@@ -1,7 +1,9 @@
 """ckanext-authz-service Flask blueprints
 """
 from ckan.plugins import toolkit
-from flask import Blueprint, Response
+from flask import Blueprint, Response, request
+
+from . import keys
 
 blueprint = Blueprint(
     'authz_service',
@@ -13,7 +15,7 @@ def public_key():
     """Get the public key used to verify JWT tokens signed by us
 
     If no public key has been configured (e.g. we are using a symmetric algorithm), will
-    return 204 with no content.
+    return 204 with no content. Conditional requests for an unchanged key will return 304.
     """
     try:
         pub_key = toolkit.get_action('authz_public_key')(None, {}).get('public_key')
@@ -23,7 +25,9 @@ def public_key():
     if not pub_key:
         return '', 204, {"Content-type": None}
 
-    return Response(pub_key, mimetype='application/x-pem-file')
+    response = Response(pub_key, mimetype='application/x-pem-file')
+    response.set_etag(keys.get_public_key_etag(pub_key))
+    return response.make_conditional(request)
 
 
 blueprint.add_url_rule(u'/authz/public_key', view_func=public_key)
@@ -0,0 +1,342 @@
+"""Cache backends
+
+Cache backends are used to store state that should outlive a single request,
+such as revoked tokens, and that may need to be shared between CKAN worker
+processes. All backends implement the `CacheBackend` interface, and are
+obtained by calling `get_backend` with a namespace. The backend type is
+selected using the `ckanext.authz_service.cache_backend` configuration
+setting:
+
+* `memory` (the default) - a per-process, in-memory backend
+* `redis` - a Redis based backend, using CKAN's Redis connection (or
+  the `ckan.redis.url` setting when running without CKAN)
+* `mmap` - a backend shared by all processes on a host, stored in a memory
+  mapped file (see `shmcache`)
+* `some.module:factory` - a custom callable, called with the namespace as its
+  only argument and returning a `CacheBackend` instance
+
+Stored values must be JSON serializable.
+"""
+import importlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from . import util
+
+KEY_PREFIX = 'ckanext.authz_service'
+
+DEFAULT_REDIS_URL = 'redis://localhost:6379/0'
+
+_backends = {}  # type: Dict[str, CacheBackend]
+
+
+class CacheBackend(object):
+    """Cache backend interface
+    """
+
+    # Whether entries are shared with other processes, i.e. can be warmed up by another process
+    shared = False
+
+    def get(self, key):
+        # type: (str) -> Any
+        """Get a value from the cache, or `None` if it is not set or has expired
+        """
+        raise NotImplementedError('Cache backends must implement get()')
+
+    def get_many(self, keys):
+        # type: (Iterable[str]) -> Dict[str, Any]
+        """Get multiple values from the cache, as a dict of key -> value for all keys that are set
+        """
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set(self, key, value, ttl=None):
+        # type: (str, Any, Optional[float]) -> None
+        """Set a value in the cache, optionally expiring after `ttl` seconds
+        """
+        raise NotImplementedError('Cache backends must implement set()')
+
+    def add(self, key, value, ttl=None):
+        # type: (str, Any, Optional[float]) -> bool
+        """Set a value unless the key is already set, returning `True` if it was not set
+
+        Backends should override this to make adding atomic; The default
+        implementation is not.
+        """
+        if self.get(key) is not None:
+            return False
+        self.set(key, value, ttl)
+        return True
+
+    def incr(self, key):
+        # type: (str) -> int
+        """Increment an integer counter that never expires, starting from 0, and return its new value
+
+        Backends should override this to make incrementing atomic; The default
+        implementation is not.
+        """
+        value = (self.get(key) or 0) + 1
+        self.set(key, value)
+        return value
+
+    def delete(self, key):
+        # type: (str) -> None
+        """Delete a value from the cache
+        """
+        raise NotImplementedError('Cache backends must implement delete()')
+
+    def clear(self):
+        # type: () -> None
+        """Delete all values from the cache
+        """
+        raise NotImplementedError('Cache backends must implement clear()')
+
+    def stats(self):
+        # type: () -> Dict[str, Any]
+        """Get backend statistics, such as the number of entries and hits, if available
+        """
+        return {}
+
+
+class MemoryCacheBackend(CacheBackend):
+    """In-memory, per process cache backend
+
+    If `max_entries` is set, the least recently set entries are evicted once
+    the cache is full. Expired entries are removed as they are accessed, and
+    periodically as new entries are set.
+    """
+
+    SWEEP_INTERVAL = 1000
+
+    def __init__(self, max_entries=None, clock=time.time):
+        # type: (Optional[int], Callable[[], float]) -> None
+        self._max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()  # type: OrderedDict[str, Tuple[Any, Optional[float]]]
+        self._lock = threading.Lock()
+        self._sets = 0
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        # type: (str) -> Any
+        entry = self._entries.get(key)
+        if entry is None:
+            self._misses += 1
+            return None
+
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= self._clock():
+            with self._lock:
+                self._entries.pop(key, None)
+            self._misses += 1
+            return None
+
+        self._hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        # type: (str, Any, Optional[float]) -> None
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        # type: (str, Any, Optional[float]) -> bool
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > self._clock()):
+                return False
+            self._set(key, value, ttl)
+        return True
+
+    def incr(self, key):
+        # type: (str) -> int
+        with self._lock:
+            value, expires_at = self._entries.pop(key, (0, None))
+            if expires_at is not None and expires_at <= self._clock():
+                value = 0
+            value += 1
+            self._entries[key] = (value, None)
+        return value
+
+    def delete(self, key):
+        # type: (str) -> None
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        # type: () -> None
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        # type: () -> Dict[str, Any]
+        """Get the number of entries, and the number of hits and misses (which are counted approximately)
+        """
+        lookups = self._hits + self._misses
+        return {"entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": float(self._hits) / lookups if lookups else None}
+
+    def _set(self, key, value, ttl):
+        # type: (str, Any, Optional[float]) -> None
+        """Set a value; Must be called while holding the lock
+        """
+        expires_at = self._clock() + ttl if ttl is not None else None
+        self._entries.pop(key, None)
+        self._entries[key] = (value, expires_at)
+        self._sets += 1
+        if self._sets % self.SWEEP_INTERVAL == 0:
+            self._sweep()
+        if self._max_entries is not None:
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def _sweep(self):
+        # type: () -> None
+        """Remove all expired entries
+        """
+        now = self._clock()
+        expired = [k for k, (_, expires_at) in self._entries.items() if expires_at is not None and expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+
+
+class RedisCacheBackend(CacheBackend):
+    """Redis based cache backend, shared by all processes connected to the same Redis server
+
+    If no Redis client is provided, CKAN's Redis connection is used.
+    """
+
+    shared = True
+
+    def __init__(self, namespace, client=None):
+        # type: (str, Any) -> None
+        if client is None:
+            client = _connect_to_redis()
+        self._client = client
+        self._prefix = '{}:{}:'.format(KEY_PREFIX, namespace)
+
+    def get(self, key):
+        # type: (str) -> Any
+        return self._decode(self._client.get(self._prefix + key))
+
+    def get_many(self, keys):
+        # type: (Iterable[str]) -> Dict[str, Any]
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self._client.mget([self._prefix + k for k in keys])
+        return {k: self._decode(v) for k, v in zip(keys, values) if v is not None}
+
+    def set(self, key, value, ttl=None):
+        # type: (str, Any, Optional[float]) -> None
+        if ttl is not None:
+            self._client.set(self._prefix + key, json.dumps(value), px=max(int(ttl * 1000), 1))
+        else:
+            self._client.set(self._prefix + key, json.dumps(value))
+
+    def add(self, key, value, ttl=None):
+        # type: (str, Any, Optional[float]) -> bool
+        px = max(int(ttl * 1000), 1) if ttl is not None else None
+        return bool(self._client.set(self._prefix + key, json.dumps(value), px=px, nx=True))
+
+    def incr(self, key):
+        # type: (str) -> int
+        return int(self._client.incr(self._prefix + key))
+
+    def delete(self, key):
+        # type: (str) -> None
+        self._client.delete(self._prefix + key)
+
+    def clear(self):
+        # type: () -> None
+        keys = list(self._client.scan_iter(match=self._prefix + '*'))
+        if keys:
+            self._client.delete(*keys)
+
+    def stats(self):
+        # type: () -> Dict[str, Any]
+        """Get the number of entries in this backend's namespace
+        """
+        return {"entries": sum(1 for _ in self._client.scan_iter(match=self._prefix + '*'))}
+
+    @staticmethod
+    def _decode(value):
+        # type: (Optional[bytes]) -> Any
+        if value is None:
+            return None
+        return json.loads(value)
+
+
+def get_backend(namespace):
+    # type: (str) -> CacheBackend
+    """Get the configured cache backend for a namespace
+    """
+    if namespace not in _backends:
+        _backends[namespace] = _create_backend(namespace, util.get_config('cache_backend', 'memory'))
+    return _backends[namespace]
+
+
+def get_stats():
+    # type: () -> Dict[str, Dict[str, Any]]
+    """Get statistics for all cache backends created so far, by namespace
+    """
+    return {namespace: backend.stats() for namespace, backend in _backends.items()}
+
+
+def reset_backends():
+    # type: () -> None
+    """Discard all cache backend instances
+
+    Note that this will lose all data stored in in-memory backends.
+    """
+    _backends.clear()
+
+
+def _connect_to_redis():
+    # type: () -> Any
+    """Connect to CKAN's Redis server
+
+    Within CKAN, CKAN's own connection pool is used; Otherwise (see `wsgi`), a
+    client is created from the `ckan.redis.url` setting.
+    """
+    if util.is_ckan_config():
+        from ckan.lib.redis import connect_to_redis
+        return connect_to_redis()
+
+    import redis
+    return redis.Redis.from_url(util.get_global_config('ckan.redis.url', DEFAULT_REDIS_URL))
+
+
+def _create_backend(namespace, backend_type):
+    # type: (str, str) -> CacheBackend
+    """Create a cache backend instance
+    """
+    if backend_type == 'memory':
+        return MemoryCacheBackend()
+    elif backend_type == 'redis':
+        return RedisCacheBackend(namespace)
+    elif backend_type == 'mmap':
+        from . import shmcache
+        table = shmcache.get_shared_table(util.get_config('cache_mmap_file', shmcache.default_path()),
+                                          util.get_config_int('cache_mmap_slots', shmcache.DEFAULT_SLOTS),
+                                          util.get_config_int('cache_mmap_slot_size', shmcache.DEFAULT_SLOT_SIZE))
+        return shmcache.MmapCacheBackend(namespace, table, KEY_PREFIX)
+    elif ':' in backend_type:
+        module_name, factory_name = backend_type.split(':', 1)
+        factory = getattr(importlib.import_module(module_name), factory_name)
+        return factory(namespace)
+
+    raise ValueError("Unknown cache backend type: {}".format(backend_type))
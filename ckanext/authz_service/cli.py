@@ -0,0 +1,293 @@
+"""`ckan authz-service` command line interface
+
+Operator tools for warming caches and benchmarking this extension on a CKAN
+node, using the node's live configuration and keys. All commands run in batch,
+without going through the HTTP layer.
+"""
+import json
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import click
+from ckan import model
+from ckan.plugins import toolkit
+
+from . import actions, audit, cache, keys, plugin, util, verifier
+from .authz_binding import ownership, snapshot
+from .authzzie import Scope
+
+pytz = util.lazy_module('pytz')
+verification = util.lazy_module('ckanext.authz_service.verification')
+
+BENCHMARKS = ('sign', 'verify', 'authorize', 'downscope')
+
+DEFAULT_SCOPES = ('org:*:read',)
+
+
+@click.group('authz-service', short_help='Authorization service tools')
+def authz_service():
+    """Tools for warming caches and benchmarking ckanext-authz-service
+    """
+
+
+@authz_service.command(short_help='Warm shared caches for the most active users')
+@click.argument('log_file', type=click.File('r'))
+@click.option('--top-users', '-u', default=100, show_default=True, help='Number of users to warm caches for')
+@click.option('--stats', 'show_stats', is_flag=True, help='Print cache statistics when done')
+def warm(log_file, top_users, show_stats):
+    """Warm shared caches using a log of authorization requests
+
+    Each line of LOG_FILE is either a JSON object with a user name (`user`,
+    `user_id` or `sub`) and requested scopes (`scopes` or `requested_scopes`,
+    as a list or a space separated string), or a user name followed by
+    space separated scopes. Users are ranked by the number of scopes they
+    requested in the log.
+
+    Permission snapshots and decisions are stored in the cache backend, which
+    must be shared with CKAN worker processes (e.g. `mmap` or `redis`).
+    """
+    problem = check_shared_caches()
+    if problem:
+        raise click.ClickException(problem)
+
+    started = time.time()
+    entries = list(read_log_entries(log_file))
+    click.echo('Read {} log entries'.format(len(entries)))
+
+    warmed = warm_caches(entries, top_users, progress=_progress)
+    click.echo('Warmed caches for {users} users in {secs:.2f} seconds ({errors} errors)'
+               .format(secs=time.time() - started, **warmed))
+
+    if show_stats:
+        _echo_stats()
+
+
+@authz_service.command(short_help='Benchmark token signing, verification, authorization and downscoping')
+@click.option('--iterations', '-i', default=1000, show_default=True, help='Number of iterations per benchmark')
+@click.option('--user', help='Name of the user to authorize and sign tokens for (default: anonymous)')
+@click.option('--scope', '-s', 'scopes', multiple=True,
+              help='Scope to authorize; Can be used multiple times (default: {})'.format(' '.join(DEFAULT_SCOPES)))
+@click.option('--only', type=click.Choice(BENCHMARKS), multiple=True, help='Only run the specified benchmarks')
+@click.option('--stats', 'show_stats', is_flag=True, help='Print cache statistics when done')
+def bench(iterations, user, scopes, only, show_stats):
+    """Benchmark token signing, verification, authorization and downscoping with the live configuration and keys
+
+    The downscope benchmark derives a token for the first scope from a token
+    granting all scopes.
+    """
+    plugin.warm_up()
+    scopes = [Scope.from_string(s) for s in (scopes or DEFAULT_SCOPES)]
+    for name, result in run_benchmarks(iterations, user, scopes, only or BENCHMARKS, progress=_progress):
+        click.echo(format_benchmark_result(name, result))
+
+    if show_stats:
+        _echo_stats()
+
+
+@authz_service.command(short_help='Print cache statistics')
+def stats():
+    """Print cache sizes and hit rates
+
+    For in-memory caches, these are the statistics of the CLI process itself.
+    """
+    _echo_stats()
+
+
+def read_log_entries(lines):
+    # type: (Iterable[str]) -> Iterable[Tuple[Optional[str], List[str]]]
+    """Parse log lines into (user name, requested scopes) tuples, skipping lines that can't be parsed
+    """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith('{'):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            user = record.get('user', record.get('user_id', record.get('sub')))
+            scopes = record.get('scopes', record.get('requested_scopes', []))
+            if isinstance(scopes, str):
+                scopes = scopes.split(' ')
+        else:
+            user, _, scopes = line.partition(' ')
+            scopes = scopes.split()
+
+        yield user or None, [s for s in scopes if s]
+
+
+def check_shared_caches():
+    # type: () -> Optional[str]
+    """Check that there are caches to warm, shared with CKAN worker processes, returning the problem if not
+    """
+    namespaces = []
+    if util.get_config_bool('permission_snapshots', False):
+        namespaces.append(snapshot.CACHE_NAMESPACE)
+    if util.get_config_int('decision_cache_ttl', 0) > 0:
+        namespaces.append(actions.DECISION_CACHE_NAMESPACE)
+    if not namespaces:
+        return 'Nothing to warm: neither permission snapshots nor the decision cache are enabled'
+
+    if not all(cache.get_backend(namespace).shared for namespace in namespaces):
+        return ('The configured cache backend ({}) is not shared with CKAN worker processes; Configure a shared '
+                'backend such as mmap or redis'.format(util.get_config('cache_backend', 'memory')))
+    return None
+
+
+def warm_caches(entries, top_users=100, progress=None):
+    # type: (List[Tuple[Optional[str], List[str]]], int, Optional[Callable]) -> Dict[str, int]
+    """Warm caches for the most frequent users in a list of (user name, scopes) tuples
+
+    For each of the top users, permission snapshots (if enabled) are built and
+    all scopes the user requested are authorized, storing the decisions in
+    the decision cache (if enabled).
+    """
+    plugin.warm_up()
+    user_scopes = _count_log_entries(entries)
+    users = sorted(user_scopes, key=lambda u: sum(user_scopes[u].values()), reverse=True)[:top_users]
+    errors = 0
+
+    for user in _iterate(users, progress, 'Warming user caches'):
+        errors += not _warm_user_caches(user, list(user_scopes[user]))
+
+    return {"users": len(users), "errors": errors}
+
+
+def run_benchmarks(iterations, user=None, scopes=DEFAULT_SCOPES, benchmarks=BENCHMARKS, progress=None):
+    # type: (int, Optional[str], List[Scope], Iterable[str], Optional[Callable]) -> Iterable[Tuple[str, Dict]]
+    """Run benchmarks, yielding the name and timing results of each
+    """
+    user_obj = model.User.get(user) if user else None
+    if user and user_obj is None:
+        raise click.BadParameter('User not found: {}'.format(user), param_hint='--user')
+
+    scope_strs = [str(s) for s in scopes]
+    expires = datetime.now(tz=pytz.utc) + timedelta(days=1)
+    token, _ = actions._create_token(user_obj, scope_strs, expires)
+    algorithm = keys.get_algorithm()
+    key = keys.get_verification_key(algorithm)
+    authorizer = plugin.get_authorizer()
+    context = create_user_context(user)
+
+    functions = {
+        'sign': lambda: actions._create_token(user_obj, scope_strs, expires),
+        'verify': lambda: verification.verify_token(token, key, algorithm, issuer=verifier.get_issuer(),
+                                                    audience=verifier.get_audience()),
+        'authorize': lambda: authorizer.authorize_scopes(scopes, context=dict(context)),
+        'downscope': lambda: actions.downscope(authorizer, dict(context), {"token": token, "scopes": scope_strs[:1]}),
+    }
+
+    for name in benchmarks:
+        yield name, benchmark(functions[name], iterations, progress, 'Running {} benchmark'.format(name))
+
+
+def benchmark(func, iterations, progress=None, label=None):
+    # type: (Callable[[], Any], int, Optional[Callable], Optional[str]) -> Dict[str, float]
+    """Call a function repeatedly, and return timing statistics in seconds
+    """
+    timings = []
+    for _ in _iterate(range(iterations), progress, label):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+
+    timings.sort()
+    total = sum(timings)
+    return {"iterations": iterations,
+            "total": total,
+            "mean": total / iterations if iterations else 0.0,
+            "p50": _percentile(timings, 50),
+            "p95": _percentile(timings, 95),
+            "p99": _percentile(timings, 99)}
+
+
+def format_benchmark_result(name, result):
+    # type: (str, Dict[str, float]) -> str
+    """Format benchmark timing results as a single line
+    """
+    ops = result['iterations'] / result['total'] if result['total'] else float('inf')
+    return ('{name:<10} {iterations:>7} iterations   mean {mean_ms:8.3f} ms   p50 {p50_ms:8.3f} ms   '
+            'p95 {p95_ms:8.3f} ms   p99 {p99_ms:8.3f} ms   {ops:10.1f} ops/s').format(
+        name=name, iterations=result['iterations'], ops=ops,
+        **{'{}_ms'.format(k): result[k] * 1000 for k in ('mean', 'p50', 'p95', 'p99')})
+
+
+def get_stats():
+    # type: () -> Dict[str, Any]
+    """Get statistics for this process' caches
+    """
+    audit_log = audit.get_audit_log()
+    breaker = actions.get_circuit_breaker()
+    return {"cache_backends": cache.get_stats(),
+            "ownership_index": ownership.get_ownership_index().stats(),
+            "single_flight": actions.get_single_flight().stats(),
+            "rate_limiters": {limit: limiter.stats() for limit, limiter in actions.get_rate_limiters().items()},
+            "deadlines": actions.get_deadline_metrics().stats(),
+            "circuit_breaker": breaker.stats() if breaker else None,
+            "audit_log": audit_log.stats() if audit_log else None}
+
+
+def create_user_context(user):
+    # type: (Optional[str]) -> Dict[str, Any]
+    """Create a CKAN context for a user name, or for the anonymous user if `None`
+    """
+    user_obj = model.User.get(user) if user else None
+    return {"model": model,
+            "session": model.Session,
+            "user": user_obj.name if user_obj else None,
+            "auth_user_obj": user_obj}
+
+
+def _count_log_entries(entries):
+    # type: (Iterable[Tuple[Optional[str], List[str]]]) -> Dict[Optional[str], Counter]
+    """Count scopes requested by each user
+    """
+    user_scopes = OrderedDict()  # type: Dict[Optional[str], Counter]
+    for user, scopes in entries:
+        user_scopes.setdefault(user, Counter()).update(scopes)
+    return user_scopes
+
+
+def _warm_user_caches(user, scopes):
+    # type: (Optional[str], List[str]) -> bool
+    """Build a user's permission snapshot and authorize their scopes, returning `False` on failure
+    """
+    try:
+        context = create_user_context(user)
+        if user and context['user'] is None:
+            return False
+        snapshot.get_permission_snapshot(context)
+        actions._evaluate_scopes_cached(plugin.get_authorizer(), context, [Scope.from_string(s) for s in scopes])
+    except (ValueError, toolkit.ValidationError):
+        return False
+    finally:
+        model.Session.remove()
+    return True
+
+
+def _percentile(sorted_values, percentile):
+    # type: (List[float], int) -> float
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(percentile / 100.0 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def _iterate(items, progress, label):
+    if progress is None:
+        return items
+    return progress(items, label)
+
+
+def _progress(items, label):
+    with click.progressbar(items, label=label, file=click.get_text_stream('stderr')) as bar:
+        for item in bar:
+            yield item
+
+
+def _echo_stats():
+    click.echo(json.dumps(get_stats(), indent=2, sort_keys=True))
@@ -0,0 +1,325 @@
+"""Python client for token consumers and requesters
+
+`AuthzClient` requests tokens from CKAN and verifies tokens locally, taking
+care of what each consumer would otherwise need to implement:
+
+* Tokens are cached per set of requested scopes, and reused until shortly
+  before they expire. Each token is refreshed at a randomly jittered time
+  within the last part of its lifetime, so that tokens requested together
+  are not all refreshed at once; Tokens still valid are refreshed using the
+  cheaper `authz_refresh` action, and remain in use if CKAN can not be
+  reached.
+* Concurrent requests for the same token or public key are coalesced into a
+  single request to CKAN (see `singleflight`).
+* The public key is cached, and revalidated periodically using a conditional
+  GET request, so unchanged keys are not downloaded again. If a token's
+  signature does not match a cached key, the key is revalidated immediately,
+  so that key rotation is picked up.
+* Tokens are verified using the same rules as the `authz_verify` action (see
+  `verifier`), except that revocations and replays are not checked.
+
+>>> client = AuthzClient('https://ckan.example.com', api_key='...')  # doctest: +SKIP
+>>> client.get_token(['ds:myorg/mydataset:read'])  # doctest: +SKIP
+>>> client.verify(token)['verified']  # doctest: +SKIP
+
+This module does not depend on CKAN.
+"""
+import json
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from . import util, verification
+from .singleflight import SingleFlight
+from .verifier import TokenVerifier
+
+jwt = util.lazy_module('jwt')
+
+DEFAULT_REFRESH_MARGIN = 30
+
+DEFAULT_REFRESH_JITTER = 0.1
+
+DEFAULT_KEY_MAX_AGE = 300
+
+DEFAULT_TIMEOUT = 10
+
+# Minimal number of seconds between revalidating the public key due to signature mismatches
+KEY_RECHECK_INTERVAL = 10
+
+PUBLIC_KEY_PATH = '/authz/public_key'
+
+ACTION_PATH = '/api/3/action/'
+
+TokenKey = Tuple[Tuple[str, ...], Optional[int]]
+
+
+class AuthzClientError(Exception):
+    """An error response from CKAN
+    """
+
+    def __init__(self, status, error):
+        # type: (int, Dict[str, Any]) -> None
+        super(AuthzClientError, self).__init__(error.get('message') or error.get('__type'))
+        self.status = status
+        self.error = error
+
+
+class _CachedToken(object):
+
+    __slots__ = ('result', 'expires_at', 'refresh_at')
+
+    def __init__(self, result, expires_at, refresh_at):
+        # type: (Dict[str, Any], float, float) -> None
+        self.result = result
+        self.expires_at = expires_at
+        self.refresh_at = refresh_at
+
+
+class _CachedKey(object):
+
+    __slots__ = ('pem', 'parsed', 'etag', 'last_modified', 'checked_at')
+
+    def __init__(self, pem, parsed, etag, last_modified, checked_at):
+        # type: (Optional[bytes], Any, Optional[str], Optional[str], float) -> None
+        self.pem = pem
+        self.parsed = parsed
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked_at = checked_at
+
+
+class AuthzClient(object):
+    """Client for requesting tokens from CKAN and verifying them
+
+    `refresh_margin` is the number of seconds before tokens expire at which
+    they are refreshed, and `refresh_jitter` is the fraction of each token's
+    lifetime by which its refresh is randomly brought forward. `key_max_age`
+    is the number of seconds the public key is used before it is revalidated.
+
+    To verify tokens signed using a symmetric algorithm (HS*), the shared
+    `secret` must be provided. `issuer` and `audience`, if provided, are
+    checked when verifying tokens.
+    """
+
+    def __init__(self,
+                 base_url,  # type: str
+                 api_key=None,  # type: Optional[str]
+                 algorithm='RS256',  # type: str
+                 secret=None,  # type: Optional[str]
+                 issuer=None,  # type: Optional[str]
+                 audience=None,  # type: Optional[str]
+                 refresh_margin=DEFAULT_REFRESH_MARGIN,  # type: float
+                 refresh_jitter=DEFAULT_REFRESH_JITTER,  # type: float
+                 key_max_age=DEFAULT_KEY_MAX_AGE,  # type: float
+                 timeout=DEFAULT_TIMEOUT,  # type: float
+                 clock=time.time,  # type: Callable[[], float]
+                 ):
+        # type: (...) -> None
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.algorithm = algorithm
+        self.secret = secret
+        self.issuer = issuer
+        self.audience = audience
+        self.refresh_margin = refresh_margin
+        self.refresh_jitter = refresh_jitter
+        self.key_max_age = key_max_age
+        self.timeout = timeout
+        self._clock = clock
+        self._flight = SingleFlight(timeout)
+        self._lock = threading.Lock()
+        self._tokens = {}  # type: Dict[TokenKey, _CachedToken]
+        self._key = None  # type: Optional[_CachedKey]
+        self._stats = {"token_requests": 0, "token_refreshes": 0, "key_requests": 0, "key_not_modified": 0}
+
+    def authorize(self, scopes, lifetime=None):
+        # type: (Iterable[str], Optional[int]) -> Dict[str, Any]
+        """Get an `authz_authorize` result for a set of scopes, reusing a cached token if it is not due for refresh
+        """
+        key = (tuple(sorted(set(scopes))), lifetime)
+        with self._lock:
+            cached = self._tokens.get(key)
+        if cached is not None and self._clock() < cached.refresh_at:
+            return cached.result
+        return self._flight.do(('token', key), self._renew_token, key)
+
+    def get_token(self, scopes, lifetime=None):
+        # type: (Iterable[str], Optional[int]) -> str
+        """Get an encoded token for a set of scopes
+        """
+        return self.authorize(scopes, lifetime)['token']
+
+    def invalidate(self, scopes=None, lifetime=None):
+        # type: (Optional[Iterable[str]], Optional[int]) -> None
+        """Discard the cached token for a set of scopes, or all cached tokens
+        """
+        with self._lock:
+            if scopes is None:
+                self._tokens.clear()
+            else:
+                self._tokens.pop((tuple(sorted(set(scopes))), lifetime), None)
+
+    def get_public_key(self, revalidate=False):
+        # type: (bool) -> Optional[bytes]
+        """Get the PEM encoded public key used to sign tokens, or `None` if CKAN has none
+        """
+        return self._get_key(revalidate).pem
+
+    def verify(self, token, strict=True):
+        # type: (verification.EncodedToken, bool) -> Dict[str, Any]
+        """Verify a token locally, returning a result in the same format as the `authz_verify` action
+        """
+        if self.algorithm[0:2] == 'HS':
+            if self.secret is None:
+                raise ValueError("A secret is required to verify tokens signed using {}".format(self.algorithm))
+            return self._verifier(self.secret).verify(token, strict=strict)
+
+        key = self._get_key()
+        if key.parsed is None:
+            raise ValueError("CKAN has no public key configured to verify tokens")
+        result = self._verifier(key.parsed).verify(token, strict=strict)
+        if (any(error['reason'] == 'invalid_signature' for error in result['errors']) and
+                self._clock() >= key.checked_at + KEY_RECHECK_INTERVAL):
+            # The key may have been rotated since it was last checked
+            new_key = self._get_key(revalidate=True)
+            if new_key.pem != key.pem and new_key.parsed is not None:
+                result = self._verifier(new_key.parsed).verify(token, strict=strict)
+        return result
+
+    def call_action(self, name, data_dict):
+        # type: (str, Dict[str, Any]) -> Any
+        """Call a CKAN action, returning its result or raising `AuthzClientError`
+        """
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers['Authorization'] = self.api_key
+        status, _, body = self._request(ACTION_PATH + name, json.dumps(data_dict).encode('utf-8'), headers)
+        try:
+            response = json.loads(body.decode('utf-8'))
+        except ValueError:
+            raise AuthzClientError(status, {"__type": "Bad Response", "message": "Response is not valid JSON"})
+        if status != 200 or not response.get('success'):
+            raise AuthzClientError(status, response.get('error') or {"__type": "Bad Response"})
+        return response['result']
+
+    def stats(self):
+        # type: () -> Dict[str, Any]
+        """Get request counters, the number of cached tokens, and single flight statistics
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['cached_tokens'] = len(self._tokens)
+        stats['single_flight'] = self._flight.stats()
+        return stats
+
+    def _renew_token(self, key):
+        # type: (TokenKey) -> Dict[str, Any]
+        """Refresh a cached token that is still valid, or request a new one
+        """
+        scopes, lifetime = key
+        with self._lock:
+            cached = self._tokens.get(key)
+        now = self._clock()
+        if cached is not None and now < cached.refresh_at:
+            # Renewed by another thread that got here first
+            return cached.result
+
+        result = None
+        if cached is not None and now < cached.expires_at:
+            try:
+                result = self._call_token_action('authz_refresh', {"token": cached.result['token']}, lifetime)
+                self._count('token_refreshes')
+            except AuthzClientError:
+                # E.g. the token was revoked, or scopes were granted by the user's removed permissions
+                pass
+            except OSError:
+                # Keep using the token while CKAN can not be reached
+                return cached.result
+
+        if result is None:
+            result = self._call_token_action('authz_authorize', {"scopes": list(scopes)}, lifetime)
+            self._count('token_requests')
+
+        with self._lock:
+            self._tokens[key] = self._cache_entry(result)
+        return result
+
+    def _call_token_action(self, name, data_dict, lifetime):
+        # type: (str, Dict[str, Any], Optional[int]) -> Dict[str, Any]
+        if lifetime is not None:
+            data_dict['lifetime'] = lifetime
+        return self.call_action(name, data_dict)
+
+    def _cache_entry(self, result):
+        # type: (Dict[str, Any]) -> _CachedToken
+        """Create a token cache entry, with a jittered refresh time
+        """
+        now = self._clock()
+        payload = verification.decode_payload(result['token'])
+        expires_at = float(payload.get('exp', now))
+        lifetime = max(expires_at - now, 0)
+        jitter = random.uniform(0, self.refresh_jitter) * lifetime
+        refresh_at = expires_at - min(self.refresh_margin, lifetime / 2) - jitter
+        return _CachedToken(result, expires_at, max(refresh_at, now))
+
+    def _get_key(self, revalidate=False):
+        # type: (bool) -> _CachedKey
+        key = self._key
+        if key is not None and not revalidate and self._clock() < key.checked_at + self.key_max_age:
+            return key
+        return self._flight.do('public_key', self._fetch_key, key)
+
+    def _fetch_key(self, previous):
+        # type: (Optional[_CachedKey]) -> _CachedKey
+        """Fetch the public key, or revalidate a previously fetched key using a conditional GET request
+        """
+        if self._key is not previous:
+            # Fetched by another thread that got here first
+            return self._key  # type: ignore
+
+        headers = {}
+        if previous is not None and previous.etag:
+            headers['If-None-Match'] = previous.etag
+        if previous is not None and previous.last_modified:
+            headers['If-Modified-Since'] = previous.last_modified
+
+        status, response_headers, body = self._request(PUBLIC_KEY_PATH, headers=headers)
+        self._count('key_requests')
+        now = self._clock()
+        if status == 304 and previous is not None:
+            self._count('key_not_modified')
+            key = _CachedKey(previous.pem, previous.parsed, previous.etag, previous.last_modified, now)
+        elif status == 200:
+            parsed = jwt.algorithms.get_default_algorithms()[self.algorithm].prepare_key(body)
+            key = _CachedKey(body, parsed, response_headers.get('ETag'), response_headers.get('Last-Modified'), now)
+        elif status == 204:
+            key = _CachedKey(None, None, None, None, now)
+        else:
+            raise AuthzClientError(status, {"__type": "Bad Response",
+                                            "message": "Unexpected response fetching public key: {}".format(status)})
+        self._key = key
+        return key
+
+    def _verifier(self, key):
+        # type: (Any) -> TokenVerifier
+        return TokenVerifier(key, self.algorithm, issuer=self.issuer, audience=self.audience)
+
+    def _request(self, path, data=None, headers=None):
+        # type: (str, Optional[bytes], Optional[Dict[str, str]]) -> Tuple[int, Dict[str, str], bytes]
+        """Make an HTTP request to CKAN, returning the response status, headers and body
+        """
+        request = Request(self.base_url + path, data=data, headers=headers or {})
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                return response.status, dict(response.headers), response.read()
+        except HTTPError as e:
+            with e:
+                return e.code, dict(e.headers or {}), e.read()
+
+    def _count(self, counter):
+        # type: (str) -> None
+        with self._lock:
+            self._stats[counter] += 1
@@ -0,0 +1,194 @@
+"""Time limits for evaluating authorization requests
+
+A `Deadline` is the time budget of a single request: once it runs out, no
+more authorizers are called, and the scopes not yet evaluated are deferred
+(i.e. not granted) instead. Authorizers may also be given a timeout of their
+own; A call that takes longer is counted as failed, and its result is not
+used.
+
+Python can not safely interrupt a running function (authorizers use thread
+local DB sessions, so they can not be moved to another thread either), so
+both limits are enforced between calls: a single slow call can still overrun
+the deadline, but can not be followed by others.
+
+A `CircuitBreaker` keeps track of authorizers that keep failing: once an
+authorizer failed a number of times in a row, it is not called at all, and
+scopes depending on it are deferred right away, until some time has passed.
+A single call is then let through to probe whether the authorizer recovered.
+
+This module does not depend on CKAN.
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+DEFAULT_FAILURE_THRESHOLD = 5
+
+DEFAULT_RESET_TIMEOUT = 30
+
+# Reasons for deferring a scope
+DEADLINE_EXCEEDED = 'deadline_exceeded'
+
+AUTHORIZER_TIMEOUT = 'authorizer_timeout'
+
+CIRCUIT_OPEN = 'circuit_open'
+
+
+class Deferred(Exception):
+    """A scope could not be evaluated within the time limits
+    """
+
+    def __init__(self, reason, authorizer=None):
+        # type: (str, Optional[str]) -> None
+        super(Deferred, self).__init__(reason if authorizer is None else '{}: {}'.format(reason, authorizer))
+        self.reason = reason
+        self.authorizer = authorizer
+
+
+class Deadline(object):
+    """The time budget of a single request, in seconds, and the scopes deferred once it ran out
+
+    >>> deadline = Deadline(0.5, clock=lambda: 10.0)
+    >>> deadline.remaining(), deadline.expired()
+    (0.5, False)
+    """
+
+    def __init__(self, budget, clock=time.monotonic):
+        # type: (float, Callable[[], float]) -> None
+        self.clock = clock
+        self.expires_at = clock() + budget
+        self.deferred = []  # type: List[Tuple[Any, str]]
+
+    def remaining(self):
+        # type: () -> float
+        return max(self.expires_at - self.clock(), 0.0)
+
+    def expired(self):
+        # type: () -> bool
+        return self.clock() >= self.expires_at
+
+    def check(self):
+        # type: () -> None
+        """Raise `Deferred` if the deadline has passed
+        """
+        if self.expired():
+            raise Deferred(DEADLINE_EXCEEDED)
+
+    def defer(self, scope, reason):
+        # type: (Any, str) -> None
+        self.deferred.append((scope, reason))
+
+    @property
+    def deferred_scopes(self):
+        # type: () -> List[Any]
+        return [scope for scope, _ in self.deferred]
+
+
+class _Circuit(object):
+
+    __slots__ = ('failures', 'opened_at')
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None  # type: Optional[float]
+
+
+class CircuitBreaker(object):
+    """Stop calling authorizers, identified by name, that failed `failure_threshold` times in a row
+
+    An open circuit is half-opened after `reset_timeout` seconds: a single
+    call is allowed, and closes the circuit if it succeeds or re-opens it if
+    it fails.
+
+    >>> breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=lambda: 10.0)
+    >>> breaker.record_failure('slow_authorizer')
+    >>> breaker.allow('slow_authorizer')
+    True
+    >>> breaker.record_failure('slow_authorizer')
+    >>> breaker.allow('slow_authorizer')
+    False
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 clock=time.monotonic):
+        # type: (int, float, Callable[[], float]) -> None
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._circuits = {}  # type: Dict[str, _Circuit]
+        self._stats = {"failures": 0, "trips": 0, "rejected": 0}
+
+    def allow(self, name):
+        # type: (str) -> bool
+        """Tell if an authorizer may be called
+        """
+        with self._lock:
+            circuit = self._circuits.get(name)
+            if circuit is None or circuit.opened_at is None:
+                return True
+            now = self._clock()
+            if now < circuit.opened_at + self._reset_timeout:
+                self._stats['rejected'] += 1
+                return False
+            # Half-open: let this call through, and keep rejecting others until it completes
+            circuit.opened_at = now
+            return True
+
+    def record_success(self, name):
+        # type: (str) -> None
+        with self._lock:
+            self._circuits.pop(name, None)
+
+    def record_failure(self, name):
+        # type: (str) -> None
+        with self._lock:
+            self._stats['failures'] += 1
+            circuit = self._circuits.setdefault(name, _Circuit())
+            circuit.failures += 1
+            if circuit.failures >= self._failure_threshold:
+                if circuit.opened_at is None:
+                    self._stats['trips'] += 1
+                circuit.opened_at = self._clock()
+
+    def is_open(self, name):
+        # type: (str) -> bool
+        with self._lock:
+            circuit = self._circuits.get(name)
+            return circuit is not None and circuit.opened_at is not None
+
+    def stats(self):
+        # type: () -> Dict[str, Any]
+        """Get the number of recorded `failures`, circuit `trips` and `rejected` calls, and the open circuits
+        """
+        with self._lock:
+            stats = dict(self._stats)  # type: Dict[str, Any]
+            stats['open'] = sorted(name for name, circuit in self._circuits.items() if circuit.opened_at is not None)
+        return stats
+
+
+class DeadlineMetrics(object):
+    """Count requests evaluated with a deadline, and the scopes they deferred
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "deferred_requests": 0, "deferred_scopes": 0,
+                       DEADLINE_EXCEEDED: 0, AUTHORIZER_TIMEOUT: 0, CIRCUIT_OPEN: 0}
+
+    def record(self, deadline):
+        # type: (Deadline) -> None
+        with self._lock:
+            self._stats['requests'] += 1
+            if deadline.deferred:
+                self._stats['deferred_requests'] += 1
+            for _, reason in deadline.deferred:
+                self._stats['deferred_scopes'] += 1
+                self._stats[reason] += 1
+
+    def stats(self):
+        # type: () -> Dict[str, int]
+        """Get the number of `requests`, of `deferred_requests` and `deferred_scopes`, and deferred scopes by reason
+        """
+        with self._lock:
+            return dict(self._stats)
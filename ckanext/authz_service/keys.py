@@ -0,0 +1,146 @@
+"""JWT key management
+
+Keys are read from configuration or from files, and parsed into key objects
+usable by `jwt`. Both raw and parsed keys are cached, so that key files are
+not read and parsed on every request; Key files are re-read if they are
+modified.
+"""
+import hashlib
+import os
+from typing import Any, Dict, Optional, Tuple, Union
+
+from . import util
+
+jwt = util.lazy_module('jwt')
+
+_raw_keys = {}  # type: Dict[Tuple[Any, ...], Optional[bytes]]
+_parsed_keys = {}  # type: Dict[Tuple[Any, ...], Any]
+
+
+def get_algorithm():
+    # type: () -> str
+    """Get the configured JWT algorithm
+    """
+    return util.get_config('jwt_algorithm', 'RS256')
+
+
+def get_private_key():
+    # type: () -> Optional[bytes]
+    """Get the configured private key from file or string
+    """
+    private_key = util.get_config('jwt_private_key', None)
+    if private_key:
+        return private_key.encode('ascii')
+
+    return _read_key_file(util.get_config('jwt_private_key_file'))
+
+
+def get_public_key():
+    # type: () -> Optional[bytes]
+    """Get the configured public key from file
+    """
+    return _read_key_file(util.get_config('jwt_public_key_file', None))
+
+
+def get_public_key_etag(pub_key):
+    # type: (Union[str, bytes]) -> str
+    """Get the entity tag identifying a public key, for conditional requests to the public key endpoints
+    """
+    if isinstance(pub_key, str):
+        pub_key = pub_key.encode('ascii')
+    return hashlib.sha256(pub_key).hexdigest()[:32]
+
+
+def get_signing_key(algorithm=None):
+    # type: (Optional[str]) -> Any
+    """Get the parsed key to use for signing tokens
+    """
+    return _parse_key(get_private_key(), algorithm or get_algorithm())
+
+
+def get_verification_key(algorithm=None):
+    # type: (Optional[str]) -> Any
+    """Get the parsed key to use for verifying tokens
+
+    If a symmetric algorithm is used, this is the private (secret) key
+    """
+    algorithm = algorithm or get_algorithm()
+    return _parse_key(_get_raw_verification_key(algorithm), algorithm)
+
+
+def get_verification_key_id(algorithm=None):
+    # type: (Optional[str]) -> Optional[str]
+    """Get an ID identifying the key used to verify tokens and its algorithm, or `None` if there is no key
+
+    The ID changes whenever the key is changed, so it can be used to tell
+    apart verification results cached with a previous key.
+    """
+    algorithm = algorithm or get_algorithm()
+    key = _get_raw_verification_key(algorithm)
+    if key is None:
+        return None
+    return hashlib.sha256(algorithm.encode('ascii') + b':' + key).hexdigest()[:32]
+
+
+def load_keys():
+    # type: () -> None
+    """Read and parse all configured keys, so they are cached for later use
+
+    This also loads the `jwt` library and its crypto backend
+    """
+    jwt.algorithms.get_default_algorithms()
+    algorithm = get_algorithm()
+    get_signing_key(algorithm)
+    get_verification_key(algorithm)
+
+
+def clear_cache():
+    # type: () -> None
+    """Clear all cached keys
+    """
+    _raw_keys.clear()
+    _parsed_keys.clear()
+
+
+def _get_raw_verification_key(algorithm):
+    # type: (str) -> Optional[bytes]
+    """Get the raw key used to verify tokens: the private (secret) key for symmetric algorithms, or the public key
+    """
+    if algorithm[0:2] == 'HS':
+        return get_private_key()
+    return get_public_key()
+
+
+def _read_key_file(file_name):
+    # type: (Optional[str]) -> Optional[bytes]
+    """Read a key file, or get its contents from cache if it was not modified
+    """
+    if not file_name:
+        return None
+
+    stat = os.stat(file_name)
+    cache_key = (file_name, stat.st_mtime, stat.st_size)
+    if cache_key not in _raw_keys:
+        with open(file_name, 'rb') as f:
+            _raw_keys[cache_key] = f.read()
+
+    return _raw_keys[cache_key]
+
+
+def _parse_key(key, algorithm):
+    # type: (Optional[bytes], str) -> Any
+    """Parse a raw key into a key object for the JWT algorithm
+    """
+    if key is None:
+        return None
+
+    cache_key = (key, algorithm)
+    if cache_key not in _parsed_keys:
+        algorithms = jwt.algorithms.get_default_algorithms()
+        if algorithm in algorithms:
+            _parsed_keys[cache_key] = algorithms[algorithm].prepare_key(key)
+        else:
+            # Let `jwt` deal with unsupported algorithms
+            _parsed_keys[cache_key] = key
+
+    return _parsed_keys[cache_key]
@@ -1,33 +1,108 @@
-from functools import partial
+import gc
+import sys
+from functools import wraps
+from typing import Any, Callable, Optional
 
 import ckan.plugins as plugins
 
-from ckanext.authz_service import actions, blueprints
-from ckanext.authz_service.authz_binding import default_authz_bindings
+from ckanext.authz_service import audit, auth, blueprints, cache, keys, tracing, util, verifier
 from ckanext.authz_service.authzzie import Authzzie
 from ckanext.authz_service.interfaces import IAuthorizationBindings
 
+# `actions` and `authz_binding` load the CKAN model and the JWT libraries, so they are only imported when first used
+
+_authorizer = None  # type: Optional[Authzzie]
+
 
 class AuthzServicePlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IBlueprint)
+    plugins.implements(plugins.IClick)
+    plugins.implements(plugins.IConfigurable)
+    plugins.implements(plugins.IPackageController, inherit=True)
+    plugins.implements(plugins.IResourceController, inherit=True)
     plugins.implements(IAuthorizationBindings)
 
     # IActions
 
     def get_actions(self):
-        authorizer = init_authorizer()
-        return {'authz_authorize': partial(actions.authorize, authorizer),
+        from ckanext.authz_service import actions
+        return {'authz_authorize': _with_authorizer(actions.authorize),
+                'authz_refresh': _with_authorizer(actions.refresh),
+                'authz_downscope': _with_authorizer(actions.downscope),
                 'authz_verify': actions.verify,
+                'authz_revoke': actions.revoke,
                 'authz_public_key': actions.public_key}
 
+    # IAuthFunctions
+
+    def get_auth_functions(self):
+        return {'authz_revoke': auth.revoke}
+
     # IBlueprint
     def get_blueprint(self):
         return blueprints.blueprint
 
+    # IClick
+
+    def get_commands(self):
+        from ckanext.authz_service.cli import authz_service
+        return [authz_service]
+
+    # IConfigurable
+
+    def configure(self, config):
+        reset()
+        configure_tracing()
+        if _tracks_membership_changes():
+            from ckanext.authz_service.authz_binding import snapshot
+            snapshot.listen_for_membership_changes()
+        if util.get_config_bool('warm_up_on_load', True):
+            warm_up()
+
+    # IPackageController / IResourceController
+
+    def after_dataset_create(self, context, pkg_dict):
+        _get_ownership_index().invalidate(pkg_dict)
+
+    def after_dataset_update(self, context, pkg_dict):
+        _get_ownership_index().invalidate(pkg_dict)
+
+    def after_dataset_delete(self, context, pkg_dict):
+        _get_ownership_index().invalidate(pkg_dict)
+
+    def after_resource_create(self, context, resource):
+        _get_ownership_index().invalidate(resource)
+
+    def after_resource_update(self, context, resource):
+        _get_ownership_index().invalidate(resource)
+
+    def before_resource_delete(self, context, resource, resources):
+        # The "after" hook is only passed the remaining resources
+        _get_ownership_index().invalidate_resource(resource.get('id'))
+
+    def after_resource_delete(self, context, resources):
+        _get_ownership_index().invalidate(resources)
+
+    # CKAN < 2.10 uses the same hook names for datasets and resources
+
+    def after_create(self, context, data_dict):
+        _get_ownership_index().invalidate(data_dict)
+
+    def after_update(self, context, data_dict):
+        _get_ownership_index().invalidate(data_dict)
+
+    def before_delete(self, context, resource, resources):
+        _get_ownership_index().invalidate_resource(resource.get('id'))
+
+    def after_delete(self, context, data_dict):
+        _get_ownership_index().invalidate(data_dict)
+
     # IAuthorizationBindings
 
     def register_authz_bindings(self, authorizer):
+        from ckanext.authz_service.authz_binding import default_authz_bindings
         default_authz_bindings(authorizer)
 
 
@@ -38,3 +113,108 @@ def init_authorizer():
             plugin.register_authz_bindings(authorizer)
 
     return authorizer
+
+
+def get_authorizer():
+    # type: () -> Authzzie
+    """Get the shared, frozen authorizer, initializing it on first use
+    """
+    global _authorizer
+    if _authorizer is None:
+        from ckanext.authz_service import actions
+        authorizer = init_authorizer()
+        if util.get_config_bool('single_flight', True):
+            authorizer.set_single_flight(actions.get_single_flight(), actions.get_caller_key)
+        authorizer_timeout = util.get_config_int('authorizer_timeout_ms', 0)
+        authorizer.set_time_limits(authorizer_timeout / 1000.0 if authorizer_timeout > 0 else None,
+                                   actions.get_circuit_breaker())
+        authorizer.freeze()
+        _authorizer = authorizer
+    return _authorizer
+
+
+def warm_up():
+    # type: () -> None
+    """Prepare this extension to handle requests
+
+    This builds and freezes the authorizer registry, and reads and parses
+    JWT keys (which also loads `jwt` and `cryptography`), so that the first
+    request handled by a worker is not slowed down by these. It is called
+    when the plugin is configured, unless `ckanext.authz_service.warm_up_on_load`
+    is set to `false`. When the app is loaded before forking workers, this
+    happens once in the master process, and workers share the result;
+    Otherwise, it can be called from a WSGI server's worker start hook (e.g.
+    gunicorn's `post_fork` or uWSGI's `@postfork`).
+
+    If `ckanext.authz_service.gc_freeze` is set, all objects allocated so far
+    are moved to the garbage collector's permanent generation. When called
+    before forking workers, this prevents garbage collection in the workers
+    from dirtying (and thus copying) memory pages shared with the parent.
+    """
+    get_authorizer()
+    keys.load_keys()
+
+    if util.get_config_bool('gc_freeze', False) and hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+
+
+def configure_tracing():
+    # type: () -> None
+    """Set the tracer used for authorization spans, as configured by `ckanext.authz_service.tracing`
+    """
+    tracing.set_tracer(tracing.create_tracer(
+        util.get_config('tracing', 'none'),
+        otlp_endpoint=util.get_config('tracing_otlp_endpoint', tracing.DEFAULT_OTLP_ENDPOINT),
+        service_name=util.get_config('tracing_service_name', tracing.DEFAULT_SERVICE_NAME)))
+
+
+def reset():
+    # type: () -> None
+    """Discard the shared authorizer, cached keys, cache backends, ownership index, replay detection,
+    single-flight state, rate limiters, circuit breaker and audit log
+
+    They will be recreated on next use. Modules imported on first use are
+    only reset if already imported, so that resetting does not import them.
+    """
+    global _authorizer
+    _authorizer = None
+    keys.clear_cache()
+    cache.reset_backends()
+    verifier.reset_replay_detector()
+    audit.reset_audit_log()
+
+    actions = sys.modules.get('ckanext.authz_service.actions')
+    if actions is not None:
+        actions.reset_single_flight()
+        actions.reset_rate_limiters()
+        actions.reset_time_limits()
+    ownership = sys.modules.get('ckanext.authz_service.authz_binding.ownership')
+    if ownership is not None:
+        ownership.reset_ownership_index()
+
+
+def _tracks_membership_changes():
+    # type: () -> bool
+    """Tell if any enabled feature depends on the membership change counter (see `authz_binding.snapshot`)
+    """
+    return (util.get_config_bool('permission_snapshots', False) or
+            util.get_config_bool('refresh_reuse_scopes', False) or
+            util.get_config_int('decision_cache_ttl', 0) > 0)
+
+
+def _get_ownership_index():
+    # type: () -> Any
+    from ckanext.authz_service.authz_binding import ownership
+    return ownership.get_ownership_index()
+
+
+def _with_authorizer(action):
+    # type: (Callable) -> Callable
+    """Wrap an action function that expects an authorizer as its first argument
+    """
+    @wraps(action)
+    def action_with_authorizer(context, data_dict):
+        return action(get_authorizer(), context, data_dict)
+
+    return action_with_authorizer
@@ -0,0 +1,68 @@
+"""SQL query counting
+
+A single SQLAlchemy event listener, registered on first use for all engines,
+records each SQL statement executed by a thread in all `QueryCounter`
+instances active in that thread. This is used to report the number of
+queries made to handle an `authorize` request (see the `debug` parameter),
+and by tests to keep the number of queries made by authorization bindings
+within budget.
+
+While no counter is active, the listener only checks a thread local list.
+"""
+import threading
+from typing import Any, List
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+_listening = False
+
+
+class QueryCounter(object):
+    """Context manager recording SQL statements executed by the current thread while it is active
+    """
+
+    def __init__(self):
+        # type: () -> None
+        self.statements = []  # type: List[str]
+
+    @property
+    def count(self):
+        # type: () -> int
+        return len(self.statements)
+
+    def __enter__(self):
+        # type: () -> QueryCounter
+        listen_for_queries()
+        _get_active_counters().append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        # type: (*Any) -> None
+        _get_active_counters().remove(self)
+
+
+def listen_for_queries():
+    # type: () -> None
+    """Register the SQLAlchemy event listener recording executed statements, if not already registered
+    """
+    global _listening
+    if _listening:
+        return
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    _listening = True
+
+
+def _get_active_counters():
+    # type: () -> List[QueryCounter]
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = []
+    return counters
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    for counter in getattr(_local, 'counters', ()):
+        counter.statements.append(statement)
@@ -0,0 +1,157 @@
+"""Cost based rate limiting
+
+The cost of an authorization request is estimated from its requested scopes,
+before any of them is evaluated: each scope costs a configurable amount per
+entity type, multiplied if its entity ref is a wildcard (as these are
+typically more expensive to evaluate) and increased if it has a subscope.
+Multi-reference scopes cost as much as a scope for each entity they refer
+to.
+
+Costs are then taken from token buckets, which hold up to `burst` tokens and
+are refilled at `rate` tokens per second. Bucket state is kept in a cache
+backend (see `cache`); When using a backend shared by multiple processes,
+buckets are shared as well, but concurrent updates from different processes
+are not atomic, so limits are approximate.
+
+This module does not depend on CKAN.
+"""
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from .authzzie import Scope
+
+DEFAULT_TYPE_COSTS = 'org:1 ds:1 res:2'
+
+DEFAULT_WILDCARD_FACTOR = 10
+
+DEFAULT_SUBSCOPE_COST = 1
+
+
+class CostModel(object):
+    """Estimate the cost of evaluating scopes
+
+    >>> model = CostModel({'res': 2}, wildcard_factor=10)
+    >>> model.scope_cost(Scope.from_string('ds:foo/bar:read'))
+    1
+    >>> model.scope_cost(Scope.from_string('res:foo/bar/*:read'))
+    20
+    >>> model.scope_cost(Scope.from_string('res:foo/bar/{a,b,c}:read'))
+    6
+    >>> model.request_cost([Scope.from_string('org:foo:read'), Scope.from_string('ds:foo/bar:read')])
+    2
+    """
+
+    def __init__(self, type_costs=None, default_type_cost=1, wildcard_factor=DEFAULT_WILDCARD_FACTOR,
+                 subscope_cost=DEFAULT_SUBSCOPE_COST):
+        # type: (Optional[Dict[str, int]], int, int, int) -> None
+        self._type_costs = type_costs or {}
+        self._default_type_cost = default_type_cost
+        self._wildcard_factor = wildcard_factor
+        self._subscope_cost = subscope_cost
+
+    @staticmethod
+    def parse_type_costs(type_costs_str):
+        # type: (str) -> Dict[str, int]
+        """Parse a space separated list of `<entity type>:<cost>` pairs
+
+        >>> CostModel.parse_type_costs('org:1 res:3')
+        {'org': 1, 'res': 3}
+        """
+        costs = {}
+        for pair in type_costs_str.split():
+            entity_type, _, cost = pair.rpartition(':')
+            costs[entity_type] = int(cost)
+        return costs
+
+    def scope_cost(self, scope):
+        # type: (Scope) -> int
+        """Estimate the cost of evaluating a single scope
+        """
+        cost = self._type_costs.get(scope.entity_type, self._default_type_cost)
+        if not scope.entity_ref or '*' in scope.entity_ref:
+            cost *= self._wildcard_factor
+        if scope.subscope:
+            cost += self._subscope_cost
+        return cost * len(scope.entity_refs)
+
+    def request_cost(self, scopes):
+        # type: (Iterable[Scope]) -> int
+        """Estimate the cost of evaluating a list of scopes
+        """
+        return sum(self.scope_cost(scope) for scope in scopes)
+
+
+class TokenBucketLimiter(object):
+    """Token bucket rate limiter, keeping bucket state in a cache backend
+
+    A missing bucket is full; Buckets are stored with a TTL equal to the time
+    it takes them to refill, so that idle buckets do not take up space.
+    """
+
+    def __init__(self, backend, rate, burst, clock=time.time):
+        # type: (Any, float, float, Callable[[], float]) -> None
+        self._backend = backend
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._stats = {"admitted": 0, "rejected": 0}
+
+    @property
+    def burst(self):
+        # type: () -> float
+        return self._burst
+
+    def consume(self, key, cost=1):
+        # type: (str, float) -> float
+        """Take `cost` tokens from a bucket
+
+        Returns 0 if there were enough tokens, or the number of seconds until
+        there will be (which is infinite if `cost` is higher than `burst`)
+        otherwise, in which case no tokens are taken.
+        """
+        with self._lock:
+            now = self._clock()
+            tokens = self._get_tokens(key, now)
+            if cost > tokens:
+                self._stats['rejected'] += 1
+                if cost > self._burst or self._rate <= 0:
+                    return math.inf
+                return (cost - tokens) / self._rate
+
+            self._stats['admitted'] += 1
+            self._set_tokens(key, tokens - cost, now)
+            return 0.0
+
+    def refund(self, key, cost):
+        # type: (str, float) -> None
+        """Return tokens taken from a bucket
+        """
+        with self._lock:
+            now = self._clock()
+            self._set_tokens(key, min(self._get_tokens(key, now) + cost, self._burst), now)
+
+    def stats(self):
+        # type: () -> Dict[str, int]
+        """Get the number of `admitted` and `rejected` requests
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _get_tokens(self, key, now):
+        # type: (str, float) -> float
+        state = self._backend.get(key)
+        if state is None:
+            return self._burst
+        tokens, updated = state
+        return min(self._burst, tokens + max(now - updated, 0) * self._rate)
+
+    def _set_tokens(self, key, tokens, now):
+        # type: (str, float, float) -> None
+        ttl = (self._burst - tokens) / self._rate if self._rate > 0 else None
+        if ttl is not None and ttl <= 0:
+            self._backend.delete(key)
+        else:
+            self._backend.set(key, [tokens, now], ttl)
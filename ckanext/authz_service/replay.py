@@ -0,0 +1,208 @@
+"""Bounded memory token replay detection
+
+This module does not depend on CKAN, and can be used by token consumers as
+well as by the `authz_verify` action.
+
+Token IDs (the `jti` claim) are remembered in time buckets, each covering a
+period equal to the maximal token lifetime. As a token is never valid for
+longer than that, only the current and previous buckets need to be kept, so
+memory use is bounded no matter how many tokens are seen. Each bucket holds an
+exact set of token IDs up to a configured capacity, and then falls back to a
+fixed size Bloom filter, trading a small chance of false positives for bounded
+memory.
+
+Each worker process has its own `ReplayDetector`, so with N worker processes
+a token can be replayed once per process. When replay detection must hold
+across processes, a `SharedReplayDetector` keeps seen token IDs in a shared
+cache backend (see `cache`) instead: each ID is stored as a single entry,
+added atomically and expiring along with the token.
+"""
+import hashlib
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+
+from .cache import CacheBackend
+
+DEFAULT_CAPACITY = 100000
+
+# Bloom filters are sized to hold this many times the exact capacity
+BLOOM_CAPACITY_FACTOR = 10
+
+DEFAULT_ERROR_RATE = 0.001
+
+
+class BloomFilter(object):
+    """Simple fixed size Bloom filter
+
+    >>> f = BloomFilter(1000, 0.01)
+    >>> f.add('foo')
+    >>> 'foo' in f
+    True
+    >>> 'bar' in f
+    False
+    """
+
+    def __init__(self, capacity, error_rate=DEFAULT_ERROR_RATE):
+        # type: (int, float) -> None
+        bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self._size = max(bits, 8)
+        self._hashes = max(int(round(self._size / capacity * math.log(2))), 1)
+        self._bits = bytearray(int(math.ceil(self._size / 8.0)))
+
+    def add(self, item):
+        # type: (str) -> None
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def _positions(self, item):
+        # type: (str) -> Iterable[int]
+        """Calculate bit positions for an item using double hashing
+        """
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self._size for i in range(self._hashes))
+
+
+class _Bucket(object):
+    """A set of token IDs, falling back to a Bloom filter once it reaches capacity
+    """
+
+    def __init__(self, capacity, error_rate):
+        # type: (int, float) -> None
+        self._capacity = capacity
+        self._error_rate = error_rate
+        self._exact = set()  # type: Optional[Set[str]]
+        self._bloom = None  # type: Optional[BloomFilter]
+
+    def add(self, item):
+        # type: (str) -> None
+        if self._bloom is not None:
+            self._bloom.add(item)
+            return
+
+        self._exact.add(item)
+        if len(self._exact) > self._capacity:
+            self._bloom = BloomFilter(self._capacity * BLOOM_CAPACITY_FACTOR, self._error_rate)
+            for i in self._exact:
+                self._bloom.add(i)
+            self._exact = None
+
+    def __contains__(self, item):
+        if self._bloom is not None:
+            return item in self._bloom
+        return item in self._exact
+
+
+class _BaseReplayDetector(object):
+
+    def is_replayed(self, jti, expires_at=None, record=True):
+        # type: (str, Optional[float], bool) -> bool
+        raise NotImplementedError('Replay detectors must implement is_replayed()')
+
+    def is_payload_replayed(self, payload, record=True):
+        # type: (Dict[str, Any], bool) -> bool
+        """Check if a decoded token payload was already seen
+
+        Tokens with no `jti` claim can't be tracked, and are always considered
+        to be replayed.
+        """
+        jti = payload.get('jti')
+        if not jti:
+            return True
+        return self.is_replayed(str(jti), payload.get('exp'), record)
+
+
+class ReplayDetector(_BaseReplayDetector):
+    """Detect replayed token IDs in bounded memory
+
+    `max_lifetime` is the maximal lifetime of tokens in seconds, and should
+    match the `jwt_max_lifetime` setting of the token issuer. Up to `capacity`
+    token IDs per `max_lifetime` period are remembered exactly; Beyond that, a
+    Bloom filter sized for `BLOOM_CAPACITY_FACTOR` times as many IDs with the
+    given false positive `error_rate` is used.
+
+    >>> detector = ReplayDetector(900)
+    >>> detector.is_replayed('token-1')
+    False
+    >>> detector.is_replayed('token-1')
+    True
+    """
+
+    def __init__(self, max_lifetime, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE, clock=time.time):
+        # type: (int, int, float, Callable[[], float]) -> None
+        self._period = max(int(max_lifetime), 1)
+        self._capacity = capacity
+        self._error_rate = error_rate
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._current = _Bucket(capacity, error_rate)
+        self._previous = None  # type: Optional[_Bucket]
+        self._current_period = self._get_period()
+
+    def is_replayed(self, jti, expires_at=None, record=True):
+        # type: (str, Optional[float], bool) -> bool
+        """Check if a token ID was already seen, and unless `record` is `False`, remember it as seen
+
+        `expires_at` is not used, as token IDs are kept for the maximal token
+        lifetime.
+        """
+        with self._lock:
+            self._rotate()
+            if jti in self._current or (self._previous is not None and jti in self._previous):
+                return True
+            if record:
+                self._current.add(jti)
+            return False
+
+    def _get_period(self):
+        # type: () -> int
+        return int(self._clock() // self._period)
+
+    def _rotate(self):
+        # type: () -> None
+        """Rotate buckets if one or more periods have passed since the current bucket was created
+        """
+        period = self._get_period()
+        if period == self._current_period:
+            return
+
+        if period == self._current_period + 1:
+            self._previous = self._current
+        else:
+            self._previous = None
+        self._current = _Bucket(self._capacity, self._error_rate)
+        self._current_period = period
+
+
+class SharedReplayDetector(_BaseReplayDetector):
+    """Detect replayed token IDs using a cache backend, which may be shared between processes
+
+    Seen token IDs are kept until the token expires, or for `max_lifetime`
+    seconds if the expiry time is not known.
+    """
+
+    def __init__(self, backend, max_lifetime, clock=time.time):
+        # type: (CacheBackend, int, Callable[[], float]) -> None
+        self._backend = backend
+        self._max_lifetime = max(int(max_lifetime), 1)
+        self._clock = clock
+
+    def is_replayed(self, jti, expires_at=None, record=True):
+        # type: (str, Optional[float], bool) -> bool
+        """Check if a token ID was already seen, and unless `record` is `False`, remember it as seen
+
+        `expires_at` is the token's expiry time as a UNIX timestamp.
+        """
+        if not record:
+            return self._backend.get('jti:{}'.format(jti)) is not None
+        if expires_at is None:
+            ttl = self._max_lifetime  # type: float
+        else:
+            ttl = min(max(expires_at - self._clock(), 1), self._max_lifetime)
+        return not self._backend.add('jti:{}'.format(jti), 1, ttl)
@@ -0,0 +1,92 @@
+"""Token revocation
+
+Revoked tokens are tracked in a cache backend (see `cache`), so that
+revocations can be shared between worker processes. Each revocation is stored
+as a single cache entry, keyed either by token ID (`jti`) or by subject
+(`sub`), and expires once all tokens it could apply to have expired; Thus, the
+revocation list never grows beyond the number of revocations made within the
+maximal token lifetime, and checking a token takes a single cache lookup.
+
+This module does not depend on CKAN.
+"""
+import time
+from typing import Any, Dict, Optional
+
+from .cache import CacheBackend
+
+
+class RevocationList(object):
+    """List of revoked tokens and subjects
+    """
+
+    def __init__(self, backend, max_lifetime, clock=time.time):
+        # type: (CacheBackend, int, Any) -> None
+        self._backend = backend
+        self._max_lifetime = max_lifetime
+        self._clock = clock
+
+    def revoke_token(self, jti, expires_at=None):
+        # type: (str, Optional[float]) -> None
+        """Revoke a single token by its ID
+
+        `expires_at` is the token's expiry time as a UNIX timestamp; If not
+        known, the revocation is kept for the maximal token lifetime.
+        """
+        self._backend.set(_jti_key(jti), 1, self._get_ttl(expires_at))
+
+    def revoke_subject(self, subject, issued_before=None):
+        # type: (str, Optional[float]) -> None
+        """Revoke all tokens issued to a subject before a given UNIX timestamp (or now)
+        """
+        now = self._clock()
+        issued_before = min(issued_before, now) if issued_before is not None else now
+        key = _subject_key(subject)
+        current = self._backend.get(key)
+        if current is not None and current >= issued_before:
+            return
+        # Tokens issued before `issued_before` all expire by `issued_before + max_lifetime`
+        self._backend.set(key, issued_before, self._get_ttl(issued_before + self._max_lifetime))
+
+    def is_revoked(self, payload):
+        # type: (Dict[str, Any]) -> bool
+        """Check if a decoded token payload has been revoked
+
+        Tokens derived from another token (see the `downscope` action) are
+        also revoked if their parent token, identified by the `parent_jti`
+        claim, has been revoked.
+        """
+        token_ids = [str(payload[claim]) for claim in ('jti', 'parent_jti') if payload.get(claim)]
+        subject = payload.get('sub')
+        keys = [_jti_key(jti) for jti in token_ids]
+        if subject:
+            keys.append(_subject_key(subject))
+        if not keys:
+            return False
+
+        revoked = self._backend.get_many(keys)
+        if any(_jti_key(jti) in revoked for jti in token_ids):
+            return True
+
+        if subject and _subject_key(subject) in revoked:
+            issued_at = payload.get('iat', payload.get('nbf'))
+            return issued_at is None or issued_at <= revoked[_subject_key(subject)]
+
+        return False
+
+    def _get_ttl(self, expires_at):
+        # type: (Optional[float]) -> float
+        """Get the TTL for a revocation entry, based on when the tokens it applies to expire
+        """
+        if expires_at is None:
+            return self._max_lifetime
+        return max(expires_at - self._clock(), 1)
+
+
+def _jti_key(jti):
+    # type: (str) -> str
+    return 'jti:{}'.format(jti)
+
+
+def _subject_key(subject):
+    # type: (str) -> str
+    return 'sub:{}'.format(subject)
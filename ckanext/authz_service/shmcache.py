@@ -0,0 +1,350 @@
+"""Shared memory cache backend
+
+A cache backend storing entries in a memory mapped file, so that all worker
+processes on a host share them without running a separate cache server.
+Placing the file on a memory backed file system (such as `/dev/shm`, the
+default) keeps it from ever being written to disk.
+
+The file holds a fixed size, open addressed hash table of fixed size slots.
+Each key may be stored in any of `PROBE_LENGTH` consecutive slots starting at
+the slot its hash maps to; Lookups check all of these, so deleted entries
+simply leave empty slots behind. When all slots for a key are taken, an
+expired entry is replaced, or otherwise the least recently set entry that has
+a TTL. Entries without a TTL (such as counters) are only evicted if all slots
+are taken by such entries.
+
+Reads are lock free: each slot has a version number, which writers make odd
+while changing the slot and even again once done (a "seqlock"); Readers copy
+the slot and retry if its version was odd or changed meanwhile. Writers are
+serialized by a lock on the file, shared by all processes, and a lock shared
+by all threads of each process.
+
+Values are stored as JSON, and entries whose key and value do not fit in a
+slot are not stored at all. This module does not depend on CKAN.
+"""
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .cache import CacheBackend
+
+MAGIC = b'AZSC'
+
+FORMAT_VERSION = 1
+
+DEFAULT_SLOTS = 65536
+
+DEFAULT_SLOT_SIZE = 1024
+
+PROBE_LENGTH = 8
+
+READ_RETRIES = 100
+
+# File header: magic, format version, number of slots, slot size
+_FILE_HEADER = struct.Struct('<4sIII')
+_FILE_HEADER_SIZE = 64
+
+# Slot header: version, key hash (0 if empty), expiry time (0 if none), time set, key length, value length
+_SLOT_HEADER = struct.Struct('<IQddHI')
+_VERSION = struct.Struct('<I')
+
+_tables = {}  # type: Dict[str, SharedTable]
+_tables_lock = threading.Lock()
+
+
+class SharedTable(object):
+    """Fixed size hash table in a memory mapped file, shared by all processes mapping the same file
+    """
+
+    def __init__(self, path, slots=DEFAULT_SLOTS, slot_size=DEFAULT_SLOT_SIZE, clock=time.time):
+        # type: (str, int, int, Callable[[], float]) -> None
+        if slot_size <= _SLOT_HEADER.size:
+            raise ValueError("Slot size must be larger than {} bytes".format(_SLOT_HEADER.size))
+        self.path = path
+        self.slots = max(int(slots), PROBE_LENGTH)
+        self.slot_size = int(slot_size)
+        self._clock = clock
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._pid = os.getpid()
+        self._thread_lock = threading.Lock()
+        with self._locked():
+            self._init_file()
+        self._mmap = mmap.mmap(self._fd, _FILE_HEADER_SIZE + self.slots * self.slot_size)
+
+    def get(self, key):
+        # type: (bytes) -> Optional[bytes]
+        """Get the value stored for a key, or `None` if it is not set or has expired
+        """
+        key_hash = _hash(key)
+        now = self._clock()
+        for index in self._probe(key_hash):
+            slot = self._read_slot(index, key_hash)
+            if slot is not None and slot[0] == key:
+                expires_at, value = slot[1], slot[2]
+                return value if not expires_at or expires_at > now else None
+        return None
+
+    def set(self, key, value, ttl=None):
+        # type: (bytes, bytes, Optional[float]) -> bool
+        """Store a value for a key, returning `False` if it is too large to store
+        """
+        if _SLOT_HEADER.size + len(key) + len(value) > self.slot_size:
+            return False
+        now = self._clock()
+        with self._locked():
+            key_hash = _hash(key)
+            index = self._find_slot_to_set(key, key_hash, now)
+            self._write_slot(index, key_hash, key, value, now + ttl if ttl is not None else 0.0, now)
+        return True
+
+    def add(self, key, value, ttl=None):
+        # type: (bytes, bytes, Optional[float]) -> bool
+        """Atomically store a value for a key unless it is already set, returning `False` if it was set
+
+        Values too large to store are not stored, and the key is reported as not set.
+        """
+        if _SLOT_HEADER.size + len(key) + len(value) > self.slot_size:
+            return self.get(key) is None
+        now = self._clock()
+        with self._locked():
+            if self.get(key) is not None:
+                return False
+            key_hash = _hash(key)
+            index = self._find_slot_to_set(key, key_hash, now)
+            self._write_slot(index, key_hash, key, value, now + ttl if ttl is not None else 0.0, now)
+        return True
+
+    def incr(self, key):
+        # type: (bytes) -> int
+        """Atomically increment an integer counter stored as JSON, and return its new value
+        """
+        now = self._clock()
+        with self._locked():
+            key_hash = _hash(key)
+            current = self.get(key)
+            value = (json.loads(current.decode('utf-8')) if current is not None else 0) + 1
+            index = self._find_slot_to_set(key, key_hash, now)
+            self._write_slot(index, key_hash, key, str(value).encode('ascii'), 0.0, now)
+        return value
+
+    def delete(self, key):
+        # type: (bytes) -> None
+        with self._locked():
+            key_hash = _hash(key)
+            for index in self._probe(key_hash):
+                slot = self._read_slot(index, key_hash)
+                if slot is not None and slot[0] == key:
+                    self._write_slot(index, 0, b'', b'', 0.0, 0.0)
+
+    def delete_prefix(self, prefix):
+        # type: (bytes) -> None
+        """Delete all entries with keys starting with a prefix
+        """
+        with self._locked():
+            for index, key, _ in self.scan():
+                if key.startswith(prefix):
+                    self._write_slot(index, 0, b'', b'', 0.0, 0.0)
+
+    def scan(self):
+        # type: () -> Iterator[Tuple[int, bytes, float]]
+        """Iterate over all entries that have not expired, as (slot index, key, expiry time) tuples
+        """
+        now = self._clock()
+        for index in range(self.slots):
+            slot = self._read_slot(index)
+            if slot is not None and (not slot[1] or slot[1] > now):
+                yield index, slot[0], slot[1]
+
+    def _init_file(self):
+        # type: () -> None
+        """Initialize an empty file, or check that an existing file has the expected structure
+        """
+        size = _FILE_HEADER_SIZE + self.slots * self.slot_size
+        header = os.pread(self._fd, _FILE_HEADER.size, 0)
+        if len(header) < _FILE_HEADER.size:
+            os.ftruncate(self._fd, size)
+            os.pwrite(self._fd, _FILE_HEADER.pack(MAGIC, FORMAT_VERSION, self.slots, self.slot_size), 0)
+            return
+
+        magic, version, slots, slot_size = _FILE_HEADER.unpack(header)
+        if (magic, version, slots, slot_size) != (MAGIC, FORMAT_VERSION, self.slots, self.slot_size):
+            raise ValueError("Shared cache file {} has a different structure ({} slots of {} bytes) than "
+                             "configured".format(self.path, slots, slot_size))
+
+    def _probe(self, key_hash):
+        # type: (int) -> List[int]
+        start = key_hash % self.slots
+        return [(start + i) % self.slots for i in range(PROBE_LENGTH)]
+
+    def _find_slot_to_set(self, key, key_hash, now):
+        # type: (bytes, int, float) -> int
+        """Find the slot to store a key in: its current slot, an empty or expired one, or the one to evict
+        """
+        # The key may be stored past an empty or expired slot, so look for it in all slots first
+        slots = [(index, self._read_slot(index)) for index in self._probe(key_hash)]
+        for index, slot in slots:
+            if slot is not None and slot[0] == key:
+                return index
+
+        candidates = []
+        for index, slot in slots:
+            if slot is None:
+                return index
+            expires_at, stored_at = slot[1], slot[3]
+            if expires_at and expires_at <= now:
+                return index
+            # Prefer evicting entries with a TTL, least recently set first
+            candidates.append((not expires_at, stored_at, index))
+        return min(candidates)[2]
+
+    def _read_slot(self, index, key_hash=None):
+        # type: (int, Optional[int]) -> Optional[Tuple[bytes, float, bytes, float]]
+        """Read a consistent copy of a slot, as (key, expiry time, value, time set), or `None` if it is empty
+
+        If `key_hash` is provided, `None` is also returned if the slot holds a
+        key with a different hash.
+        """
+        offset = _FILE_HEADER_SIZE + index * self.slot_size
+        for _ in range(READ_RETRIES):
+            version = _VERSION.unpack_from(self._mmap, offset)[0]
+            if version & 1:
+                continue
+            header = _SLOT_HEADER.unpack_from(self._mmap, offset)
+            slot_hash, expires_at, stored_at, key_length, value_length = header[1:]
+            if slot_hash == 0 or (key_hash is not None and slot_hash != key_hash):
+                slot = None
+            else:
+                data_offset = offset + _SLOT_HEADER.size
+                key_end = data_offset + key_length
+                slot = (self._mmap[data_offset:key_end], expires_at,
+                        self._mmap[key_end:key_end + value_length], stored_at)
+            if _VERSION.unpack_from(self._mmap, offset)[0] == version:
+                return slot
+        return None
+
+    def _write_slot(self, index, key_hash, key, value, expires_at, stored_at):
+        # type: (int, int, bytes, bytes, float, float) -> None
+        """Write a slot; Must be called while holding the write lock
+        """
+        offset = _FILE_HEADER_SIZE + index * self.slot_size
+        version = _VERSION.unpack_from(self._mmap, offset)[0]
+        _VERSION.pack_into(self._mmap, offset, (version + 1) & 0xffffffff)
+        _SLOT_HEADER.pack_into(self._mmap, offset, (version + 1) & 0xffffffff, key_hash, expires_at, stored_at,
+                               len(key), len(value))
+        data_offset = offset + _SLOT_HEADER.size
+        self._mmap[data_offset:data_offset + len(key) + len(value)] = key + value
+        _VERSION.pack_into(self._mmap, offset, (version + 2) & 0xffffffff)
+
+    @contextmanager
+    def _locked(self):
+        # type: () -> Iterator[None]
+        """Hold the write lock, shared by all threads and processes
+        """
+        if self._pid != os.getpid():
+            # The lock may have been held by another thread when the process was forked
+            self._thread_lock = threading.Lock()
+            self._pid = os.getpid()
+        with self._thread_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1)
+
+
+class MmapCacheBackend(CacheBackend):
+    """Cache backend storing entries in a shared memory table, shared by all processes on a host
+
+    Multiple namespaces can share a table; Hits, misses and values too large
+    to store are counted per process.
+    """
+
+    shared = True
+
+    def __init__(self, namespace, table, key_prefix='ckanext.authz_service'):
+        # type: (str, SharedTable, str) -> None
+        self._table = table
+        self._prefix = '{}:{}:'.format(key_prefix, namespace).encode('utf-8')
+        self._hits = 0
+        self._misses = 0
+        self._oversized = 0
+
+    def get(self, key):
+        # type: (str) -> Any
+        value = self._table.get(self._key(key))
+        if value is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        return json.loads(value.decode('utf-8'))
+
+    def set(self, key, value, ttl=None):
+        # type: (str, Any, Optional[float]) -> None
+        if not self._table.set(self._key(key), json.dumps(value).encode('utf-8'), ttl):
+            self._oversized += 1
+            # Do not leave a previous value in place
+            self._table.delete(self._key(key))
+
+    def add(self, key, value, ttl=None):
+        # type: (str, Any, Optional[float]) -> bool
+        return self._table.add(self._key(key), json.dumps(value).encode('utf-8'), ttl)
+
+    def incr(self, key):
+        # type: (str) -> int
+        return self._table.incr(self._key(key))
+
+    def delete(self, key):
+        # type: (str) -> None
+        self._table.delete(self._key(key))
+
+    def clear(self):
+        # type: () -> None
+        self._table.delete_prefix(self._prefix)
+
+    def stats(self):
+        # type: () -> Dict[str, Any]
+        """Get the number of entries in this namespace, and this process's hit, miss and oversized value counts
+        """
+        lookups = self._hits + self._misses
+        return {"entries": sum(1 for _, key, _ in self._table.scan() if key.startswith(self._prefix)),
+                "slots": self._table.slots,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": float(self._hits) / lookups if lookups else None,
+                "oversized": self._oversized}
+
+    def _key(self, key):
+        # type: (str) -> bytes
+        return self._prefix + key.encode('utf-8')
+
+
+def get_shared_table(path, slots=DEFAULT_SLOTS, slot_size=DEFAULT_SLOT_SIZE):
+    # type: (str, int, int) -> SharedTable
+    """Get the shared table for a file, opening it once per process
+    """
+    with _tables_lock:
+        if path not in _tables:
+            _tables[path] = SharedTable(path, slots, slot_size)
+        return _tables[path]
+
+
+def default_path():
+    # type: () -> str
+    """Get the default shared table file path, on a memory backed file system if available
+    """
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else os.environ.get('TMPDIR', '/tmp')
+    return os.path.join(directory, 'ckanext-authz-service-cache')
+
+
+def _hash(key):
+    # type: (bytes) -> int
+    """Hash a key into a non-zero 64 bit integer
+    """
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') or 1
@@ -0,0 +1,106 @@
+"""Single-flight execution of concurrent identical work
+
+When multiple threads request the same work (identified by a key) at the same
+time, only the first one ("the leader") actually does it; The others wait for
+it to complete and share its result, or have its exception re-raised. Results
+are not cached: once the work is done, the next call with the same key will
+do it again.
+
+Waiting is limited by a timeout; A thread that times out while waiting stops
+waiting and does the work itself, so a slow or stuck leader can only delay
+other threads, not fail them.
+
+This module does not depend on CKAN.
+"""
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+DEFAULT_TIMEOUT = 10
+
+
+class _Call(object):
+    """An in-flight call
+    """
+
+    __slots__ = ('owner', 'done', 'result', 'error')
+
+    def __init__(self):
+        self.owner = threading.get_ident()
+        self.done = threading.Event()
+        self.result = None  # type: Any
+        self.error = None  # type: Optional[BaseException]
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls with the same key into a single call
+
+    >>> flight = SingleFlight()
+    >>> flight.do('key', lambda x: x * 2, 21)
+    42
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        # type: (Optional[float]) -> None
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._calls = {}  # type: Dict[Hashable, _Call]
+        self._stats = {"calls": 0, "shared": 0, "timeouts": 0}
+
+    def do(self, key, func, *args, **kwargs):
+        # type: (Hashable, Callable[..., Any], Any, Any) -> Any
+        """Call `func` with the given arguments, unless a call with the same key is in flight
+
+        If a call with the same key is in flight in another thread, wait for
+        it and return its result or re-raise its exception instead.
+        """
+        with self._lock:
+            self._stats['calls'] += 1
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                leader = False
+
+        if leader:
+            return self._lead(key, call, func, *args, **kwargs)
+
+        if call.owner == threading.get_ident():
+            # A re-entrant call from the leading thread; Waiting for itself would only time out
+            return func(*args, **kwargs)
+
+        if call.done.wait(self._timeout):
+            with self._lock:
+                self._stats['shared'] += 1
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        with self._lock:
+            self._stats['timeouts'] += 1
+        return func(*args, **kwargs)
+
+    def stats(self):
+        # type: () -> Dict[str, int]
+        """Get call counters: total `calls`, calls that `shared` another call's result, and wait `timeouts`
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls)
+        return stats
+
+    def _lead(self, key, call, func, *args, **kwargs):
+        # type: (Hashable, _Call, Callable[..., Any], Any, Any) -> Any
+        """Do the work for a call, and publish its result or exception to waiting threads
+        """
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
@@ -1,8 +1,9 @@
 from contextlib import contextmanager
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Union
+from unittest.mock import patch
 
 from ckan import model
-from unittest.mock import patch
+from sqlalchemy import orm
 
 ANONYMOUS_USER = None
 
@@ -30,6 +31,27 @@ def user_context(user, ignore_auth=False):
         yield context
 
 
+def change_dataset_elsewhere(id, **values):
+    # type: (str, Any) -> None
+    """Change a dataset's columns as another worker process would, bypassing
+    plugin hooks and the current DB session, then end the current session
+    """
+    session = orm.Session(bind=model.Session.get_bind())
+    session.execute(model.package_table.update().where(model.package_table.c.id == id).values(**values))
+    session.commit()
+    session.close()
+    model.Session.remove()
+
+
+def tamper_token(token):
+    # type: (Union[str, bytes]) -> str
+    """Get a copy of a JWT token with an invalid signature
+    """
+    if isinstance(token, bytes):
+        token = token.decode('ascii')
+    return token[:-4] + ('BBBB' if token.endswith('AAAA') else 'AAAA')
+
+
 @contextmanager
 def temporary_file(content):
     # type: (str) -> str
@@ -0,0 +1,27 @@
+import pytest
+from ckan.tests import helpers
+
+from ckanext.authz_service import cache
+from ckanext.authz_service.querycount import QueryCounter
+
+
+@pytest.fixture
+def query_counter():
+    """Record SQL statements executed by the test, e.g. to assert query budgets
+    """
+    with QueryCounter() as counter:
+        yield counter
+
+
+@pytest.fixture
+def shared_cache(tmp_path):
+    """Use a cache backend shared between processes, backed by a temporary file
+    """
+    with helpers.changed_config('ckanext.authz_service.cache_backend', 'mmap'), \
+            helpers.changed_config('ckanext.authz_service.cache_mmap_file', str(tmp_path / 'cache')), \
+            helpers.changed_config('ckanext.authz_service.cache_mmap_slots', 1024):
+        cache.reset_backends()
+        try:
+            yield
+        finally:
+            cache.reset_backends()
@@ -1,8 +1,15 @@
+from unittest import mock
+
 import jwt
 import pytest
 from ckan.plugins import toolkit
 from ckan.tests import factories, helpers
 
+from ckanext.authz_service import actions, audit, tracing, verifier
+from ckanext.authz_service.authz_binding import snapshot
+from ckanext.authz_service.authzzie import Scope
+from ckanext.authz_service.deadline import Deadline
+
 from . import ANONYMOUS_USER, temporary_file, user_context
 
 # RSA public key for testing purposes
@@ -107,6 +114,226 @@ class TestAuthorizeAction():
         assert [] == result['granted_scopes']
         assert result['user_id'] is None
 
+    def test_authorize_coalesces_granted_scopes(self):
+        """Test that granted scopes are coalesced into a minimal list by default
+        """
+        scopes = ['org:{}:read'.format(self.org['name']),
+                  'org:{}:update'.format(self.org['name']),
+                  'org:{}:read'.format(self.org['name'])]
+        with user_context(self.org_admin) as context:
+            result = helpers.call_action(
+                'authz_authorize',
+                context,
+                scopes=scopes)
+
+        expected = ['org:{}:read,update'.format(self.org['name'])]
+        assert scopes == result['requested_scopes']
+        assert expected == result['granted_scopes']
+        assert expected == _decode_jwt(result['token'])['scopes'].split(' ')
+        assert 3 == result['scopes_coalescing']['original_count']
+        assert 1 == result['scopes_coalescing']['coalesced_count']
+        assert len(expected[0]) == result['scopes_coalescing']['coalesced_size']
+
+    @helpers.change_config('ckanext.authz_service.coalesce_scopes', False)
+    def test_authorize_coalescing_can_be_disabled(self):
+        """Test that granted scopes are encoded verbatim if coalescing is disabled
+        """
+        scopes = ['org:{}:read'.format(self.org['name']),
+                  'org:{}:update'.format(self.org['name'])]
+        with user_context(self.org_admin) as context:
+            result = helpers.call_action(
+                'authz_authorize',
+                context,
+                scopes=scopes)
+
+        assert scopes == result['granted_scopes']
+        assert 'scopes_coalescing' not in result
+
+    def test_single_flight_key_identifies_identical_requests(self):
+        """Test that requests by the same user for the same scopes and lifetime bucket are identified as identical
+        """
+        scopes = [Scope.from_string(s) for s in ('ds:foo:read', 'org:bar:*')]
+        key = actions._get_single_flight_key({'user': 'alice'}, scopes, 900)
+        assert key == actions._get_single_flight_key({'user': 'alice'}, list(reversed(scopes)), 905)
+        assert key != actions._get_single_flight_key({'user': 'bob'}, scopes, 900)
+        assert key != actions._get_single_flight_key({'user': 'alice'}, scopes[:1], 900)
+        assert key != actions._get_single_flight_key({'user': 'alice'}, scopes, 300)
+
+    @helpers.change_config('ckanext.authz_service.single_flight', False)
+    def test_authorize_without_single_flight(self):
+        """Test that authorization works the same when single-flight is disabled
+        """
+        scopes = ['org:{}:read'.format(self.org['name'])]
+        with user_context(self.org_admin) as context:
+            result = helpers.call_action('authz_authorize', context, scopes=scopes)
+
+        assert scopes == result['granted_scopes']
+
+    def test_authorize_is_traced(self):
+        """Test that authorization creates nested spans for the request, scopes, authorizers and signing
+        """
+        tracer = tracing.InMemoryTracer()
+        tracing.set_tracer(tracer)
+        try:
+            with user_context(self.org_admin) as context:
+                helpers.call_action('authz_authorize', context, scopes=['org:{}:read'.format(self.org['name'])])
+        finally:
+            tracing.set_tracer(None)
+
+        request_span, = tracer.get_spans('authz.authorize')
+        scope_span, = tracer.get_spans('authz.scope')
+        authorizer_span = tracer.get_spans('authz.authorizer')[0]
+        check_access_span = tracer.get_spans('ckan.check_access')[0]
+        sign_span, = tracer.get_spans('authz.sign')
+        assert scope_span.parent is request_span
+        assert authorizer_span.parent is scope_span
+        assert check_access_span.parent is authorizer_span
+        assert sign_span.parent is request_span
+        assert scope_span.attributes['authz.entity_type'] == 'org'
+        assert scope_span.attributes['authz.granted_actions'] == 'read'
+        assert request_span.attributes['authz.granted'] is True
+
+    @helpers.change_config('ckanext.authz_service.audit_log', True)
+    @helpers.change_config('ckanext.authz_service.audit_log_sink',
+                           'ckanext.authz_service.tests.test_actions:create_audit_sink')
+    @helpers.change_config('ckanext.authz_service.jwt_include_token_id', True)
+    def test_authorize_is_audited(self):
+        """Test that an audit event is recorded for each issued token
+        """
+        audit.reset_audit_log()
+        scopes = ['org:{}:read'.format(self.org['name']), 'org:{}:delete'.format(self.org['name'])]
+        with user_context(self.org_member) as context:
+            result = helpers.call_action('authz_authorize', context, scopes=scopes)
+
+        audit.get_audit_log().flush()
+        event, = [e for batch in _audit_sink.batches for e in batch]
+        audit.reset_audit_log()
+
+        assert event['event'] == 'authorize'
+        assert event['user'] == self.org_member['name']
+        assert event['requested_scopes'] == scopes
+        assert event['granted_scopes'] == scopes[:1]
+        assert event['jti'] == jwt.decode(result['token'], verify=False)['jti']
+        assert event['expires_at'] == result['expires_at']
+        assert event['latency_ms'] >= 0
+
+    @helpers.change_config('ckanext.authz_service.rate_limit', True)
+    @helpers.change_config('ckanext.authz_service.rate_limit_user_burst', 3)
+    @helpers.change_config('ckanext.authz_service.rate_limit_user_rate', 0.01)
+    def test_authorize_rate_limit_per_user(self):
+        """Test that requests exceeding the user's rate limit are rejected before scopes are evaluated
+        """
+        actions.reset_rate_limiters()
+        scopes = ['org:{}:read'.format(self.org['name'])]
+        try:
+            with user_context(self.org_member) as context:
+                for _ in range(3):
+                    helpers.call_action('authz_authorize', dict(context), scopes=scopes)
+                with mock.patch.object(actions, '_authorize_request') as authorize_request:
+                    with pytest.raises(actions.RateLimitExceeded) as e:
+                        helpers.call_action('authz_authorize', dict(context), scopes=scopes)
+                    authorize_request.assert_not_called()
+
+            assert e.value.retry_after > 0
+            assert 'rate limit exceeded' in str(e.value)
+
+            with user_context(self.org_admin) as context:
+                helpers.call_action('authz_authorize', context, scopes=scopes)
+        finally:
+            actions.reset_rate_limiters()
+
+    @helpers.change_config('ckanext.authz_service.rate_limit', True)
+    @helpers.change_config('ckanext.authz_service.rate_limit_user_burst', 20)
+    def test_authorize_rate_limit_rejects_expensive_requests(self):
+        """Test that requests costing more than the maximal budget are rejected with a clear error
+        """
+        actions.reset_rate_limiters()
+        try:
+            with user_context(self.org_member) as context:
+                with pytest.raises(actions.RateLimitExceeded) as e:
+                    helpers.call_action('authz_authorize', context, scopes=['org:*:read', 'ds:*:read', 'res:*:read'])
+        finally:
+            actions.reset_rate_limiters()
+
+        assert 'exceeds the maximal user rate limit budget' in str(e.value)
+
+    @helpers.change_config('ckanext.authz_service.debug_responses', True)
+    def test_authorize_debug_response_counts_queries(self):
+        scopes = ['org:{}:read'.format(self.org['name'])]
+        with user_context(self.org_admin) as context:
+            result = helpers.call_action('authz_authorize', context, scopes=scopes, debug=True)
+            assert 'debug' not in helpers.call_action('authz_authorize', context, scopes=scopes)
+
+        assert result['debug']['query_count'] > 0
+
+    def test_authorize_defers_scopes_once_the_deadline_passed(self):
+        """Test that scopes not evaluated before the deadline are not granted, and are reported as deferred
+        """
+        actions.reset_time_limits()
+        scopes = ['org:{}:read'.format(self.org['name'])]
+        with user_context(self.org_admin) as context:
+            assert helpers.call_action('authz_authorize', dict(context), scopes=scopes)['deferred_scopes'] == []
+            with mock.patch.object(actions, '_create_deadline', return_value=Deadline(0)):
+                result = helpers.call_action('authz_authorize', dict(context), scopes=scopes)
+
+        assert result['granted_scopes'] == []
+        assert result['deferred_scopes'] == scopes
+        stats = actions.get_deadline_metrics().stats()
+        assert stats['requests'] == 2
+        assert stats['deferred_scopes'] == 1
+        actions.reset_time_limits()
+
+    def test_authorize_debug_responses_are_disabled_by_default(self):
+        scopes = ['org:{}:read'.format(self.org['name'])]
+        with user_context(self.org_admin) as context:
+            result = helpers.call_action('authz_authorize', context, scopes=scopes, debug=True)
+
+        assert 'debug' not in result
+
+    @helpers.change_config('ckanext.authz_service.decision_cache_ttl', 60)
+    def test_authorize_reuses_cached_decisions(self):
+        scopes = ['org:{}:read'.format(self.org['name'])]
+        with user_context(self.org_member) as context:
+            first = helpers.call_action('authz_authorize', context, scopes=scopes)
+        with user_context(self.org_member) as context, mock.patch.object(actions, '_evaluate_scopes') as evaluate:
+            second = helpers.call_action('authz_authorize', context, scopes=scopes)
+            evaluate.assert_not_called()
+
+        assert second['granted_scopes'] == first['granted_scopes']
+
+    @helpers.change_config('ckanext.authz_service.decision_cache_ttl', 60)
+    def test_cached_decisions_are_not_reused_after_membership_changes(self):
+        # Listeners are registered when the plugin is configured with the decision cache enabled
+        snapshot.listen_for_membership_changes()
+        scopes = ['org:{}:*'.format(self.org['name'])]
+        with user_context(self.org_member) as context:
+            assert helpers.call_action('authz_authorize', context, scopes=scopes)['granted_scopes'] == \
+                ['org:{}:read'.format(self.org['name'])]
+
+        helpers.call_action('organization_member_create', id=self.org['id'], username=self.org_member['name'],
+                            role='admin')
+
+        with user_context(self.org_member) as context:
+            assert helpers.call_action('authz_authorize', context, scopes=scopes)['granted_scopes'] == \
+                ['org:{}:delete,patch,read,update'.format(self.org['name'])]
+
+
+class _ListAuditSink(audit.AuditSink):
+
+    def __init__(self):
+        self.batches = []
+
+    def write(self, events):
+        self.batches.append(events)
+
+
+_audit_sink = _ListAuditSink()
+
+
+def create_audit_sink():
+    _audit_sink.batches = []
+    return _audit_sink
+
 
 @pytest.mark.usefixtures('with_plugins')
 class TestPublicKeyAction():
@@ -171,6 +398,134 @@ class TestJwtConfig():
         assert self.user['email'] == jwt_payload['email']
 
 
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+@helpers.change_config('ckanext.authz_service.jwt_algorithm', 'HS256')
+@helpers.change_config('ckanext.authz_service.jwt_private_key', 'this-is-a-test-only-key')
+@helpers.change_config('ckanext.authz_service.jwt_include_token_id', True)
+class TestVerifyAction():
+    """Tests for the verify action
+    """
+
+    def setup(self):
+        verifier.reset_replay_detector()
+        self.user = factories.User()
+        self.org = factories.Organization(
+            users=[
+                {'name': self.user['name'], 'capacity': 'admin'},
+            ]
+        )
+
+    def _get_token(self):
+        with user_context(self.user) as context:
+            return helpers.call_action('authz_authorize', context,
+                                       scopes=['org:{}:read'.format(self.org['name'])])['token']
+
+    def test_verify_valid_token(self):
+        """Test that a valid token is verified
+        """
+        result = helpers.call_action('authz_verify', {}, token=self._get_token())
+        assert result['verified']
+        assert self.user['name'] == result['payload']['sub']
+
+    def test_verify_can_detect_replayed_tokens(self):
+        """Test that a token is only verified once when replay detection is requested
+        """
+        token = self._get_token()
+        first = helpers.call_action('authz_verify', {}, token=token, check_replay=True)
+        second = helpers.call_action('authz_verify', {}, token=token, check_replay=True)
+
+        assert first['verified']
+        assert not second['verified']
+        assert second['replayed']
+        assert 'payload' not in second
+
+    def test_get_requests_do_not_use_up_tokens(self, app):
+        """Test that verifying a token through a GET request checks for replays without recording the token
+        """
+        token = self._get_token()
+        params = {"token": token, "check_replay": "true"}
+        for _ in range(2):
+            assert app.get('/api/3/action/authz_verify', params=params).json['result']['verified']
+
+        assert helpers.call_action('authz_verify', {}, token=token, check_replay=True)['verified']
+        assert app.get('/api/3/action/authz_verify', params=params).json['result']['replayed']
+
+    @helpers.change_config('ckanext.authz_service.replay_detection', True)
+    def test_replay_detection_can_be_enabled_by_config(self):
+        """Test that replay detection can be enabled for all verify calls
+        """
+        token = self._get_token()
+        helpers.call_action('authz_verify', {}, token=token)
+        result = helpers.call_action('authz_verify', {}, token=token, strict=False)
+
+        assert not result['verified']
+        assert result['replayed']
+        assert self.user['name'] == result['payload']['sub']
+
+    def test_token_ids_are_unique(self):
+        """Test that generated token IDs do not repeat
+        """
+        assert len({actions._generate_jti() for _ in range(10000)}) == 10000
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+@helpers.change_config('ckanext.authz_service.jwt_algorithm', 'HS256')
+@helpers.change_config('ckanext.authz_service.jwt_private_key', 'this-is-a-test-only-key')
+@helpers.change_config('ckanext.authz_service.jwt_include_token_id', True)
+class TestRevokeAction():
+    """Tests for the revoke action
+    """
+
+    def setup(self):
+        self.user = factories.User()
+        self.org = factories.Organization(
+            users=[
+                {'name': self.user['name'], 'capacity': 'admin'},
+            ]
+        )
+
+    def _get_token(self):
+        with user_context(self.user) as context:
+            return helpers.call_action('authz_authorize', context,
+                                       scopes=['org:{}:read'.format(self.org['name'])])['token']
+
+    def test_revoke_token(self):
+        """Test that a revoked token is no longer verified
+        """
+        token = self._get_token()
+        other_token = self._get_token()
+        helpers.call_action('authz_revoke', {}, token=token)
+
+        result = helpers.call_action('authz_verify', {}, token=token)
+        assert not result['verified']
+        assert result['revoked']
+        assert helpers.call_action('authz_verify', {}, token=other_token)['verified']
+
+    def test_revoke_own_subject(self):
+        """Test that users can revoke all tokens issued to them
+        """
+        token = self._get_token()
+        with user_context(self.user) as context:
+            helpers.call_action('authz_revoke', context, subject=self.user['name'])
+
+        assert helpers.call_action('authz_verify', {}, token=token)['revoked']
+
+    def test_revoke_other_subject_not_allowed(self):
+        """Test that regular users can not revoke tokens issued to other users
+        """
+        other_user = factories.User()
+        with user_context(other_user) as context:
+            context['ignore_auth'] = False
+            with pytest.raises(toolkit.NotAuthorized):
+                helpers.call_action('authz_revoke', context, subject=self.user['name'])
+
+    def test_revoke_requires_parameters(self):
+        """Test that revoke fails if nothing to revoke was specified
+        """
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('authz_revoke', {})
+
+
 def _decode_jwt(token):
     """Decode a JWT token generated by the system
 
@@ -0,0 +1,117 @@
+"""Tests for the asynchronous audit log
+"""
+import json
+import threading
+
+from ckanext.authz_service import audit
+
+
+class ListSink(audit.AuditSink):
+
+    def __init__(self):
+        self.batches = []
+        self.closed = False
+
+    def write(self, events):
+        self.batches.append(list(events))
+
+    def close(self):
+        self.closed = True
+
+
+class BlockingSink(ListSink):
+
+    def __init__(self):
+        super(BlockingSink, self).__init__()
+        self.release = threading.Event()
+
+    def write(self, events):
+        self.release.wait(5)
+        super(BlockingSink, self).write(events)
+
+
+class FailingSink(audit.AuditSink):
+
+    def write(self, events):
+        raise IOError('disk full')
+
+
+def test_events_are_written_in_batches():
+    sink = BlockingSink()
+    log = audit.AuditLog(sink, batch_size=3)
+    for i in range(7):
+        assert log.record({'i': i})
+    sink.release.set()
+    log.flush()
+
+    assert [e['i'] for batch in sink.batches for e in batch] == list(range(7))
+    assert all(len(batch) <= 3 for batch in sink.batches)
+    stats = log.stats()
+    assert stats['recorded'] == 7
+    assert stats['written'] == 7
+    assert stats['dropped'] == 0
+    assert stats['queued'] == 0
+
+
+def test_events_are_dropped_when_queue_is_full():
+    sink = BlockingSink()
+    log = audit.AuditLog(sink, queue_size=2, batch_size=1)
+    log.record({'i': 0})
+    # Wait for the writer to take the first event, so that it is blocked writing it
+    for _ in range(1000):
+        if log.stats()['queued'] == 0:
+            break
+        threading.Event().wait(0.005)
+
+    results = [log.record({'i': i}) for i in range(1, 6)]
+    assert results == [True, True, False, False, False]
+    assert log.stats()['dropped'] == 3
+
+    sink.release.set()
+    log.close()
+    assert sink.closed
+    assert [e['i'] for batch in sink.batches for e in batch] == [0, 1, 2]
+
+
+def test_sink_errors_are_counted():
+    log = audit.AuditLog(FailingSink())
+    log.record({'i': 0})
+    log.record({'i': 1})
+    log.flush()
+
+    stats = log.stats()
+    assert stats['failed'] == 2
+    assert stats['written'] == 0
+
+
+def test_close_writes_queued_events():
+    sink = ListSink()
+    log = audit.AuditLog(sink, flush_interval=60)
+    log.record({'i': 0})
+    log.close()
+
+    assert sink.batches == [[{'i': 0}]]
+
+
+def test_json_lines_file_sink(tmp_path):
+    path = tmp_path / 'audit.jsonl'
+    sink = audit.JsonLinesFileSink(str(path))
+    sink.write([{'user': 'alice', 'granted_scopes': ['org:foo:read']}, {'user': None}])
+    sink.close()
+
+    lines = path.read_text().splitlines()
+    assert [json.loads(line) for line in lines] == [{'user': 'alice', 'granted_scopes': ['org:foo:read']},
+                                                    {'user': None}]
+
+
+def test_json_lines_file_sink_rotation(tmp_path):
+    path = tmp_path / 'audit.jsonl'
+    sink = audit.JsonLinesFileSink(str(path), max_bytes=30, backup_count=2)
+    for i in range(4):
+        sink.write([{'event': 'authorize', 'i': i}])
+    sink.close()
+
+    assert json.loads(path.read_text()) == {'event': 'authorize', 'i': 3}
+    assert json.loads((tmp_path / 'audit.jsonl.1').read_text()) == {'event': 'authorize', 'i': 2}
+    assert json.loads((tmp_path / 'audit.jsonl.2').read_text()) == {'event': 'authorize', 'i': 1}
+    assert not (tmp_path / 'audit.jsonl.3').exists()
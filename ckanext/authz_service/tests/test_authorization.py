@@ -1,6 +1,10 @@
+import re
+
 import pytest
+from ckan import model
 from ckan.tests import factories, helpers
 
+from ckanext.authz_service.authz_binding import ownership
 from ckanext.authz_service.authzzie import Scope
 from ckanext.authz_service.plugin import init_authorizer
 
@@ -172,6 +176,19 @@ class TestResourceAuthBinding(object):
             granted = self.az.get_granted_actions(scope)
         assert granted == set()
 
+    def test_deleted_resources_are_not_authorized(self):
+        """Test that no actions are granted on a resource once it is deleted, even if it was indexed before
+        """
+        resource = factories.Resource(package_id=self.dataset['id'])
+        scope = Scope('res', '{}/{}/{}'.format(self.org['name'], self.dataset['name'], resource['id']), ['read'])
+        with user_context(self.org_admin):
+            assert self.az.get_granted_actions(scope) == {'read'}
+
+        helpers.call_action('resource_delete', id=resource['id'])
+
+        with user_context(self.org_admin):
+            assert self.az.get_granted_actions(scope) == set()
+
 
 @pytest.mark.usefixtures('clean_db', 'with_plugins')
 class TestOrganizationAuthBinding():
@@ -276,3 +293,60 @@ class TestOrganizationAuthBinding():
         with user_context(self.sysadmin):
             granted = self.az.authorize_scope(scope)
         assert granted.actions == {'read', 'write'}
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestEntityLoadQueries(object):
+    """Test that each entity is loaded from the DB once, no matter how many
+    CKAN permission checks are run for it
+    """
+
+    def setup(self):
+        self.org_admin = factories.User()
+        self.org = factories.Organization(users=[{'name': self.org_admin['name'], 'capacity': 'admin'}])
+        self.dataset = factories.Dataset(owner_org=self.org['id'])
+        self.resource = factories.Resource(package_id=self.dataset['id'])
+
+        # Role matrix authorizers would grant these without running CKAN permission checks
+        with helpers.changed_config('ckanext.authz_service.role_matrix_authorizers', False):
+            self.az = init_authorizer()
+        ownership.reset_ownership_index()
+        model.Session.remove()
+
+    @staticmethod
+    def _queries_from(table, statements):
+        pattern = re.compile(r'\bFROM "?{}"?(\s|$)'.format(table))
+        return [s for s in statements if pattern.search(s)]
+
+    def test_dataset_scope_loads_dataset_once(self, query_counter):
+        """Test that requesting all actions on a dataset loads it once, plus once to look up its owner
+        """
+        scope = Scope('ds', '{}/{}'.format(self.org['name'], self.dataset['name']))
+        with user_context(self.org_admin):
+            del query_counter.statements[:]
+            granted = self.az.get_granted_actions(scope)
+
+        assert granted == {'read', 'update', 'delete', 'patch'}
+        assert len(self._queries_from('package', query_counter.statements)) == 2
+
+    def test_dataset_scope_with_warm_ownership_index(self, query_counter):
+        """Test that once the dataset owner is known, requesting all actions on a dataset loads it once
+        """
+        ownership.get_ownership_index().get_dataset(self.dataset['name'])
+        scope = Scope('ds', '{}/{}'.format(self.org['name'], self.dataset['name']))
+        with user_context(self.org_admin):
+            del query_counter.statements[:]
+            self.az.get_granted_actions(scope)
+
+        assert len(self._queries_from('package', query_counter.statements)) == 1
+
+    def test_resource_scope_loads_resource_once(self, query_counter):
+        """Test that requesting all actions on a resource loads it once, plus once to look up its dataset
+        """
+        scope = Scope('res', '{}/{}/{}'.format(self.org['name'], self.dataset['name'], self.resource['id']))
+        with user_context(self.org_admin):
+            del query_counter.statements[:]
+            granted = self.az.get_granted_actions(scope)
+
+        assert granted == {'read', 'update', 'delete'}
+        assert len(self._queries_from('resource', query_counter.statements)) == 2
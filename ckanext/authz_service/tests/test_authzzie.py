@@ -1,8 +1,17 @@
 """Tests for the Authzzie permission mapping library
 """
+import gc
+import math
+import os
+import threading
+import traceback
+
 import pytest
 
-from ckanext.authz_service import authzzie
+from ckanext.authz_service import authzzie, deadline
+from ckanext.authz_service.singleflight import SingleFlight
+
+from .test_replay import FakeClock
 
 
 @pytest.mark.parametrize('scope_str, expected', [
@@ -17,6 +26,9 @@ from ckanext.authz_service import authzzie
     ('ds:foobaz:delete', {'entity_type': 'ds', 'entity_ref': 'foobaz', 'actions': {'delete'}, 'subscope': None}),
     ('ds:foobaz:create,delete', {'entity_type': 'ds', 'entity_ref': 'foobaz', 'actions': {'create', 'delete'},
                                  'subscope': None}),
+    ('res:o/d/{c,a,b,a}:read', {'entity_type': 'res', 'entity_ref': 'o/d/{a,b,c}', 'actions': {'read'},
+                                'subscope': None}),
+    ('res:o/d/{a}:read', {'entity_type': 'res', 'entity_ref': 'o/d/a', 'actions': {'read'}, 'subscope': None}),
 
 ])
 def test_scope_parsing(scope_str, expected):
@@ -106,3 +118,516 @@ def test_action_aliases_with_type_alias():
     scope = authzzie.Scope('bar', 'entity-01', {'look-at-things'})
     granted = az.authorize_scope(scope)
     assert 'bar:entity-01:look-at-things' == str(granted)
+
+
+@pytest.mark.parametrize('covering, covered, expected', [
+    ('ds:foo:read', 'ds:foo:read', True),
+    ('ds:foo', 'ds:foo:read,update', True),
+    ('ds:foo:read,update', 'ds:foo:read', True),
+    ('ds:foo:read', 'ds:foo:read,update', False),
+    ('ds:*:read', 'ds:foo:read', True),
+    ('ds:foo:read', 'ds:*:read', False),
+    ('ds:foo:read', 'ds:foo:data:read', True),
+    ('ds:foo:data:read', 'ds:foo:read', False),
+    ('ds:foo:data:read', 'ds:foo:metadata:read', False),
+    ('ds:foo:read', 'res:foo:read', False),
+    ('res:o/d/{a,b,c}:read', 'res:o/d/b:read', True),
+    ('res:o/d/{a,b,c}:read', 'res:o/d/{a,c}:read', True),
+    ('res:o/d/{a,b}:read', 'res:o/d/{a,c}:read', False),
+    ('res:o/d/b:read', 'res:o/d/{a,b}:read', False),
+])
+def test_scope_covers(covering, covered, expected):
+    """Test that scope coverage is calculated as expected
+    """
+    assert authzzie.Scope.from_string(covering).covers(authzzie.Scope.from_string(covered)) is expected
+
+
+@pytest.mark.parametrize('scopes, expected', [
+    (['ds:foo:read'], ['ds:foo:read']),
+    (['ds:foo:read', 'ds:foo:read'], ['ds:foo:read']),
+    (['ds:foo:read', 'ds:bar:read', 'ds:foo:update'], ['ds:foo:read,update', 'ds:bar:read']),
+    (['ds:foo:read', 'ds:foo:*:update', 'ds:foo'], ['ds:foo']),
+    (['res:o/d/a:read', 'res:o/d/b:read', 'res:*:read'], ['res:*:read']),
+    (['ds:foo:data:read', 'ds:foo:metadata:read'], ['ds:foo:data:read', 'ds:foo:metadata:read']),
+    (['ds:foo:data:read', 'ds:foo:read,update'], ['ds:foo:read,update']),
+    (['org:foo:read', 'ds:foo:read'], ['org:foo:read', 'ds:foo:read']),
+    (['res:o/d/{a,b}:read', 'res:o/d/b:update'], ['res:o/d/a:read', 'res:o/d/b:read,update']),
+    ([], []),
+])
+def test_coalesce_scopes(scopes, expected):
+    """Test that scope coalescing produces the expected minimal scope list
+    """
+    coalesced = authzzie.coalesce_scopes([authzzie.Scope.from_string(s) for s in scopes])
+    assert [str(s) for s in coalesced] == expected
+
+
+@pytest.mark.parametrize('scopes, expected', [
+    (['res:o/d/a:read', 'res:o/d/b:read', 'res:o/d/c:read'], ['res:o/d/{a,b,c}:read']),
+    (['res:o/d/{a,b}:read', 'res:o/d/b:update', 'res:o/e/a:read'],
+     ['res:o/d/a:read', 'res:o/d/b:read,update', 'res:o/e/a:read']),
+    (['ds:o/a:read', 'ds:o/b:read', 'ds:p/c:read'], ['ds:o/{a,b}:read', 'ds:p/c:read']),
+    (['res:o/d/a:data:read', 'res:o/d/b:read'], ['res:o/d/a:data:read', 'res:o/d/b:read']),
+])
+def test_coalesce_scopes_grouping_refs(scopes, expected):
+    """Test that coalescing can group references to sibling entities into multi-reference scopes
+    """
+    coalesced = authzzie.coalesce_scopes([authzzie.Scope.from_string(s) for s in scopes], group_refs=True)
+    assert [str(s) for s in coalesced] == expected
+
+
+@pytest.mark.parametrize('scope_str', ['res:o/d/{a,}:read', 'res:o/d/{a,*}:read', 'res:o/{d,e}/{a,b}:read',
+                                       'res:o/d/{a,b/c}:read', 'res:o/d/{a:read'])
+def test_malformed_multi_ref_scopes_are_rejected(scope_str):
+    """Test that malformed multi-reference scopes can not be parsed
+    """
+    with pytest.raises(ValueError):
+        authzzie.Scope.from_string(scope_str)
+
+
+def test_coalesce_scopes_does_not_modify_input():
+    """Test that coalescing does not modify the passed scope objects
+    """
+    scopes = [authzzie.Scope.from_string('ds:foo:read'), authzzie.Scope.from_string('ds:foo:update')]
+    authzzie.coalesce_scopes(scopes)
+    assert [str(s) for s in scopes] == ['ds:foo:read', 'ds:foo:update']
+
+
+def test_scope_set_deduplicates_scopes():
+    """Test that scope sets hold a single canonical instance of each scope
+    """
+    first = authzzie.Scope.from_string('ds:foo:*:read')
+    scopes = authzzie.ScopeSet([first, authzzie.Scope.from_string('ds:foo:read'), authzzie.Scope('ds', 'foo', 'read')])
+    assert len(scopes) == 1
+    assert scopes.get(authzzie.Scope.from_string('ds:foo:read')) is first
+    assert authzzie.Scope('ds', 'foo', 'read') in scopes
+
+
+@pytest.mark.parametrize('scopes, expected', [
+    (['ds:foo:read', 'ds:foo:read,update', 'ds:foo'], ['ds:foo']),
+    (['ds:foo:data:read', 'ds:foo:read'], ['ds:foo:read']),
+    (['ds:foo:read', 'ds:*:read'], ['ds:foo:read', 'ds:*:read']),
+    (['ds:foo:data:read', 'ds:foo:metadata:read'], ['ds:foo:data:read', 'ds:foo:metadata:read']),
+    (['ds:foo:read', 'res:foo:read'], ['ds:foo:read', 'res:foo:read']),
+])
+def test_scope_set_maximal_scopes(scopes, expected):
+    """Test that only scopes not covered by scopes of the same entity are maximal
+    """
+    scope_set = authzzie.ScopeSet(authzzie.Scope.from_string(s) for s in scopes)
+    assert [str(s) for s in scope_set.maximal()] == expected
+
+
+def test_authorize_scopes_evaluates_maximal_scopes_only():
+    """Test that covered and duplicate scopes do not trigger additional authorizer calls
+    """
+    calls = []
+
+    def test_authorizer(**kwargs):
+        calls.append(kwargs['id'])
+        return {'read', 'update'}
+
+    az = authzzie.Authzzie()
+    az.register_authorizer('foo', test_authorizer, {None, 'read', 'update', 'delete'}, subscopes={None, 'meta'})
+
+    scopes = [authzzie.Scope.from_string(s) for s in ('foo:e1:read', 'foo:e1:read,delete', 'foo:e1:meta:read',
+                                                      'foo:e1:read', 'foo:e2:delete')]
+    granted = az.authorize_scopes(scopes)
+
+    assert [str(s) if s else None for s in granted] == ['foo:e1:read', 'foo:e1:read', 'foo:e1:meta:read',
+                                                        'foo:e1:read', None]
+    assert calls == ['e1', 'e2']
+
+
+def test_authorize_scopes_evaluates_covered_scopes_with_different_authorizers():
+    """Test that covered scopes are evaluated on their own if they call different authorizers
+    """
+    def test_authorizer(**_):
+        return {'read', 'update'}
+
+    def test_meta_authorizer(**_):
+        return {'read'}
+
+    az = authzzie.Authzzie()
+    az.register_authorizer('foo', test_authorizer, {None, 'read', 'update'})
+    az.register_authorizer('foo', test_meta_authorizer, {None, 'read', 'update'}, subscopes='meta')
+
+    scopes = [authzzie.Scope.from_string(s) for s in ('foo:e1', 'foo:e1:meta:read,update')]
+    granted = az.authorize_scopes(scopes)
+
+    assert [str(s) for s in granted] == ['foo:e1:read,update', 'foo:e1:meta:read']
+
+
+def test_authorize_scopes_with_action_aliases():
+    """Test that granted actions derived from a covering scope respect action aliases
+    """
+    def test_authorizer(**_):
+        return {'read'}
+
+    az = authzzie.Authzzie()
+    az.register_authorizer('foo', test_authorizer, {None, 'read', 'write'})
+    az.register_action_alias('look-at-things', 'read', 'foo')
+
+    scopes = [authzzie.Scope.from_string(s) for s in ('foo:e1:look-at-things', 'foo:e1:look-at-things,write')]
+    granted = az.authorize_scopes(scopes)
+
+    assert [str(s) for s in granted] == ['foo:e1:look-at-things', 'foo:e1:look-at-things']
+
+
+GRANTED_SCOPES = ['ds:foo:read,update', 'ds:bar', 'ds:*:metadata:read', 'ds:baz:data:*', 'org:*:list',
+                  'res:o/d/r:read', 'res:o/e/{r,s}:read']
+
+QUERY_SCOPES = ['ds:foo:read', 'ds:foo:read,update', 'ds:foo:delete', 'ds:foo', 'ds:foo:metadata:read',
+                'ds:foo:data:update', 'ds:bar:purge', 'ds:bar:data:read', 'ds:bar', 'ds:baz:data:read',
+                'ds:baz:read', 'ds:other:metadata:read', 'ds:other:metadata:update', 'ds:*:metadata:read',
+                'ds:*:read', 'org:x:list', 'org:x:read', 'org:*:list', 'res:o/d/r:read', 'res:o/d/s:read',
+                'res:o/e/s:read', 'res:o/e/{r,s}:read', 'res:o/e/{r,t}:read']
+
+
+@pytest.mark.parametrize('query', QUERY_SCOPES)
+def test_scope_matcher_is_consistent_with_scope_covers(query):
+    """Test that the scope matcher grants exactly what granted scopes cover
+    """
+    granted = [authzzie.Scope.from_string(s) for s in GRANTED_SCOPES]
+    query = authzzie.Scope.from_string(query)
+    matcher = authzzie.ScopeMatcher(granted)
+    assert matcher.matches(query) is any(g.covers(query) for g in granted)
+
+
+def test_scope_matcher_check_many():
+    """Test bulk queries against the scope matcher
+    """
+    matcher = authzzie.ScopeMatcher.from_string(' '.join(GRANTED_SCOPES))
+    assert matcher.check_many('res', ['o/d/r', 'o/d/s'], 'read') == {'o/d/r': True, 'o/d/s': False}
+    assert matcher.check_many('org', ['a', 'b'], 'list') == {'a': True, 'b': True}
+    assert matcher.check_many('spam', ['a'], 'read') == {'a': False}
+
+
+def test_scope_matcher_with_aliases():
+    """Test that the scope matcher resolves type and action aliases registered with Authzzie
+    """
+    def test_authorizer(**_):
+        return set()
+
+    az = authzzie.Authzzie()
+    az.register_authorizer('foo', test_authorizer, {'read', 'write'})
+    az.register_type_alias('bar', 'foo')
+    az.register_action_alias('look-at-things', 'read', 'foo')
+
+    matcher = az.get_scope_matcher([authzzie.Scope.from_string('bar:e1:look-at-things')])
+    assert matcher.is_granted('foo', 'e1', 'read')
+    assert matcher.is_granted('bar', 'e1', 'read')
+    assert matcher.is_granted('foo', 'e1', 'look-at-things')
+    assert not matcher.is_granted('foo', 'e1', 'write')
+
+
+def test_frozen_authorizer_can_authorize():
+    """Test that a frozen authorizer works the same, and can't be modified
+    """
+    def test_authorizer(**_):
+        return {'read'}
+
+    az = authzzie.Authzzie()
+    az.register_authorizer('foo', test_authorizer, {'read', 'write'})
+    az.freeze()
+
+    assert az.get_granted_actions(authzzie.Scope('foo', 'entity-01', {'read', 'delete'})) == {'read'}
+    assert az.get_granted_actions(authzzie.Scope('foo', 'entity-01', subscope='meta')) == set()
+    with pytest.raises(RuntimeError):
+        az.register_authorizer('bar', test_authorizer, {'read'})
+
+
+def test_concurrent_identical_authorizer_calls_are_shared():
+    """Test that identical concurrent authorizer calls by the same caller are only evaluated once
+    """
+    release = threading.Event()
+    calls = []
+
+    def test_authorizer(id=None, user=None):
+        calls.append((id, user))
+        release.wait(5)
+        return {'read'}
+
+    az = authzzie.Authzzie()
+    az.register_authorizer('foo', test_authorizer, {'read', 'write'})
+    flight = SingleFlight()
+    az.set_single_flight(flight, lambda user=None: user)
+    az.freeze()
+
+    results = []
+    requests = [('e1', 'alice')] * 3 + [('e1', 'bob'), ('e2', 'alice')]
+    threads = [threading.Thread(target=lambda r, u: results.append(
+        az.get_granted_actions(authzzie.Scope('foo', r, 'read'), user=u)), args=req) for req in requests]
+    for t in threads:
+        t.start()
+    while flight.stats()['calls'] < len(requests):
+        threading.Event().wait(0.01)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert sorted(calls) == [('e1', 'alice'), ('e1', 'bob'), ('e2', 'alice')]
+    assert results == [{'read'}] * 5
+
+
+def test_authorizer_calls_without_caller_key_are_not_shared():
+    calls = []
+    az = authzzie.Authzzie()
+    az.register_authorizer('foo', lambda **kw: calls.append(kw) or {'read'}, {'read'})
+    az.set_single_flight(SingleFlight(), lambda user=None: user)
+
+    assert az.get_granted_actions(authzzie.Scope('foo', 'e1', 'read')) == {'read'}
+    assert calls == [{'id': 'e1'}]
+
+
+def test_role_matrix_authorizer():
+    """Test that a role matrix authorizer grants actions by role and subscope, and falls back for unknown roles
+    """
+    matrix = authzzie.RoleMatrix()
+    matrix.grant('member', 'foo', {'read'})
+    matrix.grant('editor', 'foo', {'read', 'write'})
+    matrix.grant('editor', 'foo', {'read'}, subscope='meta')
+    roles = {'e1': 'editor', 'e2': 'member', 'e3': 'owner'}
+    fallback_calls = []
+
+    def fallback(**kwargs):
+        fallback_calls.append(kwargs['id'])
+        return {'read'}
+
+    az = authzzie.Authzzie()
+    for subscope in (None, 'meta'):
+        az.register_authorizer('foo', matrix.authorizer('foo', lambda id, **_: roles.get(id), subscope, fallback),
+                               {None, 'read', 'write'}, subscopes=subscope)
+    az.freeze()
+
+    assert az.get_granted_actions(authzzie.Scope('foo', 'e1', {'read', 'write'})) == {'read', 'write'}
+    assert az.get_granted_actions(authzzie.Scope('foo', 'e1', {'read', 'write'}, 'meta')) == {'read'}
+    assert az.get_granted_actions(authzzie.Scope('foo', 'e2', {'read', 'write'})) == {'read'}
+    assert fallback_calls == []
+
+    # Roles not in the table, including for subscopes with entries of their own, fall back
+    assert az.get_granted_actions(authzzie.Scope('foo', 'e2', 'write', 'meta')) == set()
+    assert az.get_granted_actions(authzzie.Scope('foo', 'e3', 'write')) == set()
+    assert az.get_granted_actions(authzzie.Scope('foo', 'e4', 'read')) == {'read'}
+    assert fallback_calls == ['e2', 'e3', 'e4']
+
+
+def _multi_ref_authzzie(calls, batch_calls=None):
+    """Get an Authzzie instance granting read on odd and read, update on even entity numbers
+    """
+    def test_authorizer(id=None, **_):
+        calls.append(id)
+        return {'read', 'update'} if int(id[1:]) % 2 == 0 else {'read'}
+
+    az = authzzie.Authzzie()
+    az.register_authorizer('foo', test_authorizer, {None, 'read', 'update'})
+    if batch_calls is not None:
+        def test_batch_authorizer(entity_refs, **kwargs):
+            batch_calls.append([ref['id'] for ref in entity_refs])
+            return [test_authorizer(**dict(kwargs, **ref)) for ref in entity_refs]
+
+        az.register_batch_authorizer(test_authorizer, test_batch_authorizer)
+    return az
+
+
+def test_multi_ref_scopes_are_evaluated_in_a_batch():
+    """Test that a batch authorizer is called once for all entities of a multi-reference scope
+    """
+    calls = []
+    batch_calls = []
+    az = _multi_ref_authzzie(calls, batch_calls)
+    granted = az.authorize_scopes([authzzie.Scope.from_string('foo:{e1,e2,e3,e4}:read,update')])
+
+    assert [str(s) for s in granted] == ['foo:{e1,e3}:read', 'foo:{e2,e4}:read,update']
+    assert batch_calls == [['e1', 'e2', 'e3', 'e4']]
+    assert az.get_granted_actions(authzzie.Scope.from_string('foo:{e1,e2}:read,update')) == {'read'}
+
+
+def test_multi_ref_scopes_fall_back_to_single_entity_authorizers():
+    """Test that entities of a multi-reference scope are authorized one by one if there is no batch authorizer
+    """
+    calls = []
+    az = _multi_ref_authzzie(calls)
+    granted = az.authorize_scopes([authzzie.Scope.from_string('foo:{e2,e4}:update'),
+                                   authzzie.Scope.from_string('foo:{e1,e3}:update')])
+
+    assert [str(s) if s else None for s in granted] == ['foo:{e2,e4}:update', None]
+    assert calls == ['e2', 'e4', 'e1', 'e3']
+
+
+def test_role_matrix_authorizer_check_many():
+    """Test that a role matrix authorizer looks up roles and falls back in batches
+    """
+    matrix = authzzie.RoleMatrix()
+    matrix.grant('editor', 'foo', {'read', 'write'})
+    roles = {'e1': 'editor', 'e3': 'editor'}
+    lookups = []
+    fallbacks = []
+
+    def batch_role_lookup(entity_refs, **_):
+        lookups.append([ref['id'] for ref in entity_refs])
+        return [roles.get(ref['id']) for ref in entity_refs]
+
+    def batch_fallback(entity_refs, **_):
+        fallbacks.append([ref['id'] for ref in entity_refs])
+        return [{'read'} for _ in entity_refs]
+
+    check = matrix.authorizer('foo', lambda id, **_: roles.get(id), batch_role_lookup=batch_role_lookup,
+                              batch_fallback=batch_fallback)
+    results = check.check_many([{'id': 'e1'}, {'id': 'e2'}, {'id': 'e3'}, {'id': 'e4'}])
+
+    assert results == [{'read', 'write'}, {'read'}, {'read', 'write'}, {'read'}]
+    assert lookups == [['e1', 'e2', 'e3', 'e4']]
+    assert fallbacks == [['e2', 'e4']]
+
+
+def _timed_authzzie(clock, durations, timeout=None, breaker=None):
+    """Get an Authzzie instance with an authorizer advancing `clock` by the duration given for each entity
+    """
+    def test_authorizer(id=None, **_):
+        clock.now += durations.get(id, 0)
+        return {'read'}
+
+    az = authzzie.Authzzie()
+    az.register_authorizer('foo', test_authorizer, {None, 'read'})
+    az.set_time_limits(timeout, breaker, clock=clock)
+    return az
+
+
+def test_scopes_are_deferred_once_the_deadline_passed():
+    """Test that no authorizer is called once the deadline passed, and unevaluated scopes are deferred
+    """
+    clock = FakeClock(100)
+    az = _timed_authzzie(clock, {'e1': 0.5, 'e2': 1})
+    limit = deadline.Deadline(1, clock=clock)
+    scopes = [authzzie.Scope.from_string(s) for s in ('foo:e1:read', 'foo:e2:read', 'foo:e3:read', 'foo:e3')]
+    granted = az.authorize_scopes(scopes, deadline=limit)
+
+    # The call for e2 started before the deadline, so its result is used
+    assert [str(s) if s else None for s in granted] == ['foo:e1:read', 'foo:e2:read', None, None]
+    assert sorted(str(s) for s in limit.deferred_scopes) == ['foo:e3', 'foo:e3:read']
+    assert az.get_granted_actions(scopes[0], deadline=limit) == set()
+
+
+def test_slow_authorizer_calls_are_deferred():
+    """Test that the results of authorizer calls exceeding their timeout are not used
+    """
+    clock = FakeClock(100)
+    az = _timed_authzzie(clock, {'e2': 0.5}, timeout=0.25)
+    limit = deadline.Deadline(math.inf, clock=clock)
+    granted = az.authorize_scopes([authzzie.Scope.from_string(s) for s in ('foo:e1:read', 'foo:e2:read')],
+                                  deadline=limit)
+
+    assert [str(s) if s else None for s in granted] == ['foo:e1:read', None]
+    assert [(str(s), reason) for s, reason in limit.deferred] == [('foo:e2:read', deadline.AUTHORIZER_TIMEOUT)]
+
+
+def test_authorizers_timing_out_trip_the_circuit_breaker():
+    """Test that authorizers that keep timing out are not called until the circuit breaker is reset
+    """
+    clock = FakeClock(100)
+    breaker = deadline.CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=clock)
+    durations = {'e1': 1}
+    az = _timed_authzzie(clock, durations, timeout=0.5, breaker=breaker)
+    for _ in range(2):
+        assert az.authorize_scope(authzzie.Scope.from_string('foo:e1:read')) is None
+
+    limit = deadline.Deadline(math.inf, clock=clock)
+    assert az.authorize_scope(authzzie.Scope.from_string('foo:e2:read'), deadline=limit) is None
+    assert limit.deferred[0][1] == deadline.CIRCUIT_OPEN
+
+    clock.now += 30
+    durations.clear()
+    assert str(az.authorize_scope(authzzie.Scope.from_string('foo:e2:read'))) == 'foo:e2:read'
+    assert breaker.stats()['open'] == []
+
+
+def test_authorizers_can_be_registered_with_their_own_timeout():
+    """Test that a timeout registered with an authorizer overrides the default one
+    """
+    clock = FakeClock(100)
+
+    def slow_authorizer(**_):
+        clock.now += 1
+        return {'read'}
+
+    def other_slow_authorizer(**kwargs):
+        return slow_authorizer(**kwargs)
+
+    az = authzzie.Authzzie()
+    az.register_authorizer('foo', slow_authorizer, {None, 'read'}, timeout=2)
+    az.register_authorizer('bar', other_slow_authorizer, {None, 'read'})
+    az.set_time_limits(0.5, clock=clock)
+    az.freeze()
+
+    assert az.get_granted_actions(authzzie.Scope.from_string('foo:e1:read')) == {'read'}
+    assert az.get_granted_actions(authzzie.Scope.from_string('bar:e1:read')) == set()
+
+
+# Maximal private memory, in kB, a warmed up forked worker may dirty while handling 100 authorization requests
+FORKED_WORKER_MEMORY_BUDGET = 256
+
+
+def _private_dirty_kb():
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Private_Dirty:'):
+                return int(line.split()[1])
+    return 0
+
+
+def _call_in_forked_process(func):
+    """Call a function in a forked child process, and get its wait status and its result or traceback as a string
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        os.close(read_fd)
+        try:
+            output, status = str(func()), 0
+        except BaseException:
+            output, status = traceback.format_exc(), 1
+        os.write(write_fd, output.encode('utf-8'))
+        os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        output = f.read().decode('utf-8')
+    return os.waitpid(pid, 0)[1], output
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork') or not os.path.exists('/proc/self/smaps_rollup'),
+                    reason='Requires fork() and /proc/self/smaps_rollup')
+def test_frozen_registry_memory_growth_in_forked_worker():
+    """Test that authorizing in a forked worker doesn't dirty significant memory shared with the parent
+    """
+    def test_authorizer(**_):
+        return {'read', 'update'}
+
+    az = authzzie.Authzzie()
+    for entity_type in ('foo{}'.format(i) for i in range(100)):
+        az.register_authorizer(entity_type, test_authorizer, {None, 'read', 'update', 'delete'},
+                               subscopes={None, 'meta', 'data'})
+    az.freeze()
+    scopes = [authzzie.Scope.from_string('foo{}:e{}:meta:read,update'.format(i % 100, i)) for i in range(200)]
+    az.authorize_scopes(scopes[:1])
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+    def measure_growth():
+        # First request and measurement will dirty some pages that any code touches
+        az.authorize_scopes(scopes)
+        _private_dirty_kb()
+        before = _private_dirty_kb()
+        for _ in range(100):
+            az.authorize_scopes(scopes)
+        return _private_dirty_kb() - before
+
+    try:
+        status, output = _call_in_forked_process(measure_growth)
+    finally:
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0, \
+        'Worker process failed (wait status {}):\n{}'.format(status, output)
+    assert int(output) < FORKED_WORKER_MEMORY_BUDGET
@@ -0,0 +1,97 @@
+"""Tests for cache backends
+"""
+import pytest
+from ckan.tests import helpers
+
+from ckanext.authz_service import cache
+
+from .test_replay import FakeClock
+
+
+def test_memory_backend_get_set_delete():
+    backend = cache.MemoryCacheBackend()
+    assert backend.get('foo') is None
+    backend.set('foo', {'bar': 1})
+    assert backend.get('foo') == {'bar': 1}
+    backend.delete('foo')
+    assert backend.get('foo') is None
+
+
+def test_memory_backend_entries_expire():
+    clock = FakeClock(1000)
+    backend = cache.MemoryCacheBackend(clock=clock)
+    backend.set('foo', 'bar', ttl=10)
+    backend.set('baz', 'bar')
+
+    clock.now += 10
+    assert backend.get('foo') is None
+    assert backend.get('baz') == 'bar'
+    assert len(backend) == 1
+
+
+def test_memory_backend_evicts_oldest_entries():
+    backend = cache.MemoryCacheBackend(max_entries=2)
+    backend.set('a', 1)
+    backend.set('b', 2)
+    backend.set('a', 3)
+    backend.set('c', 4)
+
+    assert backend.get_many(['a', 'b', 'c']) == {'a': 3, 'c': 4}
+
+
+def test_memory_backend_incr():
+    backend = cache.MemoryCacheBackend()
+    assert backend.incr('counter') == 1
+    assert backend.incr('counter') == 2
+    assert backend.get('counter') == 2
+
+
+def test_memory_backend_add():
+    clock = FakeClock(1000)
+    backend = cache.MemoryCacheBackend(clock=clock)
+    assert backend.add('foo', 1, ttl=10)
+    assert not backend.add('foo', 2, ttl=10)
+    assert backend.get('foo') == 1
+
+    clock.now += 10
+    assert backend.add('foo', 2)
+    assert backend.get('foo') == 2
+
+
+def test_default_incr_implementation():
+    class DictBackend(cache.CacheBackend):
+        def __init__(self):
+            self.values = {}
+
+        def get(self, key):
+            return self.values.get(key)
+
+        def set(self, key, value, ttl=None):
+            self.values[key] = value
+
+    backend = DictBackend()
+    assert backend.incr('counter') == 1
+    assert backend.incr('counter') == 2
+    assert backend.add('foo', 1)
+    assert not backend.add('foo', 2)
+    assert backend.get('foo') == 1
+
+
+def test_get_backend_returns_same_instance_per_namespace():
+    cache.reset_backends()
+    assert cache.get_backend('foo') is cache.get_backend('foo')
+    assert cache.get_backend('foo') is not cache.get_backend('bar')
+
+
+@helpers.change_config('ckanext.authz_service.cache_backend', 'ckanext.authz_service.cache:MemoryCacheBackend')
+def test_get_backend_with_custom_factory():
+    cache.reset_backends()
+    assert isinstance(cache.get_backend('foo'), cache.MemoryCacheBackend)
+    cache.reset_backends()
+
+
+@helpers.change_config('ckanext.authz_service.cache_backend', 'spam')
+def test_get_backend_unknown_type():
+    cache.reset_backends()
+    with pytest.raises(ValueError):
+        cache.get_backend('foo')
@@ -0,0 +1,94 @@
+import json
+
+import pytest
+from ckan.tests import factories, helpers
+from click.testing import CliRunner
+
+from ckanext.authz_service import actions, cache, cli
+from ckanext.authz_service.authz_binding import ownership
+
+
+def test_read_log_entries():
+    lines = ['{"user": "alice", "scopes": ["ds:foo/bar:read", "org:foo:*"]}',
+             '{"sub": "bob", "requested_scopes": "ds:foo/baz:read"}',
+             'carol res:foo/bar/res-1:read  ds:foo/bar:update',
+             '',
+             '{not json',
+             '{"scopes": ["org:*:read"]}']
+    assert list(cli.read_log_entries(lines)) == [
+        ('alice', ['ds:foo/bar:read', 'org:foo:*']),
+        ('bob', ['ds:foo/baz:read']),
+        ('carol', ['res:foo/bar/res-1:read', 'ds:foo/bar:update']),
+        (None, ['org:*:read']),
+    ]
+
+
+def test_benchmark_results():
+    result = cli.benchmark(lambda: None, 10)
+    assert result['iterations'] == 10
+    assert 0 <= result['p50'] <= result['p95'] <= result['p99']
+    assert 'ops/s' in cli.format_benchmark_result('noop', result)
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestCommands(object):
+
+    def setup(self):
+        self.user = factories.User()
+        self.org = factories.Organization(users=[{'name': self.user['name'], 'capacity': 'admin'}])
+        self.dataset = factories.Dataset(owner_org=self.org['id'])
+        ownership.reset_ownership_index()
+
+    def test_bench(self):
+        result = CliRunner().invoke(cli.authz_service, ['bench', '-i', '3', '--user', self.user['name'],
+                                                        '-s', 'org:{}:*'.format(self.org['name'])])
+        assert result.exit_code == 0, result.output
+        for name in cli.BENCHMARKS:
+            assert name in result.output
+
+    def test_bench_unknown_user(self):
+        result = CliRunner().invoke(cli.authz_service, ['bench', '-i', '3', '--user', 'no-such-user'])
+        assert result.exit_code != 0
+
+    @helpers.change_config('ckanext.authz_service.decision_cache_ttl', 60)
+    def test_warm(self, tmp_path, shared_cache):
+        log_file = tmp_path / 'requests.log'
+        log_file.write_text(u'\n'.join([
+            json.dumps({"user": self.user['name'],
+                        "scopes": ['ds:{}/{}:read'.format(self.org['name'], self.dataset['name'])]}),
+            u'no-such-user org:{}:read'.format(self.org['name']),
+        ]))
+
+        result = CliRunner().invoke(cli.authz_service, ['warm', str(log_file), '--stats'])
+        decisions = cache.get_backend(actions.DECISION_CACHE_NAMESPACE).stats()
+
+        assert result.exit_code == 0, result.output
+        assert 'Warmed caches for 2 users' in result.output
+        assert '(1 errors)' in result.output
+        assert decisions['entries'] == 1
+
+    @helpers.change_config('ckanext.authz_service.decision_cache_ttl', 60)
+    def test_warm_requires_a_shared_cache_backend(self, tmp_path):
+        log_file = tmp_path / 'requests.log'
+        log_file.write_text(u'{} org:{}:read'.format(self.user['name'], self.org['name']))
+
+        result = CliRunner().invoke(cli.authz_service, ['warm', str(log_file)])
+
+        assert result.exit_code != 0
+        assert 'is not shared with CKAN worker processes' in result.output
+
+    def test_warm_requires_caches_to_warm(self, tmp_path, shared_cache):
+        log_file = tmp_path / 'requests.log'
+        log_file.write_text(u'{} org:{}:read'.format(self.user['name'], self.org['name']))
+
+        result = CliRunner().invoke(cli.authz_service, ['warm', str(log_file)])
+
+        assert result.exit_code != 0
+        assert 'Nothing to warm' in result.output
+
+    def test_stats(self):
+        result = CliRunner().invoke(cli.authz_service, ['stats'])
+        assert result.exit_code == 0, result.output
+        stats = json.loads(result.output)
+        assert set(stats) == {'cache_backends', 'ownership_index', 'single_flight', 'rate_limiters', 'deadlines',
+                              'circuit_breaker', 'audit_log'}
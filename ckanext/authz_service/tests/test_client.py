@@ -0,0 +1,224 @@
+"""Tests for the Python client, against a local stand-in for CKAN
+"""
+import json
+import threading
+import time
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+import jwt
+import pytest
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from ckanext.authz_service import client, keys
+
+from .test_replay import FakeClock
+
+ISSUER = 'https://ckan.example.com'
+
+
+def _generate_key_pair():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    public_key = private_key.public_key().public_bytes(serialization.Encoding.PEM,
+                                                       serialization.PublicFormat.SubjectPublicKeyInfo)
+    return private_key, public_key
+
+
+class StandInCkan(object):
+    """A WSGI app issuing tokens and serving the public key the way CKAN does
+    """
+
+    def __init__(self, clock, lifetime=300):
+        self.clock = clock
+        self.lifetime = lifetime
+        self.private_key, self.public_key = _generate_key_pair()
+        self.requests = []
+        self.delay = 0
+        self.denied = False
+
+    def rotate_key(self):
+        self.private_key, self.public_key = _generate_key_pair()
+
+    def __call__(self, environ, start_response):
+        path = environ['PATH_INFO']
+        self.requests.append(path)
+        time.sleep(self.delay)
+        if path == '/authz/public_key':
+            etag = '"{}"'.format(keys.get_public_key_etag(self.public_key))
+            if environ.get('HTTP_IF_NONE_MATCH') == etag:
+                start_response('304 Not Modified', [('ETag', etag)])
+                return [b'']
+            start_response('200 OK', [('ETag', etag), ('Content-Type', 'application/x-pem-file')])
+            return [self.public_key]
+
+        data = json.loads(environ['wsgi.input'].read(int(environ['CONTENT_LENGTH'])).decode('utf-8'))
+        if self.denied:
+            start_response('403 Forbidden', [('Content-Type', 'application/json')])
+            return [json.dumps({"success": False, "error": {"__type": "Authorization Error",
+                                                            "message": "Access denied"}}).encode('utf-8')]
+
+        if path.endswith('/authz_refresh'):
+            scopes = jwt.decode(data['token'], verify=False)['scopes'].split(' ')
+        else:
+            scopes = data['scopes']
+        now = self.clock()
+        payload = {"sub": "user", "iss": ISSUER, "iat": now, "nbf": now,
+                   "exp": now + data.get('lifetime', self.lifetime), "scopes": ' '.join(scopes)}
+        token = jwt.encode(payload, self.private_key, 'RS256')
+        result = {"token": token.decode('ascii') if isinstance(token, bytes) else token,
+                  "requested_scopes": scopes,
+                  "granted_scopes": scopes}
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps({"success": True, "result": result}).encode('utf-8')]
+
+
+class _QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def clock():
+    return FakeClock(time.time())
+
+
+@pytest.fixture()
+def ckan(clock):
+    app = StandInCkan(clock)
+    server = make_server('127.0.0.1', 0, app, handler_class=_QuietHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    app.url = 'http://127.0.0.1:{}'.format(server.server_port)
+    yield app
+    server.shutdown()
+    server.server_close()
+
+
+def _client(ckan, clock, **kwargs):
+    kwargs.setdefault('refresh_jitter', 0)
+    return client.AuthzClient(ckan.url, api_key='secret', issuer=ISSUER, clock=clock, **kwargs)
+
+
+def test_tokens_are_cached_per_scope_set(ckan, clock):
+    authz = _client(ckan, clock)
+    token = authz.get_token(['ds:org/a:read', 'ds:org/b:read'])
+    assert authz.get_token(['ds:org/b:read', 'ds:org/a:read']) == token
+    assert authz.get_token(['ds:org/a:read']) != token
+    assert ckan.requests == ['/api/3/action/authz_authorize'] * 2
+
+
+def test_tokens_are_refreshed_before_they_expire(ckan, clock):
+    authz = _client(ckan, clock, refresh_margin=30)
+    token = authz.get_token(['ds:org/a:read'])
+    clock.now += 269
+    assert authz.get_token(['ds:org/a:read']) == token
+
+    clock.now += 1
+    refreshed = authz.get_token(['ds:org/a:read'])
+    assert refreshed != token
+    assert ckan.requests[-1] == '/api/3/action/authz_refresh'
+    assert jwt.decode(refreshed, verify=False)['scopes'] == 'ds:org/a:read'
+
+
+def test_expired_tokens_are_not_refreshed(ckan, clock):
+    authz = _client(ckan, clock)
+    authz.get_token(['ds:org/a:read'])
+    clock.now += 300
+    authz.get_token(['ds:org/a:read'])
+    assert ckan.requests == ['/api/3/action/authz_authorize'] * 2
+
+
+def test_failed_refreshes_request_new_tokens(ckan, clock):
+    authz = _client(ckan, clock)
+    authz.get_token(['ds:org/a:read'])
+    clock.now += 280
+    ckan.denied = True
+    with pytest.raises(client.AuthzClientError) as e:
+        authz.get_token(['ds:org/a:read'])
+    assert e.value.status == 403
+    assert ckan.requests[-2:] == ['/api/3/action/authz_refresh', '/api/3/action/authz_authorize']
+
+
+def test_refresh_times_are_jittered(ckan, clock):
+    authz = _client(ckan, clock, refresh_margin=0, refresh_jitter=0.5)
+    refresh_times = set()
+    for i in range(10):
+        authz.authorize(['ds:org/{}:read'.format(i)])
+    for cached in authz._tokens.values():
+        assert clock.now + 150 <= cached.refresh_at <= clock.now + 300
+        refresh_times.add(cached.refresh_at)
+    assert len(refresh_times) > 1
+
+
+def test_concurrent_requests_are_deduplicated(ckan, clock):
+    authz = _client(ckan, clock)
+    ckan.delay = 0.2
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(authz.get_token(['ds:org/a:read'])))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(tokens)) == 1
+    assert ckan.requests == ['/api/3/action/authz_authorize']
+
+
+def test_public_key_is_revalidated_conditionally(ckan, clock):
+    authz = _client(ckan, clock, key_max_age=60)
+    assert authz.get_public_key() == ckan.public_key
+    clock.now += 30
+    assert authz.get_public_key() == ckan.public_key
+    assert len(ckan.requests) == 1
+
+    clock.now += 30
+    assert authz.get_public_key() == ckan.public_key
+    assert authz.stats()['key_requests'] == 2
+    assert authz.stats()['key_not_modified'] == 1
+
+
+def test_tokens_are_verified_locally(ckan, clock):
+    authz = _client(ckan, clock)
+    token = authz.get_token(['ds:org/a:read'])
+    result = authz.verify(token)
+    assert result['verified']
+    assert result['payload']['scopes'] == 'ds:org/a:read'
+
+    # Claims are checked against the actual time, rather than the client's clock
+    clock.now -= 300
+    result = authz.verify(authz.get_token(['ds:org/b:read']))
+    assert not result['verified']
+    assert result['errors'][0]['reason'] == 'expired'
+    assert 'payload' not in result
+
+
+def test_verification_checks_issuer(ckan, clock):
+    authz = client.AuthzClient(ckan.url, issuer='https://other.example.com', clock=clock)
+    result = authz.verify(authz.get_token(['ds:org/a:read']))
+    assert not result['verified']
+    assert result['errors'][0]['reason'] == 'invalid_issuer'
+
+
+def test_rotated_keys_are_fetched_on_signature_mismatch(ckan, clock):
+    authz = _client(ckan, clock)
+    authz.get_public_key()
+    ckan.rotate_key()
+    token = authz.get_token(['ds:org/a:read'])
+
+    assert not authz.verify(token)['verified']
+    clock.now += client.KEY_RECHECK_INTERVAL
+    assert authz.verify(token)['verified']
+    assert authz.get_public_key() == ckan.public_key
+
+
+def test_symmetric_tokens_require_a_secret(ckan, clock):
+    token = jwt.encode({"sub": "user", "iss": ISSUER}, 'shared', 'HS256')
+    with pytest.raises(ValueError):
+        _client(ckan, clock, algorithm='HS256').verify(token)
+    assert _client(ckan, clock, algorithm='HS256', secret='shared').verify(token)['verified']
+    assert not ckan.requests
@@ -0,0 +1,84 @@
+"""Tests for request deadlines and the authorizer circuit breaker
+"""
+import math
+
+import pytest
+
+from ckanext.authz_service import deadline
+
+from .test_replay import FakeClock
+
+
+def test_deadline_expires():
+    clock = FakeClock(100)
+    limit = deadline.Deadline(0.5, clock=clock)
+    limit.check()
+    clock.now += 0.25
+    assert limit.remaining() == 0.25
+
+    clock.now += 0.25
+    assert limit.expired()
+    assert limit.remaining() == 0
+    with pytest.raises(deadline.Deferred) as e:
+        limit.check()
+    assert e.value.reason == deadline.DEADLINE_EXCEEDED
+
+
+def test_unlimited_deadline_never_expires():
+    limit = deadline.Deadline(math.inf, clock=FakeClock(1e9))
+    assert not limit.expired()
+    assert limit.remaining() == math.inf
+
+
+def test_circuit_opens_after_consecutive_failures():
+    breaker = deadline.CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=FakeClock(100))
+    for _ in range(2):
+        breaker.record_failure('slow')
+    breaker.record_success('slow')
+    for _ in range(2):
+        breaker.record_failure('slow')
+    assert breaker.allow('slow')
+
+    breaker.record_failure('slow')
+    assert not breaker.allow('slow')
+    assert breaker.allow('other')
+    assert breaker.stats() == {"failures": 5, "trips": 1, "rejected": 1, "open": ['slow']}
+
+
+def test_circuit_is_half_opened_after_reset_timeout():
+    clock = FakeClock(100)
+    breaker = deadline.CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+    breaker.record_failure('slow')
+
+    clock.now += 30
+    # Only a single probing call is let through
+    assert breaker.allow('slow')
+    assert not breaker.allow('slow')
+
+    breaker.record_failure('slow')
+    clock.now += 29
+    assert not breaker.allow('slow')
+
+    clock.now += 1
+    assert breaker.allow('slow')
+    breaker.record_success('slow')
+    assert breaker.allow('slow')
+    assert not breaker.is_open('slow')
+    assert breaker.stats()['trips'] == 1
+
+
+def test_deadline_metrics():
+    metrics = deadline.DeadlineMetrics()
+    limit = deadline.Deadline(1)
+    metrics.record(limit)
+    limit.defer('ds:foo:read', deadline.DEADLINE_EXCEEDED)
+    limit.defer('ds:bar:read', deadline.CIRCUIT_OPEN)
+    metrics.record(limit)
+
+    stats = metrics.stats()
+    assert stats['requests'] == 2
+    assert stats['deferred_requests'] == 1
+    assert stats['deferred_scopes'] == 2
+    assert stats[deadline.DEADLINE_EXCEEDED] == 1
+    assert stats[deadline.CIRCUIT_OPEN] == 1
+    assert stats[deadline.AUTHORIZER_TIMEOUT] == 0
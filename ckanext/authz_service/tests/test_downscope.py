@@ -0,0 +1,75 @@
+"""Tests for token downscoping
+"""
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import pytest
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+from ckanext.authz_service import actions
+from ckanext.authz_service.authzzie import Authzzie
+
+from . import tamper_token, user_context
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestDownscopeAction(object):
+
+    def setup(self):
+        self.user = factories.User()
+        self.org = factories.Organization(users=[{'name': self.user['name'], 'capacity': 'admin'}])
+        expires = datetime.now(tz=timezone.utc) + timedelta(seconds=900)
+        token, _ = actions._create_token(model.User.get(self.user['name']),
+                                         ['org:{}:read,update'.format(self.org['name']), 'ds:*:read'], expires)
+        self.token = {"token": token, "expires_at": expires.isoformat()}
+
+    def _downscope(self, scopes, token=None, **kwargs):
+        return helpers.call_action('authz_downscope', {}, token=token or self.token['token'], scopes=scopes, **kwargs)
+
+    def test_covered_scopes_are_granted(self, query_counter):
+        scopes = ['org:{}:read'.format(self.org['name']), 'ds:foo/bar:data:read']
+        with mock.patch.object(Authzzie, '_call_authorizer') as call_authorizer:
+            del query_counter.statements[:]
+            result = self._downscope(scopes)
+
+        call_authorizer.assert_not_called()
+        assert query_counter.statements == []
+        assert result['granted_scopes'] == scopes
+        assert result['user_id'] == self.user['name']
+
+        payload = helpers.call_action('authz_verify', token=result['token'])['payload']
+        assert payload['sub'] == self.user['name']
+        assert payload['scopes'] == ' '.join(scopes)
+
+    def test_uncovered_scopes_are_rejected(self):
+        with pytest.raises(toolkit.NotAuthorized) as e:
+            self._downscope(['org:{}:delete'.format(self.org['name']), 'ds:foo/bar:read'])
+        assert 'org:{}:delete'.format(self.org['name']) in str(e.value)
+
+    def test_downscoped_token_expires_before_original(self):
+        result = self._downscope(['ds:foo/bar:read'], lifetime=10 ** 6)
+        assert result['expires_at'] <= self.token['expires_at']
+
+        with helpers.changed_config('ckanext.authz_service.downscope_max_lifetime', 60):
+            result = self._downscope(['ds:foo/bar:read'])
+        expires_in = datetime.fromisoformat(result['expires_at']).timestamp() - datetime.now().timestamp()
+        assert 0 < expires_in <= 60
+
+    def test_invalid_tokens_can_not_be_downscoped(self):
+        with pytest.raises(toolkit.NotAuthorized):
+            self._downscope(['ds:foo/bar:read'], token=tamper_token(self.token['token']))
+
+    @helpers.change_config('ckanext.authz_service.jwt_include_token_id', True)
+    def test_revoking_original_token_revokes_downscoped_tokens(self):
+        token, _ = actions._create_token(model.User.get(self.user['name']), ['ds:*:read'],
+                                         datetime.now(tz=timezone.utc) + timedelta(seconds=900))
+        downscoped = self._downscope(['ds:foo/bar:read'], token=token)['token']
+
+        with user_context(self.user) as context:
+            helpers.call_action('authz_revoke', context, token=token)
+
+        assert helpers.call_action('authz_verify', token=downscoped)['revoked']
+        with pytest.raises(toolkit.NotAuthorized):
+            self._downscope(['ds:foo/bar:read'], token=downscoped)
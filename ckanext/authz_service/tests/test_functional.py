@@ -23,3 +23,13 @@ def test_get_public_key_no_key_configured(app):
     url = toolkit.url_for('authz_service.public_key')
     response = app.get(url, status=204)
     assert not response.body
+
+
+def test_get_public_key_conditionally(app):
+    url = toolkit.url_for('authz_service.public_key')
+    with temporary_file(RSA_PUB_KEY) as pub_key_file, \
+            helpers.changed_config('ckanext.authz_service.jwt_public_key_file', pub_key_file):
+        etag = app.get(url, status=200).headers['etag']
+        response = app.get(url, headers={"If-None-Match": etag}, status=304)
+
+    assert not response.body
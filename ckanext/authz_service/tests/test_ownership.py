@@ -0,0 +1,103 @@
+import pytest
+from ckan import model
+from ckan.tests import factories, helpers
+
+from ckanext.authz_service.authz_binding import ownership
+
+from . import change_dataset_elsewhere
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestOwnershipIndex(object):
+
+    def setup(self):
+        ownership.reset_ownership_index()
+        self.org = factories.Organization()
+        self.dataset = factories.Dataset(owner_org=self.org['id'])
+        self.resource = factories.Resource(package_id=self.dataset['id'])
+
+    def test_dataset_in_org_by_id_or_name(self):
+        index = ownership.OwnershipIndex()
+        for ds in (self.dataset['id'], self.dataset['name']):
+            for org in (self.org['id'], self.org['name']):
+                assert index.is_dataset_in_org(ds, org)
+
+    def test_dataset_not_in_other_org(self):
+        index = ownership.OwnershipIndex()
+        other_org = factories.Organization()
+        assert not index.is_dataset_in_org(self.dataset['name'], other_org['name'])
+        assert not index.is_dataset_in_org('no-such-dataset', self.org['name'])
+
+    def test_private_flag_is_indexed(self):
+        index = ownership.OwnershipIndex()
+        ds = factories.Dataset(owner_org=self.org['id'], private=True)
+        assert index.get_dataset(ds['name']).private
+        assert not index.get_dataset(self.dataset['name']).private
+
+    def test_state_is_indexed(self):
+        index = ownership.OwnershipIndex()
+        ds = factories.Dataset(owner_org=self.org['id'], state='draft')
+        assert index.get_dataset(ds['name']).state == 'draft'
+        assert index.get_dataset(self.dataset['name']).state == 'active'
+
+    def test_resource_in_dataset_by_id_or_name(self):
+        index = ownership.OwnershipIndex()
+        assert index.is_resource_in_dataset(self.resource['id'], self.dataset['id'])
+        assert index.is_resource_in_dataset(self.resource['id'], self.dataset['name'])
+
+    def test_resource_not_in_other_dataset(self):
+        index = ownership.OwnershipIndex()
+        other_ds = factories.Dataset(owner_org=self.org['id'])
+        assert not index.is_resource_in_dataset(self.resource['id'], other_ds['name'])
+        assert not index.is_resource_in_dataset('no-such-resource', self.dataset['name'])
+
+    def test_index_is_updated_when_dataset_moves(self):
+        index = ownership.get_ownership_index()
+        other_org = factories.Organization()
+        assert index.is_dataset_in_org(self.dataset['name'], self.org['name'])
+
+        helpers.call_action('package_patch', id=self.dataset['id'], owner_org=other_org['id'])
+
+        assert not index.is_dataset_in_org(self.dataset['name'], self.org['name'])
+        assert index.is_dataset_in_org(self.dataset['name'], other_org['name'])
+
+    def test_index_is_updated_when_dataset_is_renamed(self):
+        index = ownership.get_ownership_index()
+        assert index.get_dataset(self.dataset['name']) is not None
+
+        helpers.call_action('package_patch', id=self.dataset['id'], name='renamed-dataset')
+
+        assert index.get_dataset(self.dataset['name']) is None
+        assert index.is_dataset_in_org('renamed-dataset', self.org['name'])
+
+    def test_index_is_updated_when_resource_is_deleted(self):
+        index = ownership.get_ownership_index()
+        assert index.is_resource_in_dataset(self.resource['id'], self.dataset['name'])
+
+        helpers.call_action('resource_delete', id=self.resource['id'])
+
+        assert not index.is_resource_in_dataset(self.resource['id'], self.dataset['name'])
+
+    def test_changes_made_by_other_processes_are_seen_in_the_next_transaction(self):
+        index = ownership.get_ownership_index()
+        other_org = factories.Organization()
+        assert index.is_dataset_in_org(self.dataset['name'], self.org['name'])
+
+        change_dataset_elsewhere(self.dataset['id'], owner_org=other_org['id'])
+        assert not index.is_dataset_in_org(self.dataset['name'], self.org['name'])
+        assert index.is_dataset_in_org(self.dataset['name'], other_org['name'])
+
+    def test_entries_are_loaded_once_per_transaction(self, monkeypatch):
+        index = ownership.OwnershipIndex()
+        calls = []
+        query = ownership._query_dataset
+        monkeypatch.setattr(ownership, '_query_dataset', lambda id: calls.append(id) or query(id))
+
+        for _ in range(3):
+            assert index.is_dataset_in_org(self.dataset['name'], self.org['name'])
+            assert index.is_dataset_in_org(self.dataset['id'], self.org['id'])
+        assert calls == [self.dataset['name']]
+
+        model.Session.commit()
+        assert index.is_dataset_in_org(self.dataset['id'], self.org['id'])
+        assert calls == [self.dataset['name'], self.dataset['id']]
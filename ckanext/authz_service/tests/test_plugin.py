@@ -1,7 +1,61 @@
 """Tests for plugin.py."""
+import subprocess
+import sys
+
+import pytest
+
+import ckanext.authz_service.plugin as plugin
+
+# Modules importing and configuring the plugin should not load, and which CKAN itself never loads; Lazily loaded
+# modules (such as `jwt`) are added to `sys.modules` before they are loaded, so their submodules are checked instead
+DEFERRED_MODULES = ('jwt.api_jwt', 'ckanext.authz_service.actions', 'ckanext.authz_service.authz_binding')
+
+IMPORT_SCRIPT = '''
+import sys
+import ckan.plugins, ckan.plugins.toolkit as toolkit, flask
+before = set(sys.modules)
 import ckanext.authz_service.plugin as plugin
+{}
+print(' '.join(set(sys.modules) - before))
+'''
+
+CONFIGURE = '''
+toolkit.config['ckanext.authz_service.warm_up_on_load'] = 'false'
+plugin.AuthzServicePlugin().configure(toolkit.config)
+'''
 
 
 def test_plugin():
     p = plugin.AuthzServicePlugin()
     assert p
+
+
+def test_plugin_import_defers_heavy_modules():
+    """Test that importing the plugin does not load actions, authorization bindings and the JWT library
+    """
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT.format('')]).decode('utf-8')
+    loaded_modules = set(output.split())
+
+    assert loaded_modules.isdisjoint(DEFERRED_MODULES)
+
+
+def test_plugin_configuration_defers_heavy_modules():
+    """Test that configuring the plugin without warming up does not load the deferred modules either
+    """
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT.format(CONFIGURE)]).decode('utf-8')
+    loaded_modules = set(output.split())
+
+    assert loaded_modules.isdisjoint(DEFERRED_MODULES)
+
+
+@pytest.mark.usefixtures('with_plugins')
+def test_warm_up_freezes_shared_authorizer():
+    """Test that warming up creates a single, frozen authorizer
+    """
+    plugin.reset()
+    plugin.warm_up()
+    authorizer = plugin.get_authorizer()
+
+    assert authorizer.frozen
+    assert authorizer is plugin.get_authorizer()
+    assert 'cryptography' in sys.modules
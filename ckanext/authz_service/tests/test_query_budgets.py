@@ -0,0 +1,82 @@
+"""Query budgets for authorizing different scope shapes
+
+Each budget is the maximal number of SQL queries evaluating a scope of some
+shape may take, with a cold ownership index and permission snapshots
+disabled. Changes making authorization bindings query the DB more than
+before should fail these tests, rather than go unnoticed until they affect
+production.
+"""
+import pytest
+from ckan import model
+from ckan.tests import factories
+
+from ckanext.authz_service.authz_binding import ownership
+from ckanext.authz_service.authzzie import Scope
+from ckanext.authz_service.plugin import init_authorizer
+
+from . import user_context
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestQueryBudgets(object):
+
+    def setup(self):
+        self.user = factories.User()
+        self.org = factories.Organization(users=[{'name': self.user['name'], 'capacity': 'editor'}])
+        self.datasets = [factories.Dataset(owner_org=self.org['id']) for _ in range(5)]
+        self.resource = factories.Resource(package_id=self.datasets[0]['id'])
+
+        self.az = init_authorizer()
+        ownership.reset_ownership_index()
+        model.Session.remove()
+
+    def _authorize(self, scopes, query_counter):
+        scopes = [Scope.from_string(s.format(org=self.org['name'], ds=self.datasets[0]['name'],
+                                             res=self.resource['id'])) for s in scopes]
+        with user_context(self.user):
+            del query_counter.statements[:]
+            granted = self.az.authorize_scopes(scopes)
+        return granted, query_counter.count
+
+    @pytest.mark.parametrize('scope, budget', [
+        ('org:{org}:read', 2),
+        ('ds:{org}/{ds}:read', 3),
+        ('ds:{org}/{ds}', 3),
+        ('ds:{org}/{ds}:data:read', 3),
+        ('res:{org}/{ds}/{res}:read', 4),
+        ('res:{org}/{ds}/*', 3),
+    ])
+    def test_scope_query_budget(self, scope, budget, query_counter):
+        granted, queries = self._authorize([scope], query_counter)
+        assert granted[0] is not None
+        assert queries <= budget, '\n'.join(query_counter.statements)
+
+    def test_dataset_scopes_query_budget_grows_linearly(self, query_counter):
+        """Test that scopes for more datasets take at most a fixed number of additional queries each
+        """
+        scopes = ['ds:{}/{}:read'.format('{org}', ds['name']) for ds in self.datasets]
+        granted, queries = self._authorize(scopes, query_counter)
+        assert all(granted)
+        assert queries <= 2 * len(scopes) + 1, '\n'.join(query_counter.statements)
+
+    def test_scopes_of_one_dataset_share_its_load(self, query_counter):
+        """Test that all scopes referring to the same dataset take no more queries than each does alone
+        """
+        scopes = ['ds:{org}/{ds}:read', 'ds:{org}/{ds}:metadata:update', 'res:{org}/{ds}/*:read']
+        granted, queries = self._authorize(scopes, query_counter)
+        assert all(granted)
+        assert queries <= 5, '\n'.join(query_counter.statements)
+
+    def test_multi_ref_scopes_query_budget_is_constant(self, query_counter):
+        """Test that multi-reference scopes take the same number of queries, regardless of the number of entities
+        """
+        resources = [self.resource] + [factories.Resource(package_id=self.datasets[0]['id']) for _ in range(4)]
+        ownership.reset_ownership_index()
+        model.Session.remove()
+
+        # Braces are doubled to survive formatting in `_authorize`
+        scopes = ['ds:{org}/{{' + ','.join(ds['name'] for ds in self.datasets) + '}}:read',
+                  'res:{org}/{ds}/{{' + ','.join(res['id'] for res in resources) + '}}:read']
+        granted, queries = self._authorize(scopes, query_counter)
+        assert [len(scope.entity_refs) for scope in granted] == [5, 5]
+        assert queries <= 6, '\n'.join(query_counter.statements)
@@ -0,0 +1,83 @@
+"""Tests for cost based rate limiting
+"""
+import math
+
+import pytest
+
+from ckanext.authz_service.authzzie import Scope
+from ckanext.authz_service.cache import MemoryCacheBackend
+from ckanext.authz_service.ratelimit import CostModel, TokenBucketLimiter
+
+from .test_replay import FakeClock
+
+
+@pytest.mark.parametrize('scope_str, expected', [
+    ('org:foo:read', 1),
+    ('org:*:read', 10),
+    ('ds:foo/bar:read', 1),
+    ('ds:foo/*:read', 10),
+    ('res:foo/bar/baz:read', 2),
+    ('res:foo/bar/*:read', 20),
+    ('ds:foo/bar:data:read', 2),
+    ('ds', 10),
+    ('res:foo/bar/{a,b,c}:read', 6),
+    ('ds:foo/{a,b}:data:read', 4),
+])
+def test_scope_cost(scope_str, expected):
+    model = CostModel(CostModel.parse_type_costs('org:1 ds:1 res:2'), wildcard_factor=10, subscope_cost=1)
+    assert model.scope_cost(Scope.from_string(scope_str)) == expected
+
+
+def test_unknown_entity_types_have_default_cost():
+    model = CostModel({'org': 5}, default_type_cost=3, wildcard_factor=1)
+    assert model.request_cost([Scope.from_string('foo:bar:read'), Scope.from_string('org:bar:read')]) == 8
+
+
+def test_token_bucket_admits_up_to_burst():
+    clock = FakeClock(1000)
+    limiter = TokenBucketLimiter(MemoryCacheBackend(clock=clock), rate=1, burst=10, clock=clock)
+    assert limiter.consume('alice', 6) == 0
+    assert limiter.consume('alice', 4) == 0
+    assert limiter.consume('alice', 2) == pytest.approx(2)
+    assert limiter.consume('bob', 10) == 0
+    assert limiter.stats() == {'admitted': 3, 'rejected': 1}
+
+
+def test_token_bucket_refills_over_time():
+    clock = FakeClock(1000)
+    limiter = TokenBucketLimiter(MemoryCacheBackend(clock=clock), rate=2, burst=10, clock=clock)
+    assert limiter.consume('alice', 10) == 0
+    assert limiter.consume('alice', 4) == pytest.approx(2)
+
+    clock.now += 2
+    assert limiter.consume('alice', 4) == 0
+    assert limiter.consume('alice', 1) > 0
+
+    clock.now += 100
+    assert limiter.consume('alice', 10) == 0
+
+
+def test_token_bucket_rejects_cost_higher_than_burst():
+    limiter = TokenBucketLimiter(MemoryCacheBackend(), rate=1, burst=10)
+    assert math.isinf(limiter.consume('alice', 11))
+    assert limiter.consume('alice', 10) == 0
+
+
+def test_token_bucket_refund():
+    clock = FakeClock(1000)
+    limiter = TokenBucketLimiter(MemoryCacheBackend(clock=clock), rate=1, burst=10, clock=clock)
+    limiter.consume('alice', 8)
+    limiter.refund('alice', 8)
+    assert limiter.consume('alice', 10) == 0
+
+
+def test_full_buckets_are_not_stored():
+    clock = FakeClock(1000)
+    backend = MemoryCacheBackend(clock=clock)
+    limiter = TokenBucketLimiter(backend, rate=1, burst=10, clock=clock)
+    limiter.consume('alice', 5)
+    assert backend.get('alice') is not None
+
+    clock.now += 5
+    assert backend.get('alice') is None
+    assert limiter.consume('alice', 10) == 0
@@ -0,0 +1,98 @@
+"""Tests for token refresh
+"""
+from unittest import mock
+
+import pytest
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+from ckanext.authz_service import actions
+from ckanext.authz_service.authz_binding import refresh, snapshot
+
+from . import tamper_token, user_context
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestRefreshAction(object):
+
+    @pytest.fixture(autouse=True)
+    def reuse_scopes(self):
+        with helpers.changed_config('ckanext.authz_service.refresh_reuse_scopes', True):
+            yield
+
+    def setup(self):
+        snapshot.listen_for_membership_changes()
+        self.user = factories.User()
+        self.org = factories.Organization(users=[{'name': self.user['name'], 'capacity': 'editor'}])
+        self.dataset = factories.Dataset(owner_org=self.org['id'])
+        self.scopes = ['org:{}:read'.format(self.org['name']),
+                       'ds:{}/{}:read'.format(self.org['name'], self.dataset['name'])]
+
+    def _authorize(self):
+        with user_context(self.user) as context:
+            return helpers.call_action('authz_authorize', context, scopes=self.scopes)
+
+    def _refresh(self, token, user=None):
+        with user_context(user or self.user) as context:
+            return helpers.call_action('authz_refresh', context, token=token)
+
+    def test_unchanged_scopes_are_reused(self):
+        token = self._authorize()['token']
+        with mock.patch.object(actions, '_evaluate_scopes') as evaluate_scopes:
+            result = self._refresh(token)
+            evaluate_scopes.assert_not_called()
+
+        assert result['granted_scopes'] == self.scopes
+        assert result['refreshed'] == {'reused_scopes': self.scopes, 'evaluated_scopes': []}
+
+        # Refreshed tokens can be refreshed again
+        assert self._refresh(result['token'])['refreshed']['evaluated_scopes'] == []
+
+    def test_scopes_of_changed_datasets_are_reevaluated(self):
+        token = self._authorize()['token']
+        helpers.call_action('package_patch', id=self.dataset['id'], notes='changed')
+
+        result = self._refresh(token)
+        assert result['refreshed'] == {'reused_scopes': self.scopes[:1], 'evaluated_scopes': self.scopes[1:]}
+        assert result['granted_scopes'] == self.scopes
+
+    def test_scopes_of_deleted_datasets_are_not_granted(self):
+        token = self._authorize()['token']
+        helpers.call_action('package_delete', id=self.dataset['id'])
+
+        result = self._refresh(token)
+        assert result['granted_scopes'] == self.scopes[:1]
+
+    def test_all_scopes_are_reevaluated_after_membership_changes(self):
+        token = self._authorize()['token']
+        helpers.call_action('organization_member_create', id=self.org['id'], username=self.user['name'],
+                            role='member')
+
+        result = self._refresh(token)
+        assert result['refreshed']['reused_scopes'] == []
+        assert result['granted_scopes'] == self.scopes
+
+    def test_all_scopes_are_reevaluated_after_max_reuse_age(self):
+        token = self._authorize()['token']
+        with helpers.changed_config('ckanext.authz_service.refresh_max_reuse_age', -1):
+            result = self._refresh(token)
+        assert result['refreshed']['reused_scopes'] == []
+
+    def test_scopes_are_reevaluated_without_state_claim(self):
+        with helpers.changed_config('ckanext.authz_service.refresh_reuse_scopes', False):
+            token = self._authorize()['token']
+        assert refresh.STATE_CLAIM not in helpers.call_action('authz_verify', token=token)['payload']
+
+        result = self._refresh(token)
+        assert result['refreshed'] == {'reused_scopes': [], 'evaluated_scopes': self.scopes}
+        assert result['granted_scopes'] == self.scopes
+
+    def test_tokens_of_other_users_can_not_be_refreshed(self):
+        token = self._authorize()['token']
+        with pytest.raises(toolkit.NotAuthorized):
+            self._refresh(token, user=factories.User())
+
+    def test_invalid_tokens_can_not_be_refreshed(self):
+        token = self._authorize()['token']
+        with pytest.raises(toolkit.NotAuthorized):
+            self._refresh(tamper_token(token))
@@ -0,0 +1,96 @@
+"""Tests for token replay detection
+"""
+from ckanext.authz_service import cache, replay
+
+
+class FakeClock(object):
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_replayed_token_ids_are_detected():
+    detector = replay.ReplayDetector(900)
+    assert not detector.is_replayed('token-1')
+    assert not detector.is_replayed('token-2')
+    assert detector.is_replayed('token-1')
+    assert detector.is_replayed('token-2')
+
+
+def test_token_ids_are_remembered_for_max_lifetime():
+    clock = FakeClock(1000)
+    detector = replay.ReplayDetector(900, clock=clock)
+    assert not detector.is_replayed('token-1')
+
+    clock.now += 899
+    assert detector.is_replayed('token-1')
+
+
+def test_token_ids_are_forgotten_after_two_periods():
+    clock = FakeClock(900)
+    detector = replay.ReplayDetector(900, clock=clock)
+    assert not detector.is_replayed('token-1')
+
+    clock.now += 1800
+    assert not detector.is_replayed('token-1')
+
+
+def test_checking_without_recording():
+    for detector in (replay.ReplayDetector(900), replay.SharedReplayDetector(cache.MemoryCacheBackend(), 900)):
+        assert not detector.is_replayed('token-1', record=False)
+        assert not detector.is_replayed('token-1')
+        assert detector.is_replayed('token-1', record=False)
+
+
+def test_payload_without_jti_is_considered_replayed():
+    detector = replay.ReplayDetector(900)
+    assert detector.is_payload_replayed({"sub": "user"})
+    assert not detector.is_payload_replayed({"sub": "user", "jti": "token-1"})
+    assert detector.is_payload_replayed({"sub": "user", "jti": "token-1"})
+
+
+def test_bucket_falls_back_to_bloom_filter_beyond_capacity():
+    detector = replay.ReplayDetector(900, capacity=100, error_rate=0.0001)
+    for i in range(1000):
+        assert not detector.is_replayed('token-{}'.format(i))
+
+    assert all(detector.is_replayed('token-{}'.format(i)) for i in range(1000))
+    assert detector._current._exact is None
+
+
+def test_shared_detector_detects_token_ids_seen_by_other_detectors():
+    backend = cache.MemoryCacheBackend()
+    first = replay.SharedReplayDetector(backend, 900)
+    second = replay.SharedReplayDetector(backend, 900)
+    assert not first.is_payload_replayed({"sub": "user", "jti": "token-1"})
+    assert second.is_payload_replayed({"sub": "user", "jti": "token-1"})
+    assert second.is_payload_replayed({"sub": "user"})
+
+
+def test_shared_detector_forgets_token_ids_once_tokens_expire():
+    clock = FakeClock(1000)
+    backend = cache.MemoryCacheBackend(clock=clock)
+    detector = replay.SharedReplayDetector(backend, 900, clock=clock)
+    assert not detector.is_replayed('token-1', expires_at=1060)
+    assert not detector.is_replayed('token-2')
+
+    clock.now += 59
+    assert detector.is_replayed('token-1', expires_at=1060)
+    clock.now += 1
+    assert not detector.is_replayed('token-1', expires_at=1060)
+    assert detector.is_replayed('token-2')
+
+    clock.now += 840
+    assert not detector.is_replayed('token-2')
+
+
+def test_bloom_filter_false_positive_rate():
+    bloom = replay.BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add('in-{}'.format(i))
+
+    false_positives = sum(1 for i in range(10000) if 'out-{}'.format(i) in bloom)
+    assert false_positives < 200
@@ -0,0 +1,69 @@
+"""Tests for token revocation
+"""
+from ckanext.authz_service.cache import MemoryCacheBackend
+from ckanext.authz_service.revocation import RevocationList
+
+from .test_replay import FakeClock
+
+
+def _revocation_list(clock):
+    return RevocationList(MemoryCacheBackend(clock=clock), 900, clock=clock)
+
+
+def test_revoke_token_by_id():
+    clock = FakeClock(1000)
+    revocations = _revocation_list(clock)
+    revocations.revoke_token('token-1', expires_at=1600)
+
+    assert revocations.is_revoked({"jti": "token-1", "sub": "user", "iat": 900})
+    assert not revocations.is_revoked({"jti": "token-2", "sub": "user", "iat": 900})
+
+
+def test_revoking_a_token_revokes_derived_tokens():
+    clock = FakeClock(1000)
+    revocations = _revocation_list(clock)
+    revocations.revoke_token('token-1', expires_at=1600)
+
+    assert revocations.is_revoked({"jti": "token-2", "parent_jti": "token-1"})
+    assert revocations.is_revoked({"parent_jti": "token-1"})
+    assert not revocations.is_revoked({"jti": "token-3", "parent_jti": "token-2"})
+
+
+def test_token_revocation_expires_with_token():
+    clock = FakeClock(1000)
+    revocations = _revocation_list(clock)
+    revocations.revoke_token('token-1', expires_at=1600)
+
+    clock.now = 1600
+    assert not revocations.is_revoked({"jti": "token-1"})
+
+
+def test_revoke_subject():
+    clock = FakeClock(1000)
+    revocations = _revocation_list(clock)
+    revocations.revoke_subject('user')
+
+    assert revocations.is_revoked({"sub": "user", "iat": 999})
+    assert not revocations.is_revoked({"sub": "other-user", "iat": 999})
+
+    clock.now = 1001
+    assert not revocations.is_revoked({"sub": "user", "iat": 1001})
+
+
+def test_revoke_subject_issued_before():
+    clock = FakeClock(1000)
+    revocations = _revocation_list(clock)
+    revocations.revoke_subject('user', issued_before=800)
+    revocations.revoke_subject('user', issued_before=700)
+
+    assert revocations.is_revoked({"sub": "user", "nbf": 750})
+    assert not revocations.is_revoked({"sub": "user", "nbf": 850})
+
+
+def test_subject_revocation_expires_after_max_lifetime():
+    clock = FakeClock(1000)
+    revocations = _revocation_list(clock)
+    revocations.revoke_subject('user')
+
+    clock.now = 1900
+    assert not revocations.is_revoked({"sub": "user", "iat": 999})
@@ -0,0 +1,100 @@
+"""Tests for role matrix authorization bindings
+"""
+import pytest
+from ckan.tests import factories, helpers
+
+from ckanext.authz_service.authz_binding import roles
+from ckanext.authz_service.authzzie import RoleMatrixAuthorizer, Scope
+from ckanext.authz_service.plugin import init_authorizer
+
+from . import change_dataset_elsewhere, user_context
+
+ORG_ROLES = ('admin', 'editor', 'member')
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestRoleMatrixAuthorizers(object):
+
+    def setup(self):
+        self.users = {role: factories.User() for role in ORG_ROLES}
+        self.users['other'] = factories.User()
+        self.org = factories.Organization(users=[{'name': self.users[role]['name'], 'capacity': role}
+                                                 for role in ORG_ROLES])
+        self.dataset = factories.Dataset(owner_org=self.org['id'], private=True)
+        self.resource = factories.Resource(package_id=self.dataset['id'])
+        self.az = init_authorizer()
+
+    def test_default_matrix_is_derived_from_ckan_role_permissions(self):
+        matrix = roles.get_default_role_matrix()
+        assert matrix.get_actions('admin', 'org') == {'read', 'update', 'patch', 'delete'}
+        assert matrix.get_actions('editor', 'org') == {'read'}
+        assert matrix.get_actions('editor', 'ds', 'data') == {'read', 'update', 'patch', 'delete'}
+        assert matrix.get_actions('member', 'ds') == {'read'}
+        assert matrix.get_actions('editor', 'res') == {'read', 'update', 'delete'}
+
+    @pytest.mark.parametrize('user', ORG_ROLES + ('other',))
+    @pytest.mark.parametrize('scope', [
+        'org:{org}',
+        'ds:{org}/{ds}',
+        'ds:{ds}',
+        'ds:{org}/{ds}:data:*',
+        'res:{org}/{ds}/{res}',
+        'res:{org}/{ds}/*',
+    ])
+    def test_matrix_grants_match_live_checks(self, user, scope):
+        """Test that permissions taken from the role matrix are the same as those checked live
+        """
+        scope = scope.format(org=self.org['name'], ds=self.dataset['name'], res=self.resource['id'])
+        with user_context(self.users[user]):
+            from_matrix = self.az.get_granted_actions(Scope.from_string(scope))
+            with helpers.changed_config('ckanext.authz_service.role_matrix_authorizers', False):
+                live = init_authorizer().get_granted_actions(Scope.from_string(scope))
+
+        assert from_matrix == live
+
+    def test_matrix_grants_take_a_single_query(self, query_counter):
+        scope = Scope.from_string('ds:{}/{}'.format(self.org['name'], self.dataset['name']))
+        with user_context(self.users['editor']):
+            self.az.get_granted_actions(scope)  # Load the dataset into the ownership index
+            del query_counter.statements[:]
+            assert self.az.get_granted_actions(scope) == {'read', 'update', 'patch', 'delete'}
+
+        assert query_counter.count == 1
+
+    def test_roles_follow_datasets_moved_by_other_processes(self):
+        other_org = factories.Organization()
+        with user_context(self.users['admin']) as context:
+            assert roles.get_dataset_role(self.dataset['id'], context=context) == 'admin'
+
+        change_dataset_elsewhere(self.dataset['id'], owner_org=other_org['id'])
+        scope = Scope.from_string('ds:{}'.format(self.dataset['name']))
+        with user_context(self.users['admin']) as context:
+            assert roles.get_dataset_role(self.dataset['id'], context=context) is None
+            assert self.az.get_granted_actions(scope) == set()
+
+    def test_roles_follow_datasets_deleted_by_other_processes(self):
+        with user_context(self.users['editor']) as context:
+            assert roles.get_dataset_role(self.dataset['id'], context=context) == 'editor'
+
+        change_dataset_elsewhere(self.dataset['id'], state='deleted')
+        with user_context(self.users['editor']) as context:
+            assert roles.get_dataset_role(self.dataset['id'], context=context) is None
+            assert roles.get_resource_role(self.resource['id'], self.dataset['id'], context=context) is None
+
+    def test_inactive_datasets_are_checked_live(self):
+        draft = factories.Dataset(owner_org=self.org['id'], state='draft')
+        with user_context(self.users['member']) as context:
+            assert roles.get_dataset_role(draft['id'], context=context) is None
+            assert roles.get_dataset_role(self.dataset['id'], context=context) == 'member'
+
+    @helpers.change_config('ckan.auth.allow_dataset_collaborators', True)
+    def test_datasets_are_checked_live_with_collaborators(self):
+        with user_context(self.users['member']) as context:
+            assert roles.get_dataset_role(self.dataset['id'], context=context) is None
+
+    @helpers.change_config('ckanext.authz_service.role_matrix_authorizers', False)
+    def test_matrix_authorizers_can_be_disabled(self):
+        az = init_authorizer()
+        authorizers = az._get_scope_authorizers(Scope.from_string('org:{}:read'.format(self.org['name'])))
+        assert authorizers
+        assert not any(isinstance(check, RoleMatrixAuthorizer) for check in authorizers)
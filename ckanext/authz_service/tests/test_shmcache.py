@@ -0,0 +1,170 @@
+"""Tests for the shared memory cache backend
+"""
+import multiprocessing
+import os
+
+import pytest
+
+from ckanext.authz_service import cache, shmcache, util
+
+from .test_replay import FakeClock
+
+
+@pytest.fixture()
+def path(tmp_path):
+    return str(tmp_path / 'cache')
+
+
+def _backend(path, namespace='test', clock=None, slots=64, slot_size=256):
+    table = shmcache.SharedTable(path, slots, slot_size, clock=clock or FakeClock(1000))
+    return shmcache.MmapCacheBackend(namespace, table)
+
+
+def test_get_set_delete(path):
+    backend = _backend(path)
+    assert backend.get('foo') is None
+    backend.set('foo', {'bar': 1})
+    assert backend.get('foo') == {'bar': 1}
+    backend.set('foo', [1, 2])
+    assert backend.get('foo') == [1, 2]
+    backend.delete('foo')
+    assert backend.get('foo') is None
+
+
+def test_entries_expire(path):
+    clock = FakeClock(1000)
+    backend = _backend(path, clock=clock)
+    backend.set('foo', 'bar', ttl=10)
+    backend.set('baz', 'bar')
+
+    clock.now += 10
+    assert backend.get('foo') is None
+    assert backend.get('baz') == 'bar'
+    assert backend.stats()['entries'] == 1
+
+
+def test_entries_are_shared_between_tables_mapping_the_same_file(path):
+    writer = _backend(path)
+    reader = _backend(path)
+    writer.set('foo', 'bar', ttl=60)
+    assert reader.get('foo') == 'bar'
+    reader.delete('foo')
+    assert writer.get('foo') is None
+
+
+def test_namespaces_are_separate(path):
+    revocations = _backend(path, 'revocations')
+    decisions = _backend(path, 'decisions')
+    revocations.set('foo', 1)
+    decisions.set('foo', 2)
+    assert revocations.get('foo') == 1
+
+    decisions.clear()
+    assert decisions.get('foo') is None
+    assert revocations.get('foo') == 1
+
+
+def test_least_recently_set_entries_with_ttl_are_evicted(path):
+    clock = FakeClock(1000)
+    # With as many slots as probed for each key, all keys compete for the same slots
+    backend = _backend(path, clock=clock, slots=shmcache.PROBE_LENGTH)
+    backend.incr('counter')
+    for i in range(shmcache.PROBE_LENGTH):
+        clock.now += 1
+        backend.set('key-{}'.format(i), i, ttl=60)
+
+    assert backend.get('counter') == 1
+    assert backend.get('key-0') is None
+    assert backend.get('key-1') == 1
+    assert backend.get('key-{}'.format(shmcache.PROBE_LENGTH - 1)) == shmcache.PROBE_LENGTH - 1
+
+
+def test_keys_are_updated_in_place_past_expired_slots(path):
+    clock = FakeClock(1000)
+    table = shmcache.SharedTable(path, 64, 256, clock=clock)
+    key = b'counter'
+    key_hash = shmcache._hash(key)
+    window = table._probe(key_hash)
+    # The key is stored in the last slot of its window, behind an expired entry
+    table._write_slot(window[-1], key_hash, key, b'1', 0.0, clock.now)
+    table._write_slot(window[0], shmcache._hash(b'other'), b'other', b'1', clock.now - 1, clock.now - 10)
+
+    assert table.incr(key) == 2
+    assert table.get(key) == b'2'
+    assert [index for index, stored_key, _ in table.scan() if stored_key == key] == [window[-1]]
+
+
+def test_add_only_sets_missing_or_expired_keys(path):
+    clock = FakeClock(1000)
+    first = _backend(path, clock=clock)
+    second = _backend(path, clock=clock)
+    assert first.add('foo', 1, ttl=10)
+    assert not second.add('foo', 2, ttl=10)
+    assert second.get('foo') == 1
+
+    clock.now += 10
+    assert second.add('foo', 2)
+    assert first.get('foo') == 2
+
+
+def test_oversized_values_are_not_stored(path):
+    backend = _backend(path)
+    backend.set('foo', 'bar')
+    backend.set('foo', 'x' * 1000)
+    assert backend.get('foo') is None
+    assert backend.stats()['oversized'] == 1
+
+
+def test_stats(path):
+    backend = _backend(path)
+    backend.set('foo', 'bar')
+    backend.get('foo')
+    backend.get('baz')
+    stats = backend.stats()
+    assert stats['entries'] == 1
+    assert stats['slots'] == 64
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['hit_rate'] == 0.5
+
+
+def test_file_structure_must_match(path):
+    shmcache.SharedTable(path, 64, 256)
+    with pytest.raises(ValueError):
+        shmcache.SharedTable(path, 128, 256)
+
+
+def _increment(path, count):
+    backend = _backend(path)
+    for _ in range(count):
+        backend.incr('counter')
+        backend.set('pid-{}'.format(os.getpid()), os.getpid())
+
+
+def test_concurrent_increments_from_multiple_processes(path):
+    backend = _backend(path)
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_increment, args=(path, 200)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert backend.get('counter') == 800
+    for process in processes:
+        assert backend.get('pid-{}'.format(process.pid)) == process.pid
+
+
+def test_mmap_backend_is_created_from_config(path):
+    util.set_config({"ckanext.authz_service.cache_backend": "mmap",
+                     "ckanext.authz_service.cache_mmap_file": path,
+                     "ckanext.authz_service.cache_mmap_slots": "128"})
+    try:
+        backend = cache.get_backend('test')
+        assert isinstance(backend, shmcache.MmapCacheBackend)
+        assert backend.stats()['slots'] == 128
+        backend.set('foo', 'bar')
+        assert cache.get_backend('other').get('foo') is None
+    finally:
+        util.set_config(None)
+        cache.reset_backends()
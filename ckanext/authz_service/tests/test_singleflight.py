@@ -0,0 +1,129 @@
+"""Tests for single-flight execution
+"""
+import threading
+
+import pytest
+
+from ckanext.authz_service.singleflight import SingleFlight
+
+
+def _run_concurrently(count, target):
+    results = [None] * count
+    errors = [None] * count
+
+    def run(i):
+        try:
+            results[i] = target()
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    return threads, results, errors
+
+
+def _wait_for_waiters(flight, count):
+    """Wait until `count` calls joined the in-flight call
+    """
+    for _ in range(1000):
+        if flight.stats()['calls'] >= count:
+            return
+        threading.Event().wait(0.005)
+    raise AssertionError('Calls did not start in time')
+
+
+def test_concurrent_calls_share_a_single_call():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        release.wait(5)
+        return {'result': 42}
+
+    threads, results, errors = _run_concurrently(5, lambda: flight.do('key', work))
+    _wait_for_waiters(flight, 5)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [{'result': 42}] * 5
+    assert errors == [None] * 5
+    assert flight.stats() == {'calls': 5, 'shared': 4, 'timeouts': 0, 'in_flight': 0}
+
+
+def test_errors_are_propagated_to_waiting_calls():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def work():
+        release.wait(5)
+        raise ValueError('failed')
+
+    threads, results, errors = _run_concurrently(3, lambda: flight.do('key', work))
+    _wait_for_waiters(flight, 3)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert all(isinstance(e, ValueError) for e in errors)
+
+
+def test_calls_with_different_keys_are_not_shared():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def work(key):
+        calls.append(key)
+        release.wait(5)
+        return key
+
+    threads = [threading.Thread(target=flight.do, args=(k, work, k)) for k in ('a', 'b')]
+    for t in threads:
+        t.start()
+    _wait_for_waiters(flight, 2)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert sorted(calls) == ['a', 'b']
+
+
+def test_results_are_not_cached():
+    flight = SingleFlight()
+    calls = []
+    flight.do('key', calls.append, 1)
+    flight.do('key', calls.append, 2)
+    assert calls == [1, 2]
+
+
+def test_waiting_calls_time_out_and_do_the_work():
+    flight = SingleFlight(timeout=0.05)
+    release = threading.Event()
+    leader = threading.Thread(target=flight.do, args=('key', release.wait, 5))
+    leader.start()
+    _wait_for_waiters(flight, 1)
+
+    assert flight.do('key', lambda: 'own result') == 'own result'
+    assert flight.stats()['timeouts'] == 1
+
+    release.set()
+    leader.join()
+
+
+def test_reentrant_calls_do_not_wait():
+    flight = SingleFlight(timeout=5)
+    result = flight.do('key', lambda: flight.do('key', lambda: 'inner'))
+    assert result == 'inner'
+    assert flight.stats()['timeouts'] == 0
+
+
+def test_errors_are_raised_to_the_leader():
+    flight = SingleFlight()
+    with pytest.raises(KeyError):
+        flight.do('key', {}.__getitem__, 'missing')
+    assert flight.stats()['in_flight'] == 0
@@ -0,0 +1,100 @@
+import pytest
+from ckan.tests import factories, helpers
+
+from ckanext.authz_service import cache
+from ckanext.authz_service.authz_binding import dataset, organization, snapshot
+from ckanext.authz_service.authzzie import Scope
+from ckanext.authz_service.plugin import init_authorizer
+
+from . import user_context
+
+ORG_ROLES = ('admin', 'editor', 'member')
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'shared_cache')
+class TestPermissionSnapshot(object):
+
+    def setup(self):
+        snapshot.listen_for_membership_changes()
+        self.users = {role: factories.User() for role in ORG_ROLES}
+        self.org = factories.Organization(users=[{'name': user['name'], 'capacity': role}
+                                                 for role, user in self.users.items()])
+        self.az = init_authorizer()
+
+    @helpers.change_config('ckanext.authz_service.permission_snapshots', True)
+    def test_snapshot_maps_orgs_to_roles(self):
+        for role, user in self.users.items():
+            with user_context(user):
+                snap = snapshot.get_permission_snapshot()
+            assert snap.get_role(self.org['id']) == role
+            assert snap.get_role(self.org['name']) == role
+            assert snap.get_role('some-other-org') is None
+            assert snap.get_org_actions('some-other-org') is None
+
+    @pytest.mark.parametrize('role', ORG_ROLES)
+    @pytest.mark.parametrize('entity_type, ref', [
+        ('org', '{org}'),
+        ('ds', '{org}/*'),
+        ('ds', '{org}/'),
+    ])
+    def test_snapshot_grants_match_live_checks(self, role, entity_type, ref):
+        """Test that permissions taken from a snapshot are the same as those checked live
+        """
+        scope = '{}:{}'.format(entity_type, ref.format(org=self.org['name']))
+        with user_context(self.users[role]):
+            live = self.az.get_granted_actions(Scope.from_string(scope))
+            with helpers.changed_config('ckanext.authz_service.permission_snapshots', True):
+                from_snapshot = self.az.get_granted_actions(Scope.from_string(scope))
+
+        assert from_snapshot == live
+
+    @helpers.change_config('ckanext.authz_service.permission_snapshots', True)
+    def test_snapshot_is_reused(self, monkeypatch):
+        calls = []
+        query = snapshot._query_memberships
+        monkeypatch.setattr(snapshot, '_query_memberships', lambda user: calls.append(user) or query(user))
+
+        with user_context(self.users['admin']) as context:
+            for _ in range(3):
+                assert organization.check_org_permissions(self.org['name'], context=context) == \
+                    {'read', 'update', 'patch', 'delete'}
+                assert dataset.check_dataset_permissions('*', self.org['name'], context=context) == \
+                    {'create', 'list', 'read', 'update', 'patch', 'delete'}
+
+        assert calls == [self.users['admin']['name']]
+
+    @helpers.change_config('ckanext.authz_service.permission_snapshots', True)
+    def test_snapshot_is_invalidated_by_membership_changes(self):
+        user = self.users['member']
+        with user_context(user) as context:
+            assert organization.check_org_permissions(self.org['name'], context=context) == {'read'}
+
+        helpers.call_action('organization_member_create', id=self.org['id'], username=user['name'], role='admin')
+
+        with user_context(user) as context:
+            assert organization.check_org_permissions(self.org['name'], context=context) == \
+                {'read', 'update', 'patch', 'delete'}
+
+    @helpers.change_config('ckanext.authz_service.permission_snapshots', True)
+    def test_snapshot_is_not_used_for_sysadmins(self):
+        user = factories.Sysadmin()
+        helpers.call_action('organization_member_create', id=self.org['id'], username=user['name'], role='member')
+
+        with user_context(user) as context:
+            assert snapshot.get_permission_snapshot(context) is None
+            assert dataset.check_dataset_permissions('*', self.org['name'], context=context) == \
+                {'create', 'list', 'read', 'update', 'patch', 'delete'}
+
+    @helpers.change_config('ckanext.authz_service.permission_snapshots', True)
+    def test_snapshots_are_not_used_with_a_per_process_cache_backend(self):
+        with helpers.changed_config('ckanext.authz_service.cache_backend', 'memory'):
+            cache.reset_backends()
+            with user_context(self.users['admin']) as context:
+                assert snapshot.get_permission_snapshot(context) is None
+                assert organization.check_org_permissions(self.org['name'], context=context) == \
+                    {'read', 'update', 'patch', 'delete'}
+        cache.reset_backends()
+
+    def test_snapshots_are_disabled_by_default(self):
+        with user_context(self.users['admin']):
+            assert snapshot.get_permission_snapshot() is None
@@ -0,0 +1,86 @@
+"""Tests for authorization tracing
+"""
+import pytest
+
+from ckanext.authz_service import tracing
+from ckanext.authz_service.authzzie import Authzzie, Scope
+
+
+@pytest.fixture()
+def tracer():
+    tracer = tracing.InMemoryTracer()
+    tracing.set_tracer(tracer)
+    yield tracer
+    tracing.set_tracer(None)
+
+
+def test_default_tracer_is_noop():
+    assert isinstance(tracing.get_tracer(), tracing.NoopTracer)
+    with tracing.span('test', {'foo': 'bar'}) as span:
+        span.set_attribute('baz', 1)
+
+
+def test_in_memory_tracer_records_nested_spans(tracer):
+    with tracing.span('outer', {'foo': 'bar'}) as outer:
+        with tracing.span('inner'):
+            pass
+        outer.set_attribute('baz', 1)
+
+    inner, outer = tracer.spans
+    assert inner.name == 'inner'
+    assert inner.parent is outer
+    assert outer.parent is None
+    assert outer.attributes == {'foo': 'bar', 'baz': 1}
+    assert outer.end_time >= inner.end_time
+
+
+def test_in_memory_tracer_records_errors(tracer):
+    with pytest.raises(ValueError):
+        with tracing.span('failing'):
+            raise ValueError('oops')
+
+    assert isinstance(tracer.get_spans('failing')[0].error, ValueError)
+
+
+def test_authorize_scopes_spans(tracer):
+    def read_only(**_):
+        return {'read'}
+
+    azz = Authzzie()
+    azz.register_authorizer('org', read_only, actions={'read', 'update'})
+    azz.authorize_scopes([Scope('org', 'foo', ['read', 'update'])])
+
+    scope_span, = tracer.get_spans('authz.scope')
+    authorizer_span, = tracer.get_spans('authz.authorizer')
+    assert authorizer_span.parent is scope_span
+    assert scope_span.attributes == {'authz.entity_type': 'org',
+                                     'authz.entity_ref': 'foo',
+                                     'authz.subscope': None,
+                                     'authz.actions': 'read,update',
+                                     'authz.granted_actions': 'read',
+                                     'authz.granted': True}
+    assert authorizer_span.attributes['authz.authorizer'].endswith('read_only')
+    assert authorizer_span.attributes['authz.granted_actions'] == 'read'
+
+
+def test_denied_scope_spans(tracer):
+    azz = Authzzie()
+    azz.register_authorizer('org', lambda **_: set())
+    azz.authorize_scopes([Scope('org', 'foo')])
+
+    scope_span, = tracer.get_spans('authz.scope')
+    assert scope_span.attributes['authz.actions'] == '*'
+    assert scope_span.attributes['authz.granted_actions'] == ''
+    assert scope_span.attributes['authz.granted'] is False
+
+
+def test_create_tracer():
+    assert isinstance(tracing.create_tracer('none'), tracing.NoopTracer)
+    assert isinstance(tracing.create_tracer('memory'), tracing.InMemoryTracer)
+    with pytest.raises(ValueError):
+        tracing.create_tracer('foo')
+
+
+def test_otel_attributes_conversion():
+    assert tracing._to_otel_attributes({'a': None, 'b': {'y', 'x'}, 'c': 1, 'd': object}) == \
+        {'b': ['x', 'y'], 'c': 1, 'd': str(object)}
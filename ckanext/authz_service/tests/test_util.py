@@ -1,3 +1,4 @@
+import pytest
 from ckan.tests import helpers
 
 from ckanext.authz_service import util
@@ -35,3 +36,18 @@ class TestConfigUtils(object):
 
     def test_get_config_bool_returns_default(self):
         assert util.get_config_bool('foo_option', True) is True
+
+    def test_set_config_replaces_ckan_config(self):
+        try:
+            util.set_config({'ckanext.authz_service.foo_option': 'yes', 'ckan.site_url': 'http://example.com'})
+            assert not util.is_ckan_config()
+            assert util.get_config_bool('foo_option') is True
+            assert util.get_global_config('ckan.site_url') == 'http://example.com'
+        finally:
+            util.set_config(None)
+        assert util.is_ckan_config()
+        assert util.get_config('foo_option') is None
+
+    def test_asbool_rejects_invalid_values(self):
+        with pytest.raises(ValueError):
+            util.asbool('maybe')
@@ -0,0 +1,85 @@
+"""Tests for single pass token verification
+"""
+import time
+
+import jwt
+import pytest
+
+from ckanext.authz_service import verification
+
+KEY = 'this-is-a-test-only-key'
+
+
+def _token(key=KEY, algorithm='HS256', **claims):
+    payload = {"sub": "user", "iss": "https://ckan.example.com", "exp": int(time.time()) + 60,
+               "nbf": int(time.time()) - 1}
+    payload.update(claims)
+    return jwt.encode({k: v for k, v in payload.items() if v is not None}, key, algorithm)
+
+
+def _reasons(result):
+    return {(e['claim'], e['reason']) for e in result['errors']}
+
+
+def test_valid_token_is_verified():
+    result = verification.verify_token(_token(), KEY, 'HS256', issuer='https://ckan.example.com')
+    assert result['verified']
+    assert result['errors'] == []
+    assert result['payload']['sub'] == 'user'
+    assert result['header']['alg'] == 'HS256'
+
+
+@pytest.mark.parametrize('claims, kwargs, expected', [
+    ({"exp": int(time.time()) - 10}, {}, {('exp', 'expired')}),
+    ({"nbf": int(time.time()) + 60}, {}, {('nbf', 'not_yet_valid')}),
+    ({"exp": "tomorrow"}, {}, {('exp', 'invalid')}),
+    ({"iss": "https://evil.example.com"}, {"issuer": "https://ckan.example.com"}, {('iss', 'invalid_issuer')}),
+    ({"iss": None}, {"issuer": "https://ckan.example.com"}, {('iss', 'missing')}),
+    ({"aud": "some-service"}, {}, {('aud', 'invalid_audience')}),
+    ({}, {"audience": "some-service"}, {('aud', 'missing')}),
+    ({"aud": ["other", "some-service"]}, {"audience": "some-service"}, set()),
+    ({"exp": int(time.time()) - 10, "aud": "x"}, {"audience": "y"}, {('exp', 'expired'), ('aud', 'invalid_audience')}),
+])
+def test_claim_errors(claims, kwargs, expected):
+    result = verification.verify_token(_token(**claims), KEY, 'HS256', **kwargs)
+    assert _reasons(result) == expected
+    assert result['verified'] is not expected
+    assert result['payload']['sub'] == 'user'
+
+
+def test_invalid_signature():
+    result = verification.verify_token(_token(key='some-other-key'), KEY, 'HS256')
+    assert _reasons(result) == {('signature', 'invalid_signature')}
+    assert result['payload']['sub'] == 'user'
+
+
+def test_disallowed_algorithm():
+    result = verification.verify_token(_token(algorithm='HS512'), KEY, ['HS256'])
+    assert _reasons(result) == {('alg', 'disallowed_algorithm')}
+
+
+def test_none_algorithm_is_never_verified():
+    result = verification.verify_token(_token(key=None, algorithm='none'), KEY, ['none'])
+    assert _reasons(result) == {('signature', 'invalid_signature')}
+
+
+@pytest.mark.parametrize('token', ['foo', 'foo.bar.baz', b'\xff.\xff.\xff', 'WzFd.WzFd.'])
+def test_malformed_token(token):
+    result = verification.verify_token(token, KEY, 'HS256')
+    assert _reasons(result) == {('token', 'malformed')}
+    assert result['payload'] is None
+
+
+def test_signature_is_verified_once(monkeypatch):
+    calls = []
+    verification.verify_token(_token(), KEY, 'HS256')
+    alg_obj = verification._algorithms['HS256']
+    original = alg_obj.verify
+
+    def verify(*args):
+        calls.append(args)
+        return original(*args)
+
+    monkeypatch.setattr(alg_obj, 'verify', verify)
+    verification.verify_token(_token(exp=int(time.time()) - 10), KEY, 'HS256')
+    assert len(calls) == 1
@@ -0,0 +1,236 @@
+"""Tests for the standalone token verification app
+"""
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+from unittest import mock
+
+import jwt
+import pytest
+
+from ckanext.authz_service import cache, keys, util, verifier, wsgi
+
+SECRET = 'not-so-secret'
+
+CONFIG = {"ckan.site_url": "https://ckan.example.com",
+          "ckanext.authz_service.jwt_algorithm": "HS256",
+          "ckanext.authz_service.jwt_private_key": SECRET}
+
+
+@pytest.fixture()
+def app():
+    yield wsgi.VerificationApp(dict(CONFIG))
+    util.set_config(None)
+    cache.reset_backends()
+    keys.clear_cache()
+    verifier.reset_replay_detector()
+
+
+def _token(**claims):
+    payload = {"sub": "user", "iss": CONFIG['ckan.site_url'], "exp": time.time() + 300, "scopes": "ds:foo:read"}
+    payload.update(claims)
+    token = jwt.encode(payload, SECRET, 'HS256')
+    return token.decode('ascii') if isinstance(token, bytes) else token
+
+
+def _request(app, path, method='GET', query='', body=None, content_type='application/json', headers=None):
+    environ = {"REQUEST_METHOD": method, "PATH_INFO": path, "QUERY_STRING": query}
+    environ.update(headers or {})
+    if body is not None:
+        environ.update({"CONTENT_TYPE": content_type,
+                        "CONTENT_LENGTH": str(len(body)),
+                        "wsgi.input": io.BytesIO(body)})
+    response = {}
+
+    def start_response(status, headers):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = dict(headers)
+
+    response['body'] = b''.join(app(environ, start_response))
+    return response
+
+
+def _call_action(app, name, data):
+    response = _request(app, '/api/3/action/{}'.format(name), 'POST', body=json.dumps(data).encode('utf-8'))
+    return response['status'], json.loads(response['body'].decode('utf-8'))
+
+
+def test_verify_valid_token(app):
+    status, response = _call_action(app, 'authz_verify', {"token": _token()})
+    assert status == 200
+    assert response['success']
+    assert response['help'] == 'https://ckan.example.com/api/3/action/help_show?name=authz_verify'
+    assert response['result']['verified']
+    assert response['result']['payload']['scopes'] == 'ds:foo:read'
+
+
+def test_verify_invalid_token(app):
+    status, response = _call_action(app, 'authz_verify', {"token": _token(exp=time.time() - 10), "strict": False})
+    assert status == 200
+    assert not response['result']['verified']
+    assert response['result']['errors'][0]['reason'] == 'expired'
+    assert response['result']['message'] == 'Signature has expired'
+    assert response['result']['payload']['sub'] == 'user'
+
+
+def test_verify_with_query_string_and_form_data(app):
+    response = _request(app, '/api/action/authz_verify', query='token={}'.format(_token()))
+    assert json.loads(response['body'].decode('utf-8'))['result']['verified']
+
+    response = _request(app, '/api/action/authz_verify', 'POST', body='token={}'.format(_token()).encode('ascii'),
+                        content_type='application/x-www-form-urlencoded')
+    assert json.loads(response['body'].decode('utf-8'))['result']['verified']
+
+
+def test_revoked_tokens_are_not_verified(app):
+    verifier.get_revocation_list().revoke_subject('user')
+    status, response = _call_action(app, 'authz_verify', {"token": _token(iat=time.time() - 10)})
+    assert not response['result']['verified']
+    assert response['result']['revoked']
+
+
+def test_replayed_tokens_are_not_verified(app):
+    token = _token(jti='token-1')
+    assert _call_action(app, 'authz_verify', {"token": token, "check_replay": True})[1]['result']['verified']
+    status, response = _call_action(app, 'authz_verify', {"token": token, "check_replay": True})
+    assert response['result']['replayed']
+
+
+def test_get_requests_do_not_use_up_tokens(app):
+    token = _token(jti='token-1')
+    for _ in range(2):
+        response = _request(app, '/api/3/action/authz_verify', query='token={}&check_replay=true'.format(token))
+        assert json.loads(response['body'].decode('utf-8'))['result']['verified']
+
+    assert _call_action(app, 'authz_verify', {"token": token, "check_replay": True})[1]['result']['verified']
+    response = _request(app, '/api/3/action/authz_verify', query='token={}&check_replay=true'.format(token))
+    assert json.loads(response['body'].decode('utf-8'))['result']['replayed']
+
+
+def test_replayed_tokens_are_detected_across_processes_with_a_shared_cache(tmp_path):
+    config = dict(CONFIG, **{"ckanext.authz_service.cache_backend": "mmap",
+                             "ckanext.authz_service.cache_mmap_file": str(tmp_path / 'cache')})
+    token = _token(jti='token-1')
+    try:
+        assert _call_action(wsgi.VerificationApp(dict(config)), 'authz_verify',
+                            {"token": token, "check_replay": True})[1]['result']['verified']
+        # Another process has its own replay detector and backend instances, sharing the same file
+        cache.reset_backends()
+        verifier.reset_replay_detector()
+        status, response = _call_action(wsgi.VerificationApp(dict(config)), 'authz_verify',
+                                        {"token": token, "check_replay": True})
+        assert response['result']['replayed']
+    finally:
+        util.set_config(None)
+        cache.reset_backends()
+        verifier.reset_replay_detector()
+
+
+def test_verified_tokens_are_cached(app):
+    app = wsgi.VerificationApp(dict(CONFIG, **{"ckanext.authz_service.verified_token_cache_ttl": "60"}))
+    token = _token(jti='token-2')
+    assert _call_action(app, 'authz_verify', {"token": token})[1]['result']['verified']
+
+    with mock.patch('ckanext.authz_service.verification.verify_token') as verify_token:
+        status, response = _call_action(app, 'authz_verify', {"token": token})
+        verify_token.assert_not_called()
+    assert response['result']['verified']
+    assert response['result']['payload']['jti'] == 'token-2'
+    assert cache.get_backend(verifier.TOKEN_CACHE_NAMESPACE).stats()['hits'] == 1
+
+    # Revocations still apply to cached tokens
+    verifier.get_revocation_list().revoke_token('token-2')
+    assert _call_action(app, 'authz_verify', {"token": token})[1]['result']['revoked']
+
+
+def test_verified_token_cache_entries_do_not_outlive_tokens():
+    backend = cache.MemoryCacheBackend(clock=lambda: 1000)
+    token_cache = verifier.VerifiedTokenCache(backend, 60, 'key-1', clock=lambda: 1000)
+    token_cache.set('token', {"exp": 1010})
+    token_cache.set('expired-token', {"exp": 990})
+
+    assert token_cache.get('token') == {"exp": 1010}
+    assert token_cache.get('expired-token') is None
+    assert verifier.VerifiedTokenCache(backend, 60, 'key-2').get('token') is None
+
+
+def test_missing_token(app):
+    status, response = _call_action(app, 'authz_verify', {})
+    assert status == 409
+    assert not response['success']
+    assert response['error'] == {"__type": "Validation Error", "token": "Missing value"}
+
+
+@pytest.mark.parametrize('path, body, expected_status', [
+    ('/api/3/action/package_show', b'{}', 400),
+    ('/api/3/action/authz_verify', b'not json', 400),
+    ('/api/3/action/authz_verify', b'[]', 400),
+    ('/dataset', b'', 404),
+])
+def test_bad_requests(app, path, body, expected_status):
+    assert _request(app, path, 'POST', body=body)['status'] == expected_status
+
+
+def test_public_key_not_configured(app):
+    status, response = _call_action(app, 'authz_public_key', {})
+    assert status == 404
+    assert response['error']['__type'] == 'Not Found Error'
+    assert _request(app, '/authz/public_key')['status'] == 204
+
+
+def test_app_requires_a_key():
+    try:
+        with pytest.raises(ValueError):
+            wsgi.VerificationApp({"ckanext.authz_service.jwt_algorithm": "HS256"})
+    finally:
+        util.set_config(None)
+
+
+def test_load_config(tmp_path):
+    config_file = tmp_path / 'ckan.ini'
+    config_file.write_text('[DEFAULT]\ndebug = false\n\n'
+                           '[app:main]\n'
+                           'ckan.site_url = http://localhost\n'
+                           'ckanext.authz_service.jwt_public_key_file = %(here)s/jwt.pub\n'
+                           'ckan.datetime_format = %d %B %Y\n')
+    config = wsgi.load_config(str(config_file))
+    assert config['ckan.site_url'] == 'http://localhost'
+    assert config['ckanext.authz_service.jwt_public_key_file'] == os.path.join(str(tmp_path), 'jwt.pub')
+    assert config['ckan.datetime_format'] == '%d %B %Y'
+
+
+def test_app_does_not_load_ckan():
+    code = ('import sys; import ckanext.authz_service.wsgi; '
+            'print(" ".join(m for m in sys.modules if m == "ckan" or m.startswith("ckan.")))')
+    output = subprocess.check_output([sys.executable, '-c', code]).decode('utf-8')
+    assert output.split() == []
+
+
+def test_public_key_conditional_requests(tmp_path):
+    pub_key_file = tmp_path / 'jwt.pub'
+    pub_key_file.write_bytes(b'-----BEGIN PUBLIC KEY-----\n...\n-----END PUBLIC KEY-----\n')
+    app = wsgi.VerificationApp(dict(CONFIG, **{"ckanext.authz_service.jwt_public_key_file": str(pub_key_file)}))
+    try:
+        response = _request(app, '/authz/public_key')
+        assert response['status'] == 200
+        etag = response['headers']['ETag']
+
+        environ_headers = {"HTTP_IF_NONE_MATCH": etag}
+        response = _request(app, '/authz/public_key', headers=environ_headers)
+        assert response['status'] == 304
+        assert not response['body']
+
+        pub_key_file.write_bytes(b'-----BEGIN PUBLIC KEY-----\n.\n-----END PUBLIC KEY-----\n')
+        os.utime(str(pub_key_file), (time.time() + 10, time.time() + 10))
+        assert _request(app, '/authz/public_key', headers=environ_headers)['status'] == 200
+    finally:
+        util.set_config(None)
+        keys.clear_cache()
+
+
+def test_public_key_etag_is_the_same_for_text_and_bytes():
+    pub_key = b'-----BEGIN PUBLIC KEY-----\n...\n-----END PUBLIC KEY-----\n'
+    assert keys.get_public_key_etag(pub_key) == keys.get_public_key_etag(pub_key.decode('ascii'))
@@ -0,0 +1,226 @@
+"""Optional tracing of authorization work
+
+Code in this extension wraps significant units of work (authorization
+requests, scope evaluation, authorizer calls, CKAN auth checks and token
+signing) in nested spans created by the current tracer. Three tracers are
+available:
+
+* `NoopTracer` (the default) - does nothing, and adds negligible overhead
+* `InMemoryTracer` - records finished spans in memory; Useful in tests
+* `OpenTelemetryTracer` - creates OpenTelemetry spans, which are nested in
+  any span active when authorization starts (e.g. a CKAN request span). Use
+  `create_otlp_tracer` to export them to an OTLP collector. Requires the
+  `opentelemetry-sdk` and `opentelemetry-exporter-otlp-proto-http` packages.
+
+This module does not depend on CKAN.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, ContextManager, Dict, Iterable, List, Optional
+
+DEFAULT_OTLP_ENDPOINT = 'http://localhost:4318/v1/traces'
+
+DEFAULT_SERVICE_NAME = 'ckan'
+
+Attributes = Optional[Dict[str, Any]]
+
+
+class NullSpan(object):
+    """A span that does nothing
+    """
+
+    def set_attribute(self, key, value):
+        # type: (str, Any) -> None
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = NullSpan()
+
+
+class NoopTracer(object):
+    """A tracer that does nothing
+    """
+
+    def span(self, name, attributes=None):
+        # type: (str, Attributes) -> ContextManager[Any]
+        """Create a span, to be used as a context manager; The span is yielded as the context
+        """
+        return _NULL_SPAN
+
+
+class RecordedSpan(object):
+    """A span recorded by `InMemoryTracer`
+    """
+
+    def __init__(self, name, attributes=None, parent=None):
+        # type: (str, Attributes, Optional[RecordedSpan]) -> None
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.parent = parent
+        self.start_time = time.time()
+        self.end_time = None  # type: Optional[float]
+        self.error = None  # type: Optional[BaseException]
+
+    def set_attribute(self, key, value):
+        # type: (str, Any) -> None
+        self.attributes[key] = value
+
+    def __repr__(self):
+        return '<RecordedSpan {} {}>'.format(self.name, self.attributes)
+
+
+class InMemoryTracer(object):
+    """A tracer that records finished spans in memory
+
+    >>> tracer = InMemoryTracer()
+    >>> with tracer.span('outer'):
+    ...     with tracer.span('inner', {'foo': 'bar'}):
+    ...         pass
+    >>> [(s.name, s.parent.name if s.parent else None) for s in tracer.spans]
+    [('inner', 'outer'), ('outer', None)]
+    """
+
+    def __init__(self):
+        self.spans = []  # type: List[RecordedSpan]
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, attributes=None):
+        # type: (str, Attributes) -> Iterable[RecordedSpan]
+        stack = self._get_stack()
+        span = RecordedSpan(name, attributes, stack[-1] if stack else None)
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = e
+            raise
+        finally:
+            stack.pop()
+            span.end_time = time.time()
+            with self._lock:
+                self.spans.append(span)
+
+    def get_spans(self, name):
+        # type: (str) -> List[RecordedSpan]
+        """Get all finished spans with a given name
+        """
+        return [s for s in self.spans if s.name == name]
+
+    def clear(self):
+        # type: () -> None
+        with self._lock:
+            self.spans = []
+
+    def _get_stack(self):
+        # type: () -> List[RecordedSpan]
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+
+class OpenTelemetryTracer(object):
+    """A tracer that creates OpenTelemetry spans
+
+    If no OpenTelemetry tracer is provided, one is obtained from the globally
+    configured tracer provider.
+    """
+
+    def __init__(self, tracer=None):
+        # type: (Any) -> None
+        if tracer is None:
+            from opentelemetry import trace
+            tracer = trace.get_tracer(__name__)
+        self._tracer = tracer
+
+    def span(self, name, attributes=None):
+        # type: (str, Attributes) -> ContextManager[Any]
+        return self._tracer.start_as_current_span(name, attributes=_to_otel_attributes(attributes))
+
+
+_tracer = NoopTracer()  # type: Any
+
+
+def get_tracer():
+    # type: () -> Any
+    """Get the current tracer
+    """
+    return _tracer
+
+
+def set_tracer(tracer):
+    # type: (Any) -> None
+    """Set the current tracer; Passing `None` restores the default, no-op tracer
+    """
+    global _tracer
+    _tracer = tracer if tracer is not None else NoopTracer()
+
+
+def span(name, attributes=None):
+    # type: (str, Attributes) -> ContextManager[Any]
+    """Create a span using the current tracer
+    """
+    return _tracer.span(name, attributes)
+
+
+def create_tracer(tracer_type, otlp_endpoint=DEFAULT_OTLP_ENDPOINT, service_name=DEFAULT_SERVICE_NAME):
+    # type: (str, str, str) -> Any
+    """Create a tracer by type: `none`, `memory`, `opentelemetry` (using the global tracer provider) or `otlp`
+    """
+    if tracer_type in ('none', '', None):
+        return NoopTracer()
+    elif tracer_type == 'memory':
+        return InMemoryTracer()
+    elif tracer_type == 'opentelemetry':
+        return OpenTelemetryTracer()
+    elif tracer_type == 'otlp':
+        return create_otlp_tracer(otlp_endpoint, service_name)
+
+    raise ValueError("Unknown tracer type: {}".format(tracer_type))
+
+
+def create_otlp_tracer(endpoint=DEFAULT_OTLP_ENDPOINT, service_name=DEFAULT_SERVICE_NAME):
+    # type: (str, str) -> OpenTelemetryTracer
+    """Create an OpenTelemetry tracer exporting spans in batches to an OTLP/HTTP collector
+    """
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+    return OpenTelemetryTracer(provider.get_tracer(__name__))
+
+
+def format_actions(actions):
+    # type: (Optional[Iterable[str]]) -> str
+    """Format a set of actions as a span attribute value, where `None` means any action
+    """
+    if actions is None:
+        return '*'
+    return ','.join(sorted(actions))
+
+
+def _to_otel_attributes(attributes):
+    # type: (Attributes) -> Dict[str, Any]
+    """Convert attributes to types supported by OpenTelemetry, dropping `None` values
+    """
+    converted = {}
+    for key, value in (attributes or {}).items():
+        if value is None:
+            continue
+        if isinstance(value, (set, frozenset, list, tuple)):
+            value = [str(v) for v in sorted(value)]
+        elif not isinstance(value, (str, bool, int, float)):
+            value = str(value)
+        converted[key] = value
+    return converted
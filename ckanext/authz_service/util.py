@@ -1,28 +1,111 @@
 """Useful utility functions
 """
-from typing import Any, Optional
-
-import ckan.plugins.toolkit as toolkit
+import importlib.util
+import sys
+from types import ModuleType
+from typing import Any, Mapping, Optional
 
 CONFIG_PREFIX = __package__
 
+TRUE_VALUES = ('true', 'yes', 'on', 'y', 't', '1')
+
+FALSE_VALUES = ('false', 'no', 'off', 'n', 'f', '0')
+
+_config = None  # type: Optional[Mapping[str, Any]]
+
 
 def get_config(key, default=None):
     # type: (str, Optional[Any]) -> Optional[str]
     """Get configuration option for this CKAN plugin
     """
-    return toolkit.config.get('{}.{}'.format(CONFIG_PREFIX, key), default)
+    return get_global_config('{}.{}'.format(CONFIG_PREFIX, key), default)
 
 
 def get_config_bool(key, default=False):
     # type: (str, bool) -> bool
     """Get a boolean configuration option for this CKAN plugin
     """
-    return toolkit.asbool(get_config(key, default))
+    return asbool(get_config(key, default))
 
 
 def get_config_int(key, default=0):
     # type: (str, int) -> int
     """Get an integer configuration option for this CKAN plugin
     """
-    return toolkit.asint(get_config(key, default))
+    return asint(get_config(key, default))
+
+
+def get_global_config(key, default=None):
+    # type: (str, Optional[Any]) -> Any
+    """Get a configuration option not specific to this plugin, such as `ckan.site_url`
+    """
+    if _config is not None:
+        return _config.get(key, default)
+
+    from ckan.plugins import toolkit
+    return toolkit.config.get(key, default)
+
+
+def set_config(config):
+    # type: (Optional[Mapping[str, Any]]) -> None
+    """Read configuration options from a mapping rather than from CKAN's configuration
+
+    This allows using configuration dependent code without loading CKAN (see
+    `wsgi`). Passing `None` reverts to reading CKAN's configuration.
+    """
+    global _config
+    _config = config
+
+
+def is_ckan_config():
+    # type: () -> bool
+    """Tell if configuration options are read from CKAN's configuration
+    """
+    return _config is None
+
+
+def asbool(value):
+    # type: (Any) -> bool
+    """Convert a configuration value to a boolean, the same way CKAN does
+    """
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in TRUE_VALUES:
+            return True
+        elif value in FALSE_VALUES:
+            return False
+        raise ValueError("String is not true/false: {!r}".format(value))
+    return bool(value)
+
+
+def asint(value):
+    # type: (Any) -> int
+    """Convert a configuration value to an integer, the same way CKAN does
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError("Bad integer value: {!r}".format(value))
+
+
+def lazy_module(name):
+    # type: (str) -> ModuleType
+    """Get a module object which is only actually loaded on first attribute access
+
+    This allows deferring the cost of importing heavy dependencies (such as
+    `jwt` and `cryptography`) from CKAN's startup time to when they are first
+    used (or to when `plugin.warm_up` is called).
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named '{}'".format(name), name=name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
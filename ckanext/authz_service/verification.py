@@ -0,0 +1,179 @@
+"""Single pass JWT token verification
+
+Tokens are parsed once, their signature is checked at most once, and each
+registered claim (`exp`, `nbf`, `iat`, `iss` and `aud`) is then evaluated
+separately. Instead of failing on the first problem found, verification
+returns a list of machine readable errors, one per failed check, along with
+the token payload if it could be decoded.
+
+This module does not depend on CKAN.
+"""
+import json
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from jwt.algorithms import get_default_algorithms
+from jwt.exceptions import InvalidKeyError
+from jwt.utils import base64url_decode
+
+AlgorithmsList = Union[str, Iterable[str]]
+
+EncodedToken = Union[str, bytes]
+
+_algorithms = {}  # type: Dict[str, Any]
+
+
+class MalformedToken(ValueError):
+    pass
+
+
+def verify_token(token, key, algorithms, issuer=None, audience=None, leeway=0, now=None):
+    # type: (EncodedToken, Any, AlgorithmsList, Optional[str], Optional[str], float, Optional[float]) -> Dict[str, Any]
+    """Verify a token and evaluate its claims
+
+    Returns a dict with the following keys:
+
+    * `verified` - `True` if the token's signature and all claims are valid
+    * `header` - the decoded token header, or `None` if the token is malformed
+    * `payload` - the decoded token payload, or `None` if the token is malformed
+    * `errors` - a list of errors; Each error is a dict with the `claim` it
+      applies to (or `token`, `alg` or `signature`), a machine readable
+      `reason` and a human readable `message`.
+
+    `issuer` and `audience` are checked only if provided, except that a token
+    with an `aud` claim is not accepted if no `audience` is provided.
+    """
+    if isinstance(algorithms, str):
+        algorithms = [algorithms]
+
+    try:
+        header, payload, signing_input, signature = _parse(token)
+    except MalformedToken as e:
+        return {"verified": False,
+                "header": None,
+                "payload": None,
+                "errors": [_error('token', 'malformed', str(e))]}
+
+    errors = []
+    if header.get('alg') not in algorithms:
+        errors.append(_error('alg', 'disallowed_algorithm', 'The specified alg value is not allowed'))
+    elif not _verify_signature(header['alg'], key, signing_input, signature):
+        errors.append(_error('signature', 'invalid_signature', 'Signature verification failed'))
+
+    errors.extend(check_claims(payload, issuer, audience, leeway, now))
+
+    return {"verified": not errors,
+            "header": header,
+            "payload": payload,
+            "errors": errors}
+
+
+def decode_payload(token):
+    # type: (EncodedToken) -> Dict[str, Any]
+    """Decode a token's payload without verifying it
+
+    Raises `MalformedToken` if the token can not be decoded.
+    """
+    return _parse(token)[1]
+
+
+def check_claims(payload, issuer=None, audience=None, leeway=0, now=None):
+    # type: (Dict[str, Any], Optional[str], Optional[str], float, Optional[float]) -> List[Dict[str, str]]
+    """Evaluate the registered claims of a decoded payload, returning a list of errors
+    """
+    if now is None:
+        now = time.time()
+
+    errors = []  # type: List[Dict[str, str]]
+    exp = _get_numeric_claim(payload, 'exp', errors)
+    if exp is not None and exp <= now - leeway:
+        errors.append(_error('exp', 'expired', 'Signature has expired'))
+
+    nbf = _get_numeric_claim(payload, 'nbf', errors)
+    if nbf is not None and nbf > now + leeway:
+        errors.append(_error('nbf', 'not_yet_valid', 'The token is not yet valid (nbf)'))
+
+    _get_numeric_claim(payload, 'iat', errors)
+
+    if issuer is not None:
+        if 'iss' not in payload:
+            errors.append(_error('iss', 'missing', 'Token is missing the "iss" claim'))
+        elif payload['iss'] != issuer:
+            errors.append(_error('iss', 'invalid_issuer', 'Invalid issuer'))
+
+    errors.extend(_check_audience(payload, audience))
+    return errors
+
+
+def _check_audience(payload, audience):
+    # type: (Dict[str, Any], Optional[str]) -> List[Dict[str, str]]
+    """Check the `aud` claim
+    """
+    if 'aud' not in payload:
+        if audience is not None:
+            return [_error('aud', 'missing', 'Token is missing the "aud" claim')]
+        return []
+
+    token_audience = payload['aud']
+    if isinstance(token_audience, str):
+        token_audience = [token_audience]
+    if audience is None or not isinstance(token_audience, list) or audience not in token_audience:
+        return [_error('aud', 'invalid_audience', 'Invalid audience')]
+
+    return []
+
+
+def _get_numeric_claim(payload, claim, errors):
+    # type: (Dict[str, Any], str, List[Dict[str, str]]) -> Optional[float]
+    """Get a numeric date claim from the payload, adding an error if it is not numeric
+    """
+    if claim not in payload:
+        return None
+    try:
+        return float(payload[claim])
+    except (TypeError, ValueError):
+        errors.append(_error(claim, 'invalid', '{} claim must be a number'.format(claim)))
+        return None
+
+
+def _parse(token):
+    # type: (EncodedToken) -> Tuple[Dict[str, Any], Dict[str, Any], bytes, bytes]
+    """Parse a token into its header, payload, signing input and signature
+    """
+    if isinstance(token, str):
+        token = token.encode('utf-8')
+
+    try:
+        signing_input, encoded_signature = token.rsplit(b'.', 1)
+        encoded_header, encoded_payload = signing_input.split(b'.', 1)
+        header = json.loads(base64url_decode(encoded_header).decode('utf-8'))
+        payload = json.loads(base64url_decode(encoded_payload).decode('utf-8'))
+        signature = base64url_decode(encoded_signature)
+    except (ValueError, TypeError) as e:
+        raise MalformedToken('Invalid token: {}'.format(e))
+
+    if not isinstance(header, dict) or not isinstance(payload, dict):
+        raise MalformedToken('Invalid token: header and payload must be JSON objects')
+
+    return header, payload, signing_input, signature
+
+
+def _verify_signature(algorithm, key, signing_input, signature):
+    # type: (str, Any, bytes, bytes) -> bool
+    """Verify the token signature using the specified algorithm
+    """
+    if not _algorithms:
+        _algorithms.update(get_default_algorithms())
+    alg_obj = _algorithms.get(algorithm)
+    if alg_obj is None:
+        return False
+    try:
+        key = alg_obj.prepare_key(key)
+        return bool(alg_obj.verify(signing_input, key, signature))
+    except (InvalidKeyError, ValueError, TypeError):
+        return False
+
+
+def _error(claim, reason, message):
+    # type: (str, str, str) -> Dict[str, str]
+    return {"claim": claim, "reason": reason, "message": message}
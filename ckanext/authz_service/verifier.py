@@ -0,0 +1,235 @@
+"""Token verification service
+
+`TokenVerifier` verifies tokens issued by this extension, including checking
+that they were not revoked or replayed, and produces the results returned by
+the `authz_verify` action. The functions in this module create the verifier
+and its components from configuration, and are shared by the CKAN actions
+and by the standalone verification app (see `wsgi`), so that both accept and
+reject exactly the same tokens.
+
+If enabled, the payloads of verified tokens are cached in a cache backend
+(see `cache`), so that with a shared backend each token's signature and
+claims are checked once by any of the worker processes, rather than on every
+request by each of them. Revocation and replay are checked on every request.
+
+This module does not depend on CKAN.
+"""
+import hashlib
+import json
+import time
+from typing import Any, Callable, Dict, Optional, Union
+
+from . import cache, keys, util
+from .cache import CacheBackend
+from .replay import DEFAULT_CAPACITY, ReplayDetector, SharedReplayDetector
+from .revocation import RevocationList
+
+verification = util.lazy_module('ckanext.authz_service.verification')
+
+DEFAULT_MAX_LIFETIME = 900
+
+TOKEN_CACHE_NAMESPACE = 'tokens'
+
+REPLAY_CACHE_NAMESPACE = 'replay'
+
+_replay_detector = None  # type: Optional[Union[ReplayDetector, SharedReplayDetector]]
+
+
+class VerifiedTokenCache(object):
+    """Cache of verified token payloads, keyed by a hash of the token
+
+    `verification_id` identifies the key, algorithm, issuer and audience
+    tokens are verified with, so that entries are not reused once any of these
+    change. Entries expire after `ttl` seconds, and never later than the token.
+    """
+
+    def __init__(self, backend, ttl, verification_id, clock=time.time):
+        # type: (CacheBackend, float, str, Callable[[], float]) -> None
+        self._backend = backend
+        self._ttl = ttl
+        self._verification_id = verification_id.encode('utf-8')
+        self._clock = clock
+
+    def get(self, token):
+        # type: (verification.EncodedToken) -> Optional[Dict[str, Any]]
+        """Get the payload of a token verified before, or `None`
+        """
+        return self._backend.get(self._key(token))
+
+    def set(self, token, payload):
+        # type: (verification.EncodedToken, Dict[str, Any]) -> None
+        """Cache the payload of a verified token
+        """
+        ttl = self._ttl
+        if isinstance(payload.get('exp'), (int, float)):
+            ttl = min(ttl, payload['exp'] - self._clock())
+        if ttl > 0:
+            self._backend.set(self._key(token), payload, ttl)
+
+    def _key(self, token):
+        # type: (verification.EncodedToken) -> str
+        if isinstance(token, str):
+            token = token.encode('ascii', 'replace')
+        return hashlib.sha256(self._verification_id + b':' + token).hexdigest()
+
+
+class TokenVerifier(object):
+    """Verifies tokens, and checks that they have not been revoked or replayed
+    """
+
+    def __init__(self,
+                 key,  # type: Any
+                 algorithm,  # type: str
+                 issuer=None,  # type: Optional[str]
+                 audience=None,  # type: Optional[str]
+                 revocations=None,  # type: Optional[RevocationList]
+                 replay_detector=None,  # type: Optional[Union[ReplayDetector, SharedReplayDetector]]
+                 token_cache=None,  # type: Optional[VerifiedTokenCache]
+                 ):
+        # type: (...) -> None
+        self._key = key
+        self._algorithm = algorithm
+        self._issuer = issuer
+        self._audience = audience
+        self._revocations = revocations
+        self._replay_detector = replay_detector
+        self._token_cache = token_cache
+
+    def verify(self, token, strict=True, check_replay=False, record_replay=True):
+        # type: (verification.EncodedToken, bool, bool, bool) -> Dict[str, Any]
+        """Verify a token, returning an `authz_verify` result
+
+        If `strict` is `True`, the payload is only included if the token is
+        valid. If `record_replay` is `False`, replays are checked without
+        recording the token as used.
+        """
+        verified = self._verify_token(token)
+        result = {"verified": verified['verified'],
+                  "payload": verified['payload'],
+                  "errors": verified['errors']}
+
+        if result['verified']:
+            result.update(self.check_state(result['payload'], check_replay, record_replay))
+        else:
+            result['message'] = verified['errors'][0]['message']
+
+        if (strict and not result['verified']) or result['payload'] is None:
+            del result['payload']
+
+        return result
+
+    def _verify_token(self, token):
+        # type: (verification.EncodedToken) -> Dict[str, Any]
+        """Verify a token's signature and claims, or get the payload of a token verified before from cache
+        """
+        payload = self._token_cache.get(token) if self._token_cache is not None else None
+        if payload is not None:
+            return {"verified": True, "payload": payload, "errors": []}
+
+        verified = verification.verify_token(token, self._key, self._algorithm, issuer=self._issuer,
+                                             audience=self._audience)
+        if verified['verified'] and self._token_cache is not None:
+            self._token_cache.set(token, verified['payload'])
+        return verified
+
+    def check_state(self, payload, check_replay=False, record_replay=True):
+        # type: (Dict[str, Any], bool, bool) -> Dict[str, Any]
+        """Check that a verified token has not been revoked or replayed
+
+        Returns the fields to update the verification result with; These are
+        empty if the token is still valid.
+        """
+        if self._revocations is not None and self._revocations.is_revoked(payload):
+            return {"verified": False,
+                    "revoked": True,
+                    "message": "Token has been revoked",
+                    "errors": [{"claim": "jti", "reason": "revoked", "message": "Token has been revoked"}]}
+
+        if check_replay:
+            if self._replay_detector is None:
+                raise ValueError("No replay detector is configured")
+            if self._replay_detector.is_payload_replayed(payload, record_replay):
+                message = "Token has already been used, or has no token ID"
+                return {"verified": False,
+                        "replayed": True,
+                        "message": message,
+                        "errors": [{"claim": "jti", "reason": "replayed", "message": message}]}
+
+        return {}
+
+
+def get_token_verifier():
+    # type: () -> TokenVerifier
+    """Get a token verifier using the configured key, issuer, audience, revocation list and replay detector
+
+    Raises `ValueError` if no key is configured to verify tokens.
+    """
+    algorithm = keys.get_algorithm()
+    key = keys.get_verification_key(algorithm)
+    if key is None:
+        raise ValueError("No key is configured to verify JWT token")
+
+    issuer, audience = get_issuer(), get_audience()
+    return TokenVerifier(key, algorithm, issuer=issuer, audience=audience,
+                         revocations=get_revocation_list(), replay_detector=get_replay_detector(),
+                         token_cache=get_verified_token_cache(algorithm, issuer, audience))
+
+
+def get_issuer():
+    # type: () -> Optional[str]
+    """Get the configured token issuer
+    """
+    return util.get_config('jwt_issuer', util.get_global_config('ckan.site_url'))
+
+
+def get_audience():
+    # type: () -> Optional[str]
+    """Get the configured token audience
+    """
+    return util.get_config('jwt_audience')
+
+
+def get_revocation_list():
+    # type: () -> RevocationList
+    """Get the token revocation list
+    """
+    return RevocationList(cache.get_backend('revocations'),
+                          util.get_config_int('jwt_max_lifetime', DEFAULT_MAX_LIFETIME))
+
+
+def get_verified_token_cache(algorithm, issuer=None, audience=None):
+    # type: (str, Optional[str], Optional[str]) -> Optional[VerifiedTokenCache]
+    """Get the cache of verified tokens, or `None` if it is disabled
+    """
+    ttl = util.get_config_int('verified_token_cache_ttl', 0)
+    if ttl <= 0:
+        return None
+    verification_id = json.dumps([keys.get_verification_key_id(algorithm), algorithm, issuer, audience])
+    return VerifiedTokenCache(cache.get_backend(TOKEN_CACHE_NAMESPACE), ttl, verification_id)
+
+
+def get_replay_detector():
+    # type: () -> Union[ReplayDetector, SharedReplayDetector]
+    """Get the replay detector used to verify tokens, creating it on first use
+
+    Seen token IDs are kept in the `replay` cache backend if it is shared
+    between processes, and in the memory of each process otherwise.
+    """
+    global _replay_detector
+    if _replay_detector is None:
+        max_lifetime = util.get_config_int('jwt_max_lifetime', DEFAULT_MAX_LIFETIME)
+        backend = cache.get_backend(REPLAY_CACHE_NAMESPACE)
+        if backend.shared:
+            _replay_detector = SharedReplayDetector(backend, max_lifetime)
+        else:
+            _replay_detector = ReplayDetector(max_lifetime,
+                                              util.get_config_int('replay_detection_capacity', DEFAULT_CAPACITY))
+    return _replay_detector
+
+
+def reset_replay_detector():
+    # type: () -> None
+    """Discard the replay detector used to verify tokens
+    """
+    global _replay_detector
+    _replay_detector = None
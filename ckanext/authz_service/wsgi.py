@@ -0,0 +1,232 @@
+"""Standalone token verification app
+
+A minimal WSGI app serving this extension's token verification and public
+key endpoints: the `authz_verify` and `authz_public_key` actions under the
+CKAN action API paths, and `/authz/public_key`. Responses are the same as
+those CKAN returns for these endpoints, and the same configuration settings
+are read from CKAN's configuration file; But as CKAN itself is not loaded,
+the app starts quickly, uses no DB connections, and can be scaled out
+independently of CKAN, so token consumers can verify tokens without loading
+CKAN workers.
+
+The app keeps no state of its own other than parsed keys. Revocations are
+read from the configured cache backend, which should be `redis` for tokens
+revoked through CKAN to be rejected by the app as well. Replay detection,
+if requested, is tracked per process.
+
+The app can be run by any WSGI server, e.g.:
+
+    gunicorn 'ckanext.authz_service.wsgi:create_app("/etc/ckan/default/ckan.ini")'
+
+Or using PasteDeploy, as the `egg:ckanext-authz-service#verify` app.
+
+This module does not depend on CKAN.
+"""
+import configparser
+import json
+import os
+from http import HTTPStatus
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from . import keys, util, verifier
+
+API_PATHS = ('/api/action/', '/api/3/action/')
+
+PUBLIC_KEY_PATH = '/authz/public_key'
+
+MAX_REQUEST_SIZE = 64 * 1024
+
+StartResponse = Callable[[str, List[Any]], Any]
+
+
+class RequestError(Exception):
+    """An error to respond with, in the format of the CKAN action API
+    """
+
+    def __init__(self, status, error):
+        # type: (int, Dict[str, Any]) -> None
+        super(RequestError, self).__init__(error.get('message'))
+        self.status = status
+        self.error = error
+
+
+class VerificationApp(object):
+    """WSGI app serving the token verification and public key endpoints
+
+    As configuration settings are global to the process, only one app should
+    be created per process.
+    """
+
+    def __init__(self, config):
+        # type: (Mapping[str, Any]) -> None
+        util.set_config(config)
+        self._actions = {"authz_verify": self.verify,
+                         "authz_public_key": self.public_key}  # type: Dict[str, Callable[[Dict[str, Any], str], Any]]
+        # Fail early if no key is configured, and load the `jwt` library and keys
+        verifier.get_token_verifier()
+
+    def __call__(self, environ, start_response):
+        # type: (Dict[str, Any], StartResponse) -> Iterable[bytes]
+        path = environ.get('PATH_INFO') or '/'
+        if path == PUBLIC_KEY_PATH:
+            return self._public_key_file(environ, start_response)
+
+        for prefix in API_PATHS:
+            if path.startswith(prefix):
+                return self._call_action(path[len(prefix):].rstrip('/'), environ, start_response)
+
+        return _respond(start_response, 404, b'Not Found', 'text/plain')
+
+    def verify(self, data_dict, method='POST'):
+        # type: (Dict[str, Any], str) -> Dict[str, Any]
+        """Validate a JWT token and dump its payload, as the `authz_verify` action does
+
+        As with the action, GET requests check for replays without recording
+        the token as used.
+        """
+        token = data_dict.get('token')
+        if not token:
+            raise RequestError(409, {"__type": "Validation Error", "token": "Missing value"})
+
+        try:
+            strict = util.asbool(data_dict.get('strict', True))
+            check_replay = util.asbool(data_dict.get('check_replay', util.get_config_bool('replay_detection')))
+        except ValueError as e:
+            raise RequestError(409, {"__type": "Validation Error", "message": str(e)})
+
+        return verifier.get_token_verifier().verify(token, strict=strict, check_replay=check_replay,
+                                                    record_replay=method != 'GET')
+
+    def public_key(self, data_dict, method='POST'):
+        # type: (Dict[str, Any], str) -> Dict[str, Any]
+        """Provide the public key used for JWT signing, as the `authz_public_key` action does
+        """
+        pub_key = keys.get_public_key()
+        if not pub_key:
+            raise RequestError(404, {"__type": "Not Found Error",
+                                     "message": "Not found: Public key has not been configured"})
+        return {"public_key": pub_key.decode('ascii')}
+
+    def _call_action(self, name, environ, start_response):
+        # type: (str, Dict[str, Any], StartResponse) -> Iterable[bytes]
+        """Call an action, and respond the way the CKAN action API does
+        """
+        response = {"help": '{}/api/3/action/help_show?name={}'.format(
+            util.get_global_config('ckan.site_url', '').rstrip('/'), name)}
+        try:
+            if name not in self._actions:
+                raise RequestError(400, {"__type": "Bad Request",
+                                         "message": "Action name not known: {}".format(name)})
+            response['result'] = self._actions[name](_get_request_data(environ), environ.get('REQUEST_METHOD', 'GET'))
+            response['success'] = True
+            status = 200
+        except RequestError as e:
+            response['error'] = e.error
+            response['success'] = False
+            status = e.status
+
+        return _respond(start_response, status, json.dumps(response).encode('utf-8'), 'application/json;charset=utf-8')
+
+    @staticmethod
+    def _public_key_file(environ, start_response):
+        # type: (Dict[str, Any], StartResponse) -> Iterable[bytes]
+        """Respond with the public key file, or with no content if no public key is configured
+
+        Conditional requests for an unchanged key are responded to with 304.
+        """
+        pub_key = keys.get_public_key()
+        if not pub_key:
+            return _respond(start_response, 204, b'')
+        etag = '"{}"'.format(keys.get_public_key_etag(pub_key))
+        if etag in environ.get('HTTP_IF_NONE_MATCH', '').split(', '):
+            return _respond(start_response, 304, b'', headers=[('ETag', etag)])
+        return _respond(start_response, 200, pub_key, 'application/x-pem-file', [('ETag', etag)])
+
+
+def create_app(config_file=None):
+    # type: (Optional[str]) -> VerificationApp
+    """Create the app, reading settings from a CKAN configuration file
+
+    If no file is specified, the file specified by the `CKAN_INI` environment
+    variable is used.
+    """
+    config_file = config_file or os.environ.get('CKAN_INI')
+    if not config_file:
+        raise ValueError("No CKAN configuration file was specified, and CKAN_INI is not set")
+    return VerificationApp(load_config(config_file))
+
+
+def make_app(global_conf, **local_conf):
+    # type: (Dict[str, Any], Any) -> VerificationApp
+    """PasteDeploy app factory
+
+    Settings can be specified directly in the app's section, or read from a
+    CKAN configuration file specified as `config_file`.
+    """
+    config = dict(global_conf)
+    if local_conf.get('config_file'):
+        config.update(load_config(local_conf['config_file']))
+    config.update(local_conf)
+    return VerificationApp(config)
+
+
+def load_config(config_file, section='app:main'):
+    # type: (str, str) -> Dict[str, str]
+    """Read settings from a section of a CKAN configuration (.ini) file
+    """
+    config_file = os.path.abspath(config_file)
+    parser = configparser.ConfigParser(defaults={"here": os.path.dirname(config_file), "__file__": config_file})
+    parser.optionxform = str  # type: ignore
+    with open(config_file) as f:
+        parser.read_file(f)
+
+    config = {}
+    for key in parser.options(section):
+        try:
+            config[key] = parser.get(section, key)
+        except configparser.InterpolationError:
+            config[key] = parser.get(section, key, raw=True)
+    return config
+
+
+def _get_request_data(environ):
+    # type: (Dict[str, Any]) -> Dict[str, Any]
+    """Get action parameters from the query string or the request body
+    """
+    if environ.get('REQUEST_METHOD', 'GET') in ('GET', 'HEAD'):
+        return dict(parse_qsl(environ.get('QUERY_STRING', '')))
+
+    body = _read_body(environ)
+    if environ.get('CONTENT_TYPE', '').startswith('application/x-www-form-urlencoded'):
+        return dict(parse_qsl(body.decode('utf-8')))
+
+    try:
+        data = json.loads(body.decode('utf-8')) if body else {}
+    except ValueError as e:
+        raise RequestError(400, {"__type": "Bad Request", "message": "JSON Error: {}".format(e)})
+    if not isinstance(data, dict):
+        raise RequestError(400, {"__type": "Bad Request",
+                                 "message": "JSON Error: Request data JSON decoded to {!r} but it needs to be "
+                                            "a dictionary.".format(data)})
+    return data
+
+
+def _read_body(environ):
+    # type: (Dict[str, Any]) -> bytes
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > MAX_REQUEST_SIZE:
+        raise RequestError(400, {"__type": "Bad Request", "message": "Request body is too large"})
+    return environ['wsgi.input'].read(length) if length else b''
+
+
+def _respond(start_response, status, body, content_type=None, headers=None):
+    # type: (StartResponse, int, bytes, Optional[str], Optional[List[Tuple[str, str]]]) -> List[bytes]
+    headers = [('Content-Length', str(len(body)))] + (headers or [])
+    if content_type:
+        headers.append(('Content-Type', content_type))
+    start_response('{} {}'.format(status, HTTPStatus(status).phrase), headers)
+    return [body]
@@ -83,6 +83,9 @@ setup(
         [ckan.plugins]
         authz_service=ckanext.authz_service.plugin:AuthzServicePlugin
 
+        [paste.app_factory]
+        verify=ckanext.authz_service.wsgi:make_app
+
         [babel.extractors]
         ckan = ckan.lib.extract:extract_ckan
     ''',